@@ -38,11 +38,8 @@ class SEEDBenchDataset(BaseEvalDataset):
                     data_dict["choice_d"],
                 ]
 
-                option_losses = []
-                for idx, option in enumerate(options):
-                    option = option_index[idx] + ". " + option
-                    loss = model.eval_forward(question, option, image)
-                    option_losses.append(loss.item())
+                options = [option_index[idx] + ". " + option for idx, option in enumerate(options)]
+                option_losses = model.score_options(question, options, image)
 
                 prediction_idx = np.argmin(option_losses)
                 prediction = ["A", "B", "C", "D"][prediction_idx]
@@ -1,8 +1,10 @@
 from abc import ABC, abstractmethod
 from PIL import Image
-from typing import Dict
+from typing import Dict, List
 
 import importlib
+import torch
+import torch.nn.functional as F
 
 AVAILABLE_MODELS: Dict[str, str] = {
     "video_chat": "VideoChat",
@@ -37,6 +39,30 @@ class BaseModel(ABC):
     def eval_forward(self, **kwargs):
         pass
 
+    def score_options(self, prompt: str, options: List[str], image) -> List[float]:
+        """
+        Loss of each answer option after the same prompt and image, lower is better. Models override this to encode the
+        image and the prompt once for all the options; by default every option goes through `eval_forward`.
+        """
+        return [float(self.eval_forward(prompt, option, image)) for option in options]
+
+
+def option_losses(prefix_logits: torch.Tensor, option_logits: torch.Tensor, option_ids: torch.Tensor, option_mask: torch.Tensor) -> List[float]:
+    """
+    Mean negative log-likelihood of the tokens of each option, as the language modeling loss of the option tokens of a
+    full prompt + option sequence would be.
+
+    Args:
+        prefix_logits: logits after the last prompt token, shape (V,)
+        option_logits: logits of the options continued from the prompt cache, shape (num_options, T, V)
+        option_ids: options padded on the right, shape (num_options, T)
+        option_mask: 1 for the option tokens and 0 for the padding, shape (num_options, T)
+    """
+    num_options = option_ids.shape[0]
+    logits = torch.cat([prefix_logits.expand(num_options, 1, -1), option_logits[:, :-1]], dim=1).float()
+    token_losses = F.cross_entropy(logits.transpose(1, 2), option_ids, reduction="none") * option_mask
+    return (token_losses.sum(dim=-1) / option_mask.sum(dim=-1)).tolist()
+
 
 def load_model(model_name: str, model_args: Dict[str, str]) -> BaseModel:
     assert model_name in AVAILABLE_MODELS, f"{model_name} is not an available model."
@@ -3,7 +3,7 @@ import torch
 from typing import List
 from transformers import IdeficsForVisionText2Text, AutoProcessor
 from PIL import Image
-from .base_model import BaseModel
+from .base_model import BaseModel, option_losses
 from pipeline.train.train_utils import find_and_remove_tokens, get_image_attention_mask
 import base64
 import numpy as np
@@ -220,6 +220,38 @@ class Idefics(BaseModel):
 
         return all_option_losses
 
+    def score_options(self, question, options, image):
+        # same prompt as eval_forward, whose <answer> token is removed before the forward
+        prompt = f"User:<fake_token_around_image><image><fake_token_around_image>{question}<end_of_utterance>\nAssistant:"
+        inputs = self.processor.tokenizer(prompt, return_tensors="pt").to(self.device)
+        vision_x = self.patch_resize_transform(image).unsqueeze(0).to(self.device)
+        with torch.no_grad():
+            prefix = self.model(
+                pixel_values=vision_x,
+                input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                image_attention_mask=get_image_attention_mask(inputs["input_ids"], 1, self.processor.tokenizer).to(self.device),
+                use_cache=True,
+            )
+
+            option_ids = [torch.tensor(self.processor.tokenizer(f"{option}<end_of_utterance>", add_special_tokens=False)["input_ids"]) for option in options]
+            option_mask = torch.nn.utils.rnn.pad_sequence([torch.ones_like(ids) for ids in option_ids], batch_first=True).to(self.device)
+            option_ids = torch.nn.utils.rnn.pad_sequence(option_ids, batch_first=True, padding_value=self.endofchunk_token_id).to(self.device)
+            num_options, option_len = option_ids.shape
+            prefix_len = inputs["input_ids"].shape[1]
+            # the options continue the prompt cache and reuse its image features, expanded over the options as views
+            image_features = {("perceiver_embeddings" if self.model.config.use_resampler else "image_encoder_embeddings"): prefix.image_hidden_states.expand(num_options, -1, -1, -1)}
+            outputs = self.model(
+                input_ids=option_ids,
+                attention_mask=torch.cat([inputs["attention_mask"].expand(num_options, -1), option_mask], dim=1),
+                # the model derives positions from the whole attention mask, give the ones of the new tokens
+                position_ids=torch.arange(prefix_len, prefix_len + option_len, device=self.device).expand(num_options, -1),
+                image_attention_mask=torch.ones(num_options, option_len, 1, dtype=torch.long, device=self.device),
+                past_key_values=tuple(tuple(t.expand(num_options, -1, -1, -1) for t in layer_past) for layer_past in prefix.past_key_values),
+                **image_features,
+            )
+        return option_losses(prefix.logits[0, -1], outputs.logits, option_ids, option_mask)
+
 
 if __name__ == "__main__":
     model = Idefics("/data/pufanyi/training_data/checkpoints/idefics-9b-instruct")
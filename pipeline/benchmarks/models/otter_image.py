@@ -9,6 +9,8 @@ import transformers
 from PIL import Image
 
 from otter_ai import OtterForConditionalGeneration
+from otter_ai.models.delta_checkpoint import from_pretrained_with_delta
+from otter_ai.models.fast_load import fast_from_pretrained
 from .base_model import BaseModel
 
 
@@ -32,7 +34,7 @@ def get_formatted_forward_prompt(question: str, answer: str) -> str:
 
 
 class OtterImage(BaseModel):
-    def __init__(self, model_path="luodian/OTTER-Image-MPT7B", load_bit="bf16"):
+    def __init__(self, model_path="luodian/OTTER-Image-MPT7B", load_bit="bf16", delta_path=None, fast_load=False):
         super().__init__("otter", model_path)
         precision = {}
         if load_bit == "bf16":
@@ -41,7 +43,12 @@ class OtterImage(BaseModel):
             precision["torch_dtype"] = torch.float16
         elif load_bit == "fp32":
             precision["torch_dtype"] = torch.float32
-        self.model = OtterForConditionalGeneration.from_pretrained(model_path, device_map="sequential", **precision)
+        if fast_load:
+            if "torch_dtype" not in precision:
+                raise ValueError(f"fast_load converts the weights to a floating point dtype, load_bit={load_bit} is not supported with it.")
+            self.model, self.delta_overlay = fast_from_pretrained(OtterForConditionalGeneration, model_path, torch_dtype=precision["torch_dtype"], delta_path=delta_path)
+        else:
+            self.model, self.delta_overlay = from_pretrained_with_delta(OtterForConditionalGeneration, model_path, delta_path, device_map="sequential", **precision)
         self.model.text_tokenizer.padding_side = "left"
         self.tokenizer = self.model.text_tokenizer
         self.image_processor = transformers.CLIPImageProcessor()
@@ -103,6 +110,20 @@ class OtterImage(BaseModel):
             loss = self.model(vision_x=vision_x.to(self.model.device), lang_x=input_ids.to(self.model.device), attention_mask=attention_mask.to(self.model.device))[0]
         return loss
 
+    def score_options(self, question, options, image):
+        # the image and the prompt go through the model once, the options are scored together from the prompt cache
+        tokens = self.tokenizer(get_formatted_prompt(question), return_tensors="pt")
+        vision_x = self.get_vision_x(get_pil_image(image))
+        state = self.model.prefill(
+            vision_x=vision_x.to(self.model.device),
+            lang_x=tokens["input_ids"].to(self.model.device),
+            attention_mask=tokens["attention_mask"].to(self.model.device),
+        )
+        candidates = [self.tokenizer(f" {option}<|endofchunk|>", add_special_tokens=False, return_tensors="pt")["input_ids"][0] for option in options]
+        log_likelihoods = self.model.score(state, candidates)[0]
+        lengths = torch.tensor([len(candidate) for candidate in candidates], device=log_likelihoods.device)
+        return (-log_likelihoods / lengths).tolist()
+
 
 if __name__ == "__main__":
     model = OtterImage("/data/pufanyi/training_data/checkpoints/OTTER-Image-MPT7B")
@@ -11,6 +11,7 @@ import sys
 
 sys.path.append("/mnt/petrelfs/zhangyuanhan/Otter/")
 from src.otter_ai.models.otter.modeling_otter import OtterForConditionalGeneration
+from src.otter_ai.models.delta_checkpoint import from_pretrained_with_delta
 from .base_model import BaseModel
 
 # Disable warnings
@@ -18,7 +19,7 @@ requests.packages.urllib3.disable_warnings()
 
 
 class OtterVideo(BaseModel):
-    def __init__(self, model_path="luodian/OTTER-Video-LLaMA7B-DenseCaption", load_bit="bf16"):
+    def __init__(self, model_path="luodian/OTTER-Video-LLaMA7B-DenseCaption", load_bit="bf16", delta_path=None):
         super().__init__("otter_video", model_path)
         precision = {}
         if load_bit == "bf16":
@@ -27,7 +28,7 @@ class OtterVideo(BaseModel):
             precision["torch_dtype"] = torch.float16
         elif load_bit == "fp32":
             precision["torch_dtype"] = torch.float32
-        self.model = OtterForConditionalGeneration.from_pretrained(model_path, device_map="sequential", **precision)
+        self.model, self.delta_overlay = from_pretrained_with_delta(OtterForConditionalGeneration, model_path, delta_path, device_map="sequential", **precision)
         self.tensor_dtype = {
             "fp16": torch.float16,
             "bf16": torch.bfloat16,
@@ -1,6 +1,6 @@
 from transformers import FuyuForCausalLM, AutoTokenizer, FuyuImageProcessor, FuyuProcessor
 from PIL import Image
-from .base_model import BaseModel
+from .base_model import BaseModel, option_losses
 import torch
 import numpy as np
 import warnings
@@ -40,7 +40,7 @@ class OtterHD(BaseModel):
         self.processor = FuyuProcessor(image_processor=self.image_processor, tokenizer=self.tokenizer)
         self.max_new_tokens = max_new_tokens
 
-    def generate(self, text_prompt: str, raw_image_data: str):
+    def _prepare_inputs(self, text_prompt: str, raw_image_data):
         raw_image_data = get_pil_image(raw_image_data)
         # make sure the image is in RGB format and resize to match the width
         raw_image_data = raw_image_data.convert("RGB")
@@ -58,6 +58,10 @@ class OtterHD(BaseModel):
             model_inputs[k] = v.to(self.device, non_blocking=True) if isinstance(v, torch.Tensor) else [vv.to(self.device, non_blocking=True) for vv in v]
 
         model_inputs["image_patches"][0] = model_inputs["image_patches"][0].to(dtype=next(self.model.parameters()).dtype)
+        return model_inputs
+
+    def generate(self, text_prompt: str, raw_image_data: str):
+        model_inputs = self._prepare_inputs(text_prompt, raw_image_data)
         generation_output = self.model.generate(**model_inputs, max_new_tokens=self.max_new_tokens, pad_token_id=self.tokenizer.eos_token_id)
         generation_text = self.processor.batch_decode(generation_output, skip_special_tokens=True)
         response = generation_text[0].split("\x04")[1].strip(" ").strip("\n")
@@ -66,3 +70,20 @@ class OtterHD(BaseModel):
     def eval_forward(self, text_prompt: str, image_path: str):
         # Similar to the Idefics' eval_forward but adapted for Fuyu
         pass
+
+    def score_options(self, text_prompt: str, options, raw_image_data):
+        # the prompt ends with the beginning-of-answer token, the image patches only go through the prompt forward
+        model_inputs = self._prepare_inputs(text_prompt, raw_image_data)
+        with torch.no_grad():
+            prefix = self.model(**model_inputs, use_cache=True)
+
+            option_ids = [torch.tensor(self.tokenizer(f" {option}", add_special_tokens=False)["input_ids"] + [self.tokenizer.eos_token_id]) for option in options]
+            option_mask = torch.nn.utils.rnn.pad_sequence([torch.ones_like(ids) for ids in option_ids], batch_first=True).to(self.device)
+            option_ids = torch.nn.utils.rnn.pad_sequence(option_ids, batch_first=True, padding_value=self.tokenizer.eos_token_id).to(self.device)
+            num_options = option_ids.shape[0]
+            outputs = self.model(
+                input_ids=option_ids,
+                attention_mask=torch.cat([model_inputs["attention_mask"].expand(num_options, -1), option_mask], dim=1),
+                past_key_values=tuple(tuple(t.expand(num_options, -1, -1, -1) for t in layer_past) for layer_past in prefix.past_key_values),
+            )
+        return option_losses(prefix.logits[0, -1], outputs.logits, option_ids, option_mask)
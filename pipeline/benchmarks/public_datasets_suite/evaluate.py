@@ -30,6 +30,7 @@ from .classification_utils import (
 )
 
 from .eval_model import BaseEvalModel
+from .models.utils import unwrap_model
 
 from .ok_vqa_utils import postprocess_ok_vqa_generation
 from .vqa_metric import compute_vqa_accuracy, postprocess_vqa_generation
@@ -1064,7 +1065,10 @@ def evaluate_classification(
             """Detach a set of past key values."""
             return list([tuple([x.detach() for x in inner]) for inner in pkvs])
 
-        if not no_kv_caching:
+        # models with a prefix state API (Otter) score every class name against the cached context at once
+        use_prefix_state = not no_kv_caching and hasattr(unwrap_model(eval_model.model), "score")
+
+        if not no_kv_caching and not use_prefix_state:
             eval_model.cache_media(
                 input_ids=ctx_and_prompt_input_ids,
                 vision_x=vision_x.to(eval_model.device),
@@ -1095,85 +1099,92 @@ def evaluate_classification(
         else:
             class_id_to_name = HM_CLASS_ID_TO_LABEL
 
-        overall_probs = []
-        for class_name in all_class_names:
-            past_key_values = None
-            # Tokenize only the class name and iteratively decode the model's
-            # predictions for this class.
-            classname_tokens = tokenizer(class_name, add_special_tokens=False, return_tensors="pt")["input_ids"].to(eval_model.device)
-
-            if classname_tokens.ndim == 1:  # Case: classname is only 1 token
-                classname_tokens = torch.unsqueeze(classname_tokens, 1)
-
-            classname_tokens = repeat(classname_tokens, "b s -> (repeat b) s", repeat=len(batch_text))
-
-            if not no_kv_caching:
-                # Compute the outputs one token at a time, using cached
-                # activations.
-
-                # Initialize the elementwise predictions with the last set of
-                # logits from precomputed; this will correspond to the predicted
-                # probability of the first position/token in the imagenet
-                # classname. We will append the logits for each token to this
-                # list (each element has shape [B, 1, vocab_size]).
-                elementwise_logits = [precomputed_logits[:, -2:-1, :]]
+        if use_prefix_state:
+            prefix_model = unwrap_model(eval_model.model)
+            classname_tokens = [tokenizer(class_name, add_special_tokens=False, return_tensors="pt")["input_ids"][0] for class_name in all_class_names]
+            with eval_model.autocast():
+                state = prefix_model.prefill(vision_x.to(eval_model.device), ctx_and_prompt_input_ids, attention_mask=ctx_and_prompt_attention_mask.long())
+                overall_probs = prefix_model.score(state, classname_tokens).exp().cpu().numpy()  # shape [B, num_classes]
+        else:
+            overall_probs = []
+            for class_name in all_class_names:
+                past_key_values = None
+                # Tokenize only the class name and iteratively decode the model's
+                # predictions for this class.
+                classname_tokens = tokenizer(class_name, add_special_tokens=False, return_tensors="pt")["input_ids"].to(eval_model.device)
+
+                if classname_tokens.ndim == 1:  # Case: classname is only 1 token
+                    classname_tokens = torch.unsqueeze(classname_tokens, 1)
+
+                classname_tokens = repeat(classname_tokens, "b s -> (repeat b) s", repeat=len(batch_text))
+
+                if not no_kv_caching:
+                    # Compute the outputs one token at a time, using cached
+                    # activations.
+
+                    # Initialize the elementwise predictions with the last set of
+                    # logits from precomputed; this will correspond to the predicted
+                    # probability of the first position/token in the imagenet
+                    # classname. We will append the logits for each token to this
+                    # list (each element has shape [B, 1, vocab_size]).
+                    elementwise_logits = [precomputed_logits[:, -2:-1, :]]
+
+                    for token_idx in range(classname_tokens.shape[1]):
+                        _lang_x = classname_tokens[:, token_idx].reshape((-1, 1))
+                        outputs = eval_model.get_logits(
+                            lang_x=_lang_x,
+                            past_key_values=(past_key_values if token_idx > 0 else precomputed_pkvs),
+                            clear_conditioned_layers=False,
+                        )
+                        past_key_values = _detach_pkvs(outputs.past_key_values)
+                        elementwise_logits.append(outputs.logits.detach())
+
+                    # logits/probs has shape [B, classname_tokens + 1, vocab_size]
+                    logits = torch.concat(elementwise_logits, 1)
+                    probs = torch.softmax(logits, dim=-1)
+
+                    # collect the probability of the generated token -- probability
+                    # at index 0 corresponds to the token at index 1.
+                    probs = probs[:, :-1, :]  # shape [B, classname_tokens, vocab_size]
+
+                    gen_probs = torch.gather(probs, 2, classname_tokens[:, :, None]).squeeze(-1).cpu()
+
+                    class_prob = torch.prod(gen_probs, 1).numpy()
+                else:
+                    # Compute the outputs without using cached
+                    # activations.
+
+                    # contatenate the class name tokens to the end of the context
+                    # tokens
+                    _lang_x = torch.cat([ctx_and_prompt_input_ids, classname_tokens], dim=1)
+                    _attention_mask = torch.cat(
+                        [
+                            ctx_and_prompt_attention_mask,
+                            torch.ones_like(classname_tokens).bool(),
+                        ],
+                        dim=1,
+                    )
 
-                for token_idx in range(classname_tokens.shape[1]):
-                    _lang_x = classname_tokens[:, token_idx].reshape((-1, 1))
                     outputs = eval_model.get_logits(
-                        lang_x=_lang_x,
-                        past_key_values=(past_key_values if token_idx > 0 else precomputed_pkvs),
-                        clear_conditioned_layers=False,
+                        vision_x=vision_x.to(eval_model.device),
+                        lang_x=_lang_x.to(eval_model.device),
+                        attention_mask=_attention_mask.to(eval_model.device),
+                        clear_conditioned_layers=True,
                     )
-                    past_key_values = _detach_pkvs(outputs.past_key_values)
-                    elementwise_logits.append(outputs.logits.detach())
-
-                # logits/probs has shape [B, classname_tokens + 1, vocab_size]
-                logits = torch.concat(elementwise_logits, 1)
-                probs = torch.softmax(logits, dim=-1)
-
-                # collect the probability of the generated token -- probability
-                # at index 0 corresponds to the token at index 1.
-                probs = probs[:, :-1, :]  # shape [B, classname_tokens, vocab_size]
-
-                gen_probs = torch.gather(probs, 2, classname_tokens[:, :, None]).squeeze(-1).cpu()
-
-                class_prob = torch.prod(gen_probs, 1).numpy()
-            else:
-                # Compute the outputs without using cached
-                # activations.
-
-                # contatenate the class name tokens to the end of the context
-                # tokens
-                _lang_x = torch.cat([ctx_and_prompt_input_ids, classname_tokens], dim=1)
-                _attention_mask = torch.cat(
-                    [
-                        ctx_and_prompt_attention_mask,
-                        torch.ones_like(classname_tokens).bool(),
-                    ],
-                    dim=1,
-                )
-
-                outputs = eval_model.get_logits(
-                    vision_x=vision_x.to(eval_model.device),
-                    lang_x=_lang_x.to(eval_model.device),
-                    attention_mask=_attention_mask.to(eval_model.device),
-                    clear_conditioned_layers=True,
-                )
 
-                logits = outputs.logits.detach().float()
-                probs = torch.softmax(logits, dim=-1)
+                    logits = outputs.logits.detach().float()
+                    probs = torch.softmax(logits, dim=-1)
 
-                # get probability of the generated class name tokens
-                gen_probs = probs[:, ctx_and_prompt_input_ids.shape[1] - 1 : _lang_x.shape[1], :]
-                gen_probs = torch.gather(gen_probs, 2, classname_tokens[:, :, None]).squeeze(-1).cpu()
-                class_prob = torch.prod(gen_probs, 1).numpy()
+                    # get probability of the generated class name tokens
+                    gen_probs = probs[:, ctx_and_prompt_input_ids.shape[1] - 1 : _lang_x.shape[1], :]
+                    gen_probs = torch.gather(gen_probs, 2, classname_tokens[:, :, None]).squeeze(-1).cpu()
+                    class_prob = torch.prod(gen_probs, 1).numpy()
 
-            overall_probs.append(class_prob)
+                overall_probs.append(class_prob)
 
-        overall_probs = np.row_stack(overall_probs).T  # shape [B, num_classes]
+            overall_probs = np.row_stack(overall_probs).T  # shape [B, num_classes]
 
-        eval_model.uncache_media()
+            eval_model.uncache_media()
 
         def topk(probs_ary: np.ndarray, k: int) -> np.ndarray:
             """Return the indices of the top k elements in probs_ary."""
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Tuple
 
 from PIL import Image
 import torch
@@ -8,6 +8,8 @@ from pipeline.benchmarks.public_datasets_suite.eval_model import BaseEvalModel
 from contextlib import suppress
 from pipeline.benchmarks.public_datasets_suite.models.utils import unwrap_model
 from otter_ai import OtterForConditionalGeneration
+from otter_ai.models.delta_checkpoint import DeltaOverlay
+from otter_ai.models.fast_load import fast_from_pretrained
 import os
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -32,22 +34,34 @@ class EvalModel(BaseEvalModel):
                 return torch.float32
 
         self.device = model_args["device"]
-        kwargs = {"torch_dtype": get_precision(model_args["precision"])}
-        self.model = OtterForConditionalGeneration.from_pretrained(
-            model_args["model_path"],
-            **kwargs,
-        ).cuda()
+        if model_args.get("fast_load", "False") == "True":
+            # the trained checkpoint is merged into the cached fused weights instead of being loaded on top
+            self.model, _ = fast_from_pretrained(
+                OtterForConditionalGeneration,
+                model_args["model_path"],
+                torch_dtype=get_precision(model_args["precision"]) or torch.float32,
+                checkpoint_path=model_args.get("checkpoint_path"),
+            )
+        else:
+            kwargs = {"torch_dtype": get_precision(model_args["precision"])}
+            self.model = OtterForConditionalGeneration.from_pretrained(
+                model_args["model_path"],
+                **kwargs,
+            ).cuda()
         # self.model.to(self.device)
         self.image_processor = transformers.CLIPImageProcessor()
         self.tokenizer = self.model.text_tokenizer
 
-        if "checkpoint_path" in model_args:
+        if "checkpoint_path" in model_args and model_args.get("fast_load", "False") != "True":
             checkpoint = torch.load(model_args["checkpoint_path"], map_location=self.device)
             if "model_state_dict" in checkpoint:
                 checkpoint = checkpoint["model_state_dict"]
                 checkpoint = {k.replace("module.", ""): v for k, v in checkpoint.items()}
             msg = self.model.load_state_dict(checkpoint, strict=False)
             print(msg)
+        self.delta_overlay = DeltaOverlay(self.model, model_args["model_path"])
+        if "delta_path" in model_args:
+            self.delta_overlay.apply(model_args["delta_path"])
         # self.model.to(self.device)
         self.model.eval()
         self.tokenizer.padding_side = "left"
@@ -56,29 +70,18 @@ class EvalModel(BaseEvalModel):
         self.autocast = get_autocast(model_args["precision"])
         self.cast_dtype = get_cast_dtype(model_args["precision"])
 
-    def _prepare_images(self, batch: List[List[torch.Tensor]]) -> torch.Tensor:
-        """Preprocess images and stack them.
+    def _prepare_images(self, batch: List[List[torch.Tensor]]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Preprocess images and pack them, without padding examples to the same number of images.
 
         Args:
             batch: A list of lists of images.
 
         Returns:
-            A Tensor of shape
-            (batch_size, images_per_example, frames, channels, height, width).
+            The images of all examples back to back, a Tensor of shape
+            (total_images, frames, channels, height, width), and the number of images of each example.
         """
-        images_per_example = max(len(x) for x in batch)
-        batch_images = None
-        for iexample, example in enumerate(batch):
-            for iimage, image in enumerate(example):
-                preprocessed = torch.from_numpy(self.image_processor(image)["pixel_values"][0])
-
-                if batch_images is None:
-                    batch_images = torch.zeros(
-                        (len(batch), images_per_example, 1) + preprocessed.shape,
-                        dtype=preprocessed.dtype,
-                    )
-                batch_images[iexample, iimage, 0] = preprocessed
-        return batch_images
+        images = [torch.from_numpy(self.image_processor(image)["pixel_values"][0]) for example in batch for image in example]
+        return torch.stack(images).unsqueeze(1), torch.tensor([len(example) for example in batch])
 
     def get_outputs(
         self,
@@ -99,12 +102,14 @@ class EvalModel(BaseEvalModel):
         input_ids = encodings["input_ids"]
         attention_mask = encodings["attention_mask"]
 
+        images, num_images = self._prepare_images(batch_images)
         with torch.inference_mode():
             with self.autocast():
                 outputs = unwrap_model(self.model).generate(
-                    self._prepare_images(batch_images).to(self.device, dtype=self.cast_dtype, non_blocking=True),
+                    images.to(self.device, dtype=self.cast_dtype, non_blocking=True),
                     input_ids.to(self.device, non_blocking=True),
                     attention_mask=attention_mask.to(self.device, non_blocking=True),
+                    num_images=num_images.to(self.device),
                     min_new_tokens=min_generation_length,
                     max_new_tokens=max_generation_length,
                     num_beams=num_beams,
@@ -8,6 +8,7 @@ from transformers import AutoProcessor, AutoTokenizer, FuyuImageProcessor, CLIPI
 from transformers import FuyuForCausalLM
 from src.otter_ai.models.fuyu.processing_fuyu import FuyuProcessor
 from otter_ai import OtterForConditionalGeneration
+from otter_ai.models.fast_load import fast_from_pretrained
 import io
 import base64
 
@@ -33,9 +34,12 @@ def get_pil_image(raw_image_data) -> Image.Image:
 
 
 class TestOtter:
-    def __init__(self, checkpoint) -> None:
-        kwargs = {"device_map": "auto", "torch_dtype": torch.bfloat16}
-        self.model = OtterForConditionalGeneration.from_pretrained(checkpoint, **kwargs)
+    def __init__(self, checkpoint, fast_load=False) -> None:
+        if fast_load:
+            self.model, _ = fast_from_pretrained(OtterForConditionalGeneration, checkpoint, torch_dtype=torch.bfloat16)
+        else:
+            kwargs = {"device_map": "auto", "torch_dtype": torch.bfloat16}
+            self.model = OtterForConditionalGeneration.from_pretrained(checkpoint, **kwargs)
         self.image_processor = CLIPImageProcessor()
         self.tokenizer = self.model.text_tokenizer
         self.tokenizer.padding_side = "left"
@@ -1,13 +1,22 @@
 import ast
+import collections
+import contextlib
+import copy
+import fcntl
 import functools
+import hashlib
 import io
 import json
 import logging
 import math
 import os
+import queue
 import random
+import shutil
 import statistics
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from multiprocessing import Value
 
@@ -18,7 +27,7 @@ import torch.utils
 import torchvision
 import webdataset as wds
 import yaml
-from PIL import Image, ImageFile, ImageSequence
+from PIL import Image, ImageFile, ImageOps, ImageSequence
 from torch.utils.data import ConcatDataset, DataLoader, IterableDataset, RandomSampler, get_worker_info
 from torch.utils.data.distributed import DistributedSampler
 from webdataset.filters import _shuffle
@@ -66,6 +75,94 @@ class DataInfo:
             self.sampler.set_epoch(epoch)
 
 
+class _LoaderError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_LOADER_EXHAUSTED = object()
+
+
+class LoaderMixer:
+    """Interleave several dataloaders, each drained by its own background prefetch thread.
+
+    Every step yields a dict mapping loader name to a list of `ratios[name]` batches. Since each
+    loader fills an independent bounded queue, a slow loader no longer gates the fetches of a fast
+    one. An epoch lasts as many steps as the longest loader (relative to its ratio) can fill; the
+    shorter loaders are cycled by iterating them again, without caching their batches.
+    """
+
+    def __init__(self, loaders, ratios=None, prefetch=2):
+        self.loaders = loaders
+        self.ratios = ratios if ratios is not None else {name: 1 for name in loaders}
+        self.prefetch = prefetch
+        assert all(self.ratios[name] >= 1 for name in loaders), "Loader ratios must be positive integers"
+        self.num_steps = max(self.num_batches(loader) // self.ratios[name] for name, loader in loaders.items())
+
+    @staticmethod
+    def num_batches(loader):
+        return loader.num_batches if hasattr(loader, "num_batches") else len(loader)
+
+    @staticmethod
+    def _put(out_queue, item, stop_event):
+        while not stop_event.is_set():
+            try:
+                out_queue.put(item, timeout=1.0)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fill(self, name, out_queue, stop_event):
+        remaining = self.num_steps * self.ratios[name]
+        try:
+            while remaining > 0:
+                # a new pass over the loader each time it runs out, so that no batch has to be kept
+                num_fetched = 0
+                for batch in self.loaders[name]:
+                    if not self._put(out_queue, batch, stop_event):
+                        return
+                    num_fetched += 1
+                    remaining -= 1
+                    if remaining == 0:
+                        break
+                if num_fetched == 0:
+                    break
+        except Exception as e:
+            self._put(out_queue, _LoaderError(e), stop_event)
+            return
+        if remaining > 0:
+            self._put(out_queue, _LOADER_EXHAUSTED, stop_event)
+
+    def __len__(self):
+        return self.num_steps
+
+    def __iter__(self):
+        stop_event = threading.Event()
+        queues = {name: queue.Queue(maxsize=self.prefetch * self.ratios[name]) for name in self.loaders}
+        threads = [threading.Thread(target=self._fill, args=(name, queues[name], stop_event), daemon=True) for name in self.loaders]
+        for thread in threads:
+            thread.start()
+        try:
+            # a loader that yields no batch at all ends the epoch instead of being cycled forever
+            for _ in range(self.num_steps):
+                batches = {}
+                for name in self.loaders:
+                    batches[name] = []
+                    for _ in range(self.ratios[name]):
+                        item = queues[name].get()
+                        if isinstance(item, _LoaderError):
+                            raise item.exception
+                        if item is _LOADER_EXHAUSTED:
+                            return
+                        batches[name].append(item)
+                yield batches
+        finally:
+            stop_event.set()
+            for thread in threads:
+                thread.join(timeout=5.0)
+
+
 def get_dataset_size(shards):
     shards_list = list(braceexpand.braceexpand(shards))
     dir_path = os.path.dirname(shards_list[0])
@@ -119,11 +216,67 @@ def decode_base64_image(key, value):
     return image
 
 
+class RejectionStats:
+    """Per-process counters of accepted/rejected samples, logged as a periodic summary.
+
+    Filter stages report rejections with a reason instead of raising, which keeps exception and
+    logging overhead off the per-sample path. Every `log_every` samples a single line with the
+    rejection rate and a per-reason breakdown is logged.
+    """
+
+    def __init__(self, name, log_every=10000):
+        self.name = name
+        self.log_every = log_every
+        self.accepted = 0
+        self.rejected = collections.Counter()
+
+    @property
+    def total(self):
+        return self.accepted + sum(self.rejected.values())
+
+    def _count(self):
+        if self.total % self.log_every == 0:
+            logging.warning(self.summary())
+
+    def summary(self):
+        num_rejected = sum(self.rejected.values())
+        return f"[{self.name}] rejected {num_rejected}/{self.total} samples ({num_rejected / max(1, self.total):.1%}): {dict(self.rejected)}"
+
+    def reject(self, reason):
+        self.rejected[reason] += 1
+        self._count()
+
+    def accept(self, sample):
+        """Identity map function placed after the last filter stage of a pipeline."""
+        self.accepted += 1
+        self._count()
+        return sample
+
+    def select(self, predicate, reason):
+        """A `wds.select` stage that counts samples rejected by `predicate` under `reason`."""
+
+        def counted_predicate(sample):
+            if predicate(sample):
+                return True
+            self.reject(reason)
+            return False
+
+        return wds.select(counted_predicate)
+
+
+_HANDLER_STATS = RejectionStats("webdataset errors")
+
+
 def log_and_continue(exn):
-    """Call in an exception handler to ignore any exception, issue a warning, and continue."""
-    if "No images in sample" in str(exn) or "Only one image in sample" in str(exn):  # Avoid spamming logs with these
-        return True
-    logging.warning(f"Handling webdataset error ({repr(exn)}). Ignoring.")
+    """Call in an exception handler to ignore any exception, count it, and continue.
+
+    Only the first occurrence of each exception type is logged in full, the rest is reported
+    through the periodic summary of `_HANDLER_STATS`.
+    """
+    reason = type(exn).__name__
+    if reason not in _HANDLER_STATS.rejected:
+        logging.warning(f"Handling webdataset error ({repr(exn)}). Ignoring.")
+    _HANDLER_STATS.reject(reason)
     return True
 
 
@@ -261,6 +414,143 @@ class ResampledShards2(IterableDataset):
             yield dict(url=self.rng.choice(self.urls))
 
 
+class _FileLock:
+    """Exclusive (or shared) flock on a lock file, shared by all workers and ranks on a node.
+
+    With `blocking=False`, entering raises `BlockingIOError` instead of waiting for the lock.
+    """
+
+    def __init__(self, path, shared=False, blocking=True):
+        self.path = path
+        self.operation = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB)
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = open(self.path, "a")
+        try:
+            fcntl.flock(self.fd, self.operation)
+        except BlockingIOError:
+            self.fd.close()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.fd.close()
+
+
+class ShardCache(wds.PipelineStage):
+    """Copy shards to a node-local cache directory ahead of the current read position.
+
+    Sits between the shard list and `tarfile_to_samples_nothrow`: every incoming dict(url=...) is
+    fetched on a thread pool up to `lookahead` shards in advance, and yielded with `url` rewritten to
+    the local copy. Any URL understood by `wds.gopen` works (local paths, file://, pipe:, http).
+    Downloads are guarded by per-shard file locks, so all dataloader workers and ranks on a node share
+    a single copy. The cache is kept under `max_bytes` by evicting the least recently used shards;
+    a shard is read-locked from the moment it is yielded until the next one is requested, and locked
+    shards are never evicted.
+    """
+
+    def __init__(self, cache_dir, max_bytes, lookahead=4, num_workers=2):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lookahead = lookahead
+        self.num_workers = num_workers
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def local_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".tar")
+
+    def cached_shards(self):
+        shards = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".tar"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            shards.append((stat.st_mtime, stat.st_size, os.path.join(self.cache_dir, name)))
+        return shards
+
+    def evict(self, incoming_bytes):
+        """Remove least recently used shards until `incoming_bytes` fits into the quota, skipping the ones being fetched or read."""
+        with _FileLock(os.path.join(self.cache_dir, ".cache.lock")):
+            shards = sorted(self.cached_shards())
+            total_bytes = sum(size for _, size, _ in shards)
+            for _, size, path in shards:
+                if total_bytes + incoming_bytes <= self.max_bytes:
+                    break
+                try:
+                    with _FileLock(path + ".lock", blocking=False):
+                        os.remove(path)
+                except BlockingIOError:
+                    continue
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+
+    def fetch(self, url):
+        path = self.local_path(url)
+        with _FileLock(path + ".lock"):
+            if os.path.exists(path):
+                os.utime(path)  # mark as recently used
+                return path
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with wds.gopen(url, "rb") as stream, open(tmp_path, "wb") as f:
+                    shutil.copyfileobj(stream, f, 1 << 20)
+                self.evict(os.path.getsize(tmp_path))
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return path
+
+    @contextlib.contextmanager
+    def ready(self, sample, future):
+        """The sample with its local shard, read-locked against eviction while the reader opens and reads it."""
+        path = future.result()
+        while True:
+            with _FileLock(path + ".lock", shared=True):
+                if os.path.exists(path):
+                    yield dict(sample, url=path)
+                    return
+            # evicted by another process between prefetch and read
+            path = self.fetch(sample["url"])
+
+    def run(self, src):
+        executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        pending = collections.deque()
+        try:
+            for sample in src:
+                pending.append((sample, executor.submit(self.fetch, sample["url"])))
+                if len(pending) > self.lookahead:
+                    with self.ready(*pending.popleft()) as ready_sample:
+                        yield ready_sample
+            while pending:
+                with self.ready(*pending.popleft()) as ready_sample:
+                    yield ready_sample
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_shard_cache_stages(args):
+    """Return the shard cache stage as a (possibly empty) list to splice into a pipeline."""
+    cache_dir = getattr(args, "shard_cache_dir", None)
+    if not cache_dir or not isinstance(cache_dir, (str, os.PathLike)):
+        # not configured, or args that do not define the shard cache options (e.g. mocks)
+        return []
+    return [
+        ShardCache(
+            cache_dir,
+            max_bytes=int(args.shard_cache_size_gb * 1024**3),
+            lookahead=args.shard_cache_lookahead,
+            num_workers=args.shard_cache_workers,
+        )
+    ]
+
+
 # import uuid
 def preprocess_image(sample, image_processor):
     # uuid_str = str(uuid.uuid4())
@@ -273,23 +563,121 @@ def preprocess_image(sample, image_processor):
     return image
 
 
+def decode_image_to_size(rawbytes, size):
+    """Decode image bytes directly to a (size, size) RGB crop.
+
+    JPEG payloads are opened in draft mode so libjpeg downscales by 1/2, 1/4 or 1/8 inside the DCT,
+    keeping the shortest side >= size. The remaining resize + center crop is done in a single
+    `ImageOps.fit` call on the already-reduced image.
+    """
+    image = Image.open(io.BytesIO(rawbytes))
+    image.draft("RGB", (size, size))  # no-op for non-JPEG images
+    # Check if the image is in palette mode and has transparency
+    if image.mode == "P" and "transparency" in image.info:
+        try:
+            image = image.convert("RGBA")
+        except ValueError:
+            pass
+    image = image.convert("RGB")
+    return ImageOps.fit(image, (size, size), method=Image.BICUBIC)
+
+
+class DraftImageDecoder:
+    """wds.decode handler that decodes jpg/jpeg/png fields straight to the model resolution.
+
+    Returns HWC uint8 numpy arrays; normalization is done per batch by `preprocess_image_batch`.
+    `base64_keys` lists extensions whose payload is base64 encoded (e.g. "png" in our LAION shards).
+    """
+
+    def __init__(self, size=INTERLEAVED_IMAGE_SIZE, base64_keys=()):
+        self.size = size
+        self.base64_keys = tuple(base64_keys)
+
+    def __call__(self, key, data):
+        extension = key.split(".")[-1].lower()
+        if extension not in ("jpg", "jpeg", "png"):
+            return None
+        if extension in self.base64_keys:
+            data = base64.b64decode(data)
+        return np.asarray(decode_image_to_size(data, self.size))
+
+
+def preprocess_image_batch(sample, image_mean, image_std):
+    """Vectorized rescale/normalize of a batch of HWC uint8 arrays produced by `DraftImageDecoder`."""
+    images = torch.from_numpy(np.stack(sample)).permute(0, 3, 1, 2).float().div_(255.0)
+    mean = torch.tensor(image_mean, dtype=images.dtype).view(1, -1, 1, 1)
+    std = torch.tensor(image_std, dtype=images.dtype).view(1, -1, 1, 1)
+    images = images.sub_(mean).div_(std).contiguous()
+    # apply random horizontal flip, same as `preprocess_image`
+    images = torchvision.transforms.RandomHorizontalFlip(p=0.5)(images)
+    return images
+
+
+def get_image_stages(args, image_processor, default_decode_stage, base64_keys=()):
+    """Return the (decode stage, batch image preprocess fn) pair for caption datasets."""
+    if getattr(args, "fast_image_decode", False):
+        crop_size = image_processor.crop_size
+        size = crop_size["height"] if isinstance(crop_size, dict) else crop_size
+        decode_stage = wds.decode(DraftImageDecoder(size=size, base64_keys=base64_keys), handler=log_and_continue)
+        preprocess_image_fn = functools.partial(preprocess_image_batch, image_mean=image_processor.image_mean, image_std=image_processor.image_std)
+    else:
+        decode_stage = default_decode_stage
+        preprocess_image_fn = functools.partial(preprocess_image, image_processor=image_processor)
+    return decode_stage, preprocess_image_fn
+
+
 B_INST, E_INST = "[INST]", "[/INST]"
 
 
-def preprocess_text(sample, tokenizer, prompt_format="simple"):
-    tokenizer.padding_side = "right"
-    if prompt_format == "simple":
-        sample = [(f"<image>{s.strip()}<|endofchunk|>{tokenizer.eos_token}") for s in sample]
-    elif prompt_format == "llama2_inst":
-        sample = [(f"<image>{B_INST}please describe this image.{E_INST}{s.strip()}<|endofchunk|>{tokenizer.eos_token}") for s in sample]
-    text = tokenizer(
-        sample,
-        max_length=32,
-        padding="longest",
-        truncation="only_first",
-        return_tensors="pt",
-    )
-    return text["input_ids"], text["attention_mask"]
+MAX_CAPTION_TOKENS = 32
+
+
+class CaptionBatchTokenizer:
+    """Tokenize a batch of captions into fixed-shape (B, max_length) int64 tensors.
+
+    With a fast tokenizer the whole batch goes through a single `encode_batch` call on a private
+    copy of the Rust backend, whose truncation/padding is configured once here instead of being
+    reset by `tokenizer.__call__` on every batch. Results are written into preallocated numpy
+    buffers and handed to torch without a copy. Slow tokenizers fall back to `tokenizer(...)`.
+    """
+
+    def __init__(self, tokenizer, max_length=MAX_CAPTION_TOKENS, prompt_format="simple"):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.prompt_format = prompt_format
+        self.eos_token = tokenizer.eos_token
+        assert tokenizer.pad_token_id is not None, "Caption tokenization requires a pad token."
+
+        if getattr(tokenizer, "is_fast", False):
+            self.backend = copy.deepcopy(tokenizer.backend_tokenizer)
+            self.backend.enable_truncation(max_length=max_length)
+            self.backend.enable_padding(length=max_length, direction="right", pad_id=tokenizer.pad_token_id, pad_token=tokenizer.pad_token)
+        else:
+            self.backend = None
+            tokenizer.padding_side = "right"
+
+    def format(self, caption):
+        if isinstance(caption, bytes):
+            caption = caption.decode("utf-8")
+        if self.prompt_format == "simple":
+            return f"<image>{caption.strip()}<|endofchunk|>{self.eos_token}"
+        elif self.prompt_format == "llama2_inst":
+            return f"<image>{B_INST}please describe this image.{E_INST}{caption.strip()}<|endofchunk|>{self.eos_token}"
+        raise ValueError(f"Unsupported prompt format: {self.prompt_format}")
+
+    def __call__(self, sample):
+        sample = [self.format(s) for s in sample]
+        if self.backend is None:
+            text = self.tokenizer(sample, max_length=self.max_length, padding="max_length", truncation=True, return_tensors="pt")
+            return text["input_ids"], text["attention_mask"]
+
+        encodings = self.backend.encode_batch(sample)
+        input_ids = np.empty((len(encodings), self.max_length), dtype=np.int64)
+        attention_mask = np.empty((len(encodings), self.max_length), dtype=np.int64)
+        for i, encoding in enumerate(encodings):
+            input_ids[i] = encoding.ids
+            attention_mask[i] = encoding.attention_mask
+        return torch.from_numpy(input_ids), torch.from_numpy(attention_mask)
 
 
 MIN_KB = 10
@@ -297,21 +685,39 @@ MAX_NUM_IMAGES = 5
 import base64
 
 
-def preprocess_interleaved(sample, tokenizer, clip_processor, sim_threshold, distributed_type="no"):
-    info = json.loads(sample[0])
+def base64_num_bytes(image_base64):
+    """Size of the decoded payload of a base64 string, without decoding it."""
+    return len(image_base64) * 3 // 4 - image_base64[-2:].count("=")
+
+
+def is_valid_interleaved_image(image_info, sim_threshold):
+    # filter to images >= 10KB that match their sentence well enough
+    return base64_num_bytes(image_info["image_base64"]) // 1000 > MIN_KB and image_info["matched_sim"] >= sim_threshold
+
+
+def has_interleaved_json(sample):
+    return "json" in sample
+
+
+def decode_interleaved_json(sample):
+    sample["json"] = json.loads(sample["json"])
+    return sample
+
+
+def has_valid_interleaved_images(sample, sim_threshold):
+    return any(is_valid_interleaved_image(image_info, sim_threshold) for image_info in sample["json"]["image_info"])
+
+
+def preprocess_interleaved(sample, tokenizer, clip_processor, sim_threshold, distributed_type="no", rejection_stats=None):
+    info = sample[0] if isinstance(sample[0], dict) else json.loads(sample[0])
     sentences = info["text_list"]
 
     images, sentence_ixs = [], []
 
     for sample_image in info["image_info"]:
-        image_base64 = sample_image["image_base64"]
-        rawbytes = base64.b64decode(image_base64)
-
-        # filter to images >= 10KB
-        if len(rawbytes) // 1000 <= MIN_KB:
-            continue
-        if sample_image["matched_sim"] < sim_threshold:
+        if not is_valid_interleaved_image(sample_image, sim_threshold):
             continue
+        rawbytes = base64.b64decode(sample_image["image_base64"])
         image = Image.open(io.BytesIO(rawbytes))
 
         # Check if the image is in palette mode and has transparency
@@ -327,18 +733,16 @@ def preprocess_interleaved(sample, tokenizer, clip_processor, sim_threshold, dis
         sentence_ixs.append(sample_image["matched_text_index"])
 
     if len(images) == 0:
-        raise ValueError("No images in sample")
+        if rejection_stats is not None:
+            rejection_stats.reject("no_valid_images")
+        return None
 
     # images -> tensors
     images_tensors = preprocess_image(images, clip_processor)
     keep_ixs = range(min(len(images_tensors), MAX_NUM_IMAGES))
     images_tensors = images_tensors[keep_ixs]
     sentence_ixs = [sentence_ixs[ix] for ix in keep_ixs]
-
-    # pad to 5 images
-    if len(images_tensors) < MAX_NUM_IMAGES:
-        zero_padding = torch.zeros((MAX_NUM_IMAGES - len(images_tensors), 3, 224, 224), dtype=torch.float)
-        images_tensors = torch.cat((images_tensors, zero_padding), dim=0)
+    # no padding to MAX_NUM_IMAGES, samples are packed by `collate_interleaved` and only real images are encoded
 
     # add in <image> and <eoc> tokens
     # eoc after sentence = "sentence loss"
@@ -357,9 +761,13 @@ def preprocess_interleaved(sample, tokenizer, clip_processor, sim_threshold, dis
     num_images = torch.count_nonzero(text_tensor["input_ids"] == tokenizer.additional_special_tokens_ids[tokenizer.additional_special_tokens.index("<image>")])
 
     if num_images == 0:
-        raise ValueError("No images in sample")
+        if rejection_stats is not None:
+            rejection_stats.reject("no_images_after_truncation")
+        return None
     elif num_images == 1 and random.random() <= 0.5:  # 50% chance of keeping single image samples
-        raise ValueError("Only one image in sample")
+        if rejection_stats is not None:
+            rejection_stats.reject("single_image_dropped")
+        return None
 
     return (
         images_tensors,
@@ -367,6 +775,15 @@ def preprocess_interleaved(sample, tokenizer, clip_processor, sim_threshold, dis
     )
 
 
+def collate_interleaved(samples):
+    """
+    Batch interleaved samples with their images packed back to back, shape (N, 3, H, W), along with the number of
+    images of each sample, as expected by `num_images` of the Otter / Flamingo forward.
+    """
+    images, texts = zip(*samples)
+    return torch.cat(images, dim=0), list(texts), torch.tensor([len(x) for x in images])
+
+
 def get_mmc4_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
     input_shards = args.mmc4_shards
     assert input_shards is not None
@@ -386,11 +803,13 @@ def get_mmc4_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
     else:
         pipeline = [wds.SimpleShardList(input_shards)]
 
+    rejection_stats = RejectionStats("mmc4")
     preprocess_fn = functools.partial(
         preprocess_interleaved,
         clip_processor=image_processor,
         tokenizer=tokenizer,
         sim_threshold=args.mmc4_textsim_threshold,
+        rejection_stats=rejection_stats,
     )
 
     # at this point we have an iterator over all the shards
@@ -407,6 +826,7 @@ def get_mmc4_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
                 wds.split_by_worker,
             ]
         )
+    pipeline.extend(get_shard_cache_stages(args))
     pipeline.extend(
         [
             # at this point, we have an iterator over the shards assigned to each worker at each node
@@ -421,9 +841,17 @@ def get_mmc4_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
 
     pipeline.extend(
         [
-            wds.to_tuple("json", handler=log_and_continue),
+            # cheap pre-checks run before image decoding, rejected samples are counted instead of raised
+            rejection_stats.select(has_interleaved_json, "no_json"),
+            wds.map(decode_interleaved_json, handler=log_and_continue),
+            rejection_stats.select(
+                functools.partial(has_valid_interleaved_images, sim_threshold=args.mmc4_textsim_threshold),
+                "no_valid_images",
+            ),
+            wds.to_tuple("json"),
             wds.map(preprocess_fn, handler=log_and_continue),
-            wds.batched(args.batch_size_mmc4, partial=False),
+            wds.map(rejection_stats.accept),
+            wds.batched(args.batch_size_mmc4, partial=False, collation_fn=collate_interleaved),
         ]
     )
 
@@ -476,8 +904,14 @@ def get_laion_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
         pipeline = [wds.SimpleShardList(input_shards)]
 
     # create two preprocess functions that take in the passed in image_processor and tokenizer
-    preprocess_image_fn = functools.partial(preprocess_image, image_processor=image_processor)
-    preprocess_text_fn = functools.partial(preprocess_text, tokenizer=tokenizer)
+    decode_stage, preprocess_image_fn = get_image_stages(
+        args,
+        image_processor,
+        wds.decode(decode_base64_image, only="png", handler=log_and_continue),
+        base64_keys=("png",),
+    )
+    preprocess_text_fn = CaptionBatchTokenizer(tokenizer, max_length=MAX_CAPTION_TOKENS)
+    rejection_stats = RejectionStats("laion")
 
     # at this point we have an iterator over all the shards
     if not resampled:
@@ -493,6 +927,7 @@ def get_laion_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
                 wds.split_by_worker,
             ]
         )
+    pipeline.extend(get_shard_cache_stages(args))
     pipeline.extend(
         [
             # at this point, we have an iterator over the shards assigned to each worker at each node
@@ -507,9 +942,10 @@ def get_laion_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
 
     pipeline.extend(
         [
-            wds.select(filter_no_caption_or_no_image),
-            wds.decode(decode_base64_image, only="png", handler=log_and_continue),
+            rejection_stats.select(filter_no_caption_or_no_image, "no_caption_or_no_image"),
+            decode_stage,
             wds.to_tuple("jpg;png;jpeg", "txt", handler=log_and_continue),
+            wds.map(rejection_stats.accept),
             wds.batched(args.batch_size_laion, partial=False),
             wds.map_tuple(preprocess_image_fn, preprocess_text_fn, handler=log_and_continue),
         ]
@@ -564,8 +1000,9 @@ def get_cc3m_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
         pipeline = [wds.SimpleShardList(input_shards)]
 
     # create two preprocess functions that take in the passed in image_processor and tokenizer
-    preprocess_image_fn = functools.partial(preprocess_image, image_processor=image_processor)
-    preprocess_text_fn = functools.partial(preprocess_text, tokenizer=tokenizer)
+    decode_stage, preprocess_image_fn = get_image_stages(args, image_processor, wds.decode("pil", handler=log_and_continue))
+    preprocess_text_fn = CaptionBatchTokenizer(tokenizer, max_length=MAX_CAPTION_TOKENS)
+    rejection_stats = RejectionStats("cc3m")
 
     # at this point we have an iterator over all the shards
     if not resampled:
@@ -581,6 +1018,7 @@ def get_cc3m_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
                 wds.split_by_worker,
             ]
         )
+    pipeline.extend(get_shard_cache_stages(args))
     pipeline.extend(
         [
             # at this point, we have an iterator over the shards assigned to each worker at each node
@@ -595,9 +1033,10 @@ def get_cc3m_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
 
     pipeline.extend(
         [
-            wds.select(filter_no_caption_or_no_image),
-            wds.decode("pil", handler=log_and_continue),
+            rejection_stats.select(filter_no_caption_or_no_image, "no_caption_or_no_image"),
+            decode_stage,
             wds.to_tuple("jpg;png;jpeg", "txt", handler=log_and_continue),
+            wds.map(rejection_stats.accept),
             wds.batched(args.batch_size_cc3m, partial=False),
             wds.map_tuple(preprocess_image_fn, preprocess_text_fn, handler=log_and_continue),
         ]
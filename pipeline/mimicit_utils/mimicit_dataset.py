@@ -96,6 +96,41 @@ def extract_rgb_number(path):
     return -1  # Return -1 if 'rgb{x}' is not found
 
 
+class VisionFeatureStore:
+    """
+    Read side of the vision features written by pipeline/utils/extract_vision_features.py.
+
+    Each directory holds `features.npy`, an fp16 array of `vision_encoder(...)[0][:, 1:, :]` outputs with one row per image,
+    and `image_ids.json`, the image id of every row. The arrays are memory-mapped on first access, so that every dataloader
+    worker opens its own mapping instead of pickling it.
+    """
+
+    FEATURES_FILE = "features.npy"
+    IDS_FILE = "image_ids.json"
+    # features of the all-zero image used for text-only samples
+    BLANK_IMAGE_ID = "__blank__"
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.index = {}
+        for store_idx, path in enumerate(paths):
+            with open(os.path.join(path, self.IDS_FILE), "rb") as f:
+                self.index.update({image_id: (store_idx, row) for row, image_id in enumerate(orjson.loads(f.read()))})
+        self.arrays = None
+
+    def __contains__(self, image_id):
+        return image_id in self.index
+
+    def __getitem__(self, image_id):
+        if self.arrays is None:
+            self.arrays = [np.load(os.path.join(path, self.FEATURES_FILE), mmap_mode="r") for path in self.paths]
+        store_idx, row = self.index[image_id]
+        return torch.from_numpy(np.array(self.arrays[store_idx][row]))
+
+    def __getstate__(self):
+        return {**self.__dict__, "arrays": None}
+
+
 class MimicitDataset(Dataset):
     def __init__(self, args, dataset_info, task_group=""):
         self.args = args
@@ -129,6 +164,10 @@ class MimicitDataset(Dataset):
         self.resample_frames = args.resample_frames
         self.wrap_sys = f"<<SYS>>\nYou are a helpful vision language assistant. You are able to understand the visual content. You need to answer user's questions with plans and Python codes as response.\n<</SYS>>\n\n"
 
+        # with precomputed vision features, samples carry (T, v, d) encoder outputs instead of pixels and no image is loaded
+        vision_features_path = getattr(args, "vision_features_path", None)
+        self.vision_features = VisionFeatureStore(vision_features_path.split(",")) if vision_features_path else None
+
         (self.mean, self.std) = (IDEFICS_STANDARD_MEAN, IDEFICS_STANDARD_STD) if args.model_name == "idefics" else (FLAMINGO_MEAN, FLAMINGO_STD)
         if args.model_name == "otter" or args.model_name == "fuyu":
             self.patch_resize_transform = transforms.Compose(
@@ -218,7 +257,7 @@ class MimicitDataset(Dataset):
                 ]
             )
 
-            if cur_images_path != "" and cur_images_path not in loaded_images_path:
+            if cur_images_path != "" and cur_images_path not in loaded_images_path and self.vision_features is None:
                 if cur_images_path.endswith(".parquet"):
                     parquet_file = pq.ParquetFile(cur_images_path)
                     dfs = []  # List to hold the DataFrames of each batch
@@ -332,6 +371,12 @@ class MimicitDataset(Dataset):
         if is_video:
             image_ids = self.resample_frames_fn(image_ids, self.resample_frames)
 
+        if self.vision_features is not None:
+            patch_images = torch.stack([self.vision_features[cur_image_id] for cur_image_id in image_ids])
+            if is_video:
+                patch_images = patch_images.unsqueeze(0)
+            return pil_images, patch_images
+
         for cur_image_id in image_ids:
             cur_image_str = self.images.loc[cur_image_id]["base64"]
             cur_image = Image.open(BytesIO(base64.urlsafe_b64decode(cur_image_str))).convert("RGB")
@@ -374,7 +419,10 @@ class MimicitDataset(Dataset):
 
         # all_texts = all_texts.rstrip("\n")
         # patch_images = torch.tensor([])
-        if task_group == "TEXT_ONLY":
+        if task_group == "TEXT_ONLY" and self.vision_features is not None:
+            patch_images = self.vision_features[VisionFeatureStore.BLANK_IMAGE_ID].unsqueeze(0).unsqueeze(0)
+            pil_images = []
+        elif task_group == "TEXT_ONLY":
             patch_images = torch.zeros(3, 224, 224).unsqueeze(0).unsqueeze(0)
             pil_images = [Image.fromarray(patch_images[0, 0].numpy().astype(np.uint8).transpose(1, 2, 0))]
         elif task_group == "IMAGE_TEXT_IN_CONTEXT" or task_group == "IMAGE_TEXT":
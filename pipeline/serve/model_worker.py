@@ -29,6 +29,9 @@ from pipeline.serve.serving_utils import (
 from huggingface_hub import hf_hub_download
 import transformers
 from otter_ai import OtterForConditionalGeneration
+from otter_ai.models.continuous_batching import ContinuousBatchingEngine
+from otter_ai.models.delta_checkpoint import DeltaOverlay
+from otter_ai.models.fast_load import fast_from_pretrained
 from flamingo import FlamingoForConditionalGeneration
 
 GB = 1 << 30
@@ -44,6 +47,9 @@ DEFAULT_IM_START_TOKEN = "<im_start>"
 DEFAULT_IM_END_TOKEN = "<im_end>"
 DEFAULT_DEMO_END_TOKEN = "<|endofchunk|>"
 
+# generation_kwargs the continuous batching engine follows, the others (e.g. length_penalty) only apply to beam search
+ENGINE_GENERATION_KWARGS = {"max_new_tokens", "do_sample", "temperature", "top_k", "top_p", "no_repeat_ngram_size"}
+
 
 def heart_beat_worker(controller):
     while True:
@@ -65,6 +71,10 @@ class ModelWorker:
         num_gpus,
         load_bit,
         load_pt,
+        delta_path=None,
+        fast_load=False,
+        continuous_batching=False,
+        max_batch_size=8,
     ):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
@@ -73,12 +83,21 @@ class ModelWorker:
         logger.info(f"Loading the model {self.model_name} on worker {worker_id} ...")
         self.keep_aspect_ratio = keep_aspect_ratio
         self.load_bit = load_bit
+        self.fast_load = fast_load
         (
             self.tokenizer,
             self.model,
             self.image_processor,
             self.context_len,
         ) = self.load_model(lm_path, checkpoint_path, num_gpus, load_pt)
+        self.delta_overlay = DeltaOverlay(self.model, checkpoint_path)
+        if delta_path is not None:
+            self.load_delta(delta_path)
+        self.engine = None
+        if continuous_batching:
+            if not isinstance(self.model, OtterForConditionalGeneration):
+                raise ValueError("--continuous_batching is only supported for Otter checkpoints.")
+            self.engine = ContinuousBatchingEngine(self.model, max_batch_size=max_batch_size).start()
 
         if not no_register:
             self.register_to_controller()
@@ -98,7 +117,10 @@ class ModelWorker:
             precision = {"torch_dtype": torch.bfloat16}
         else:
             precision = {}
-        if "otter" in checkpoint_path.lower():
+        if self.fast_load and "otter" in checkpoint_path.lower() and num_gpus > 0 and self.load_bit in ["fp16", "bf16", "fp32"]:
+            torch_dtype = precision.get("torch_dtype", torch.float32)
+            model, _ = fast_from_pretrained(OtterForConditionalGeneration, checkpoint_path, device="cuda:0", torch_dtype=torch_dtype)
+        elif "otter" in checkpoint_path.lower():
             model = OtterForConditionalGeneration.from_pretrained(checkpoint_path, device_map={"": "cuda:0"}, **precision)
         else:
             model = FlamingoForConditionalGeneration.from_pretrained(checkpoint_path, device_map=device_map, **precision)
@@ -117,6 +139,12 @@ class ModelWorker:
 
         return tokenizer, model, image_processor, context_len
 
+    def load_delta(self, delta_path):
+        """Switch to another fine-tuned variant of the loaded base model by overlaying its delta checkpoint."""
+        start = time.time()
+        names = self.delta_overlay.apply(delta_path)
+        logger.info(f"Applied delta {delta_path} ({len(names)} tensors) in {time.time() - start:.2f}s")
+
     def register_to_controller(self):
         logger.info("Register to controller")
 
@@ -219,6 +247,9 @@ class ModelWorker:
         # vision_x = vision_x.to(self.model.device)
         lang_x = inputs["input_ids"]
         attention_mask = inputs["attention_mask"]
+        if self.engine is not None:
+            yield from self.stream_from_engine(vision_x, lang_x, generation_kwargs)
+            return
         bad_words_id = tokenizer(["User:", "GPT:"], add_special_tokens=False).input_ids
         generation_input = dict(
             vision_x=vision_x,
@@ -263,6 +294,26 @@ class ModelWorker:
             }
             yield json.dumps(ret).encode() + b"\0"
 
+    def stream_from_engine(self, vision_x, lang_x, generation_kwargs):
+        """Stream the answer to a prompt generated by the continuous batching engine, in a batch with the other requests."""
+        ignored = sorted(set(generation_kwargs) - ENGINE_GENERATION_KWARGS)
+        if ignored:
+            logger.info(f"Continuous batching ignores generation_kwargs {ignored}")
+        request = self.engine.submit(vision_x, lang_x, **{k: v for k, v in generation_kwargs.items() if k in ENGINE_GENERATION_KWARGS})
+        token_ids = []
+        for i, token_id in enumerate(request):
+            token_ids.append(token_id)
+            generated_text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+            if "IMPRESSION" in generated_text:
+                generated_text = generated_text.replace("IMPRESSION", "\nIMPRESSION")
+            if i % 10 == 0:
+                logger.info(f"Generated text: {generated_text}")
+            ret = {
+                "text": generated_text,
+                "error_code": 0,
+            }
+            yield json.dumps(ret).encode() + b"\0"
+
     def generate_stream_gate(self, params):
         try:
             for x in self.generate_stream(params):
@@ -334,6 +385,10 @@ if __name__ == "__main__":
         default="fp32",
     )
     parser.add_argument("--load_pt", action="store_true")
+    parser.add_argument("--delta_path", type=str, default=None, help="delta checkpoint to overlay on --checkpoint_path")
+    parser.add_argument("--fast_load", action="store_true", help="load Otter weights from a cached fused safetensors checkpoint directly onto the GPU")
+    parser.add_argument("--continuous_batching", action="store_true", help="generate the concurrent requests of Otter checkpoints in one running batch")
+    parser.add_argument("--max_batch_size", type=int, default=8, help="largest running batch with --continuous_batching, raise --limit_model_concurrency to fill it")
     args = parser.parse_args()
 
     worker_id = str(uuid.uuid4())[:6]
@@ -353,5 +408,9 @@ if __name__ == "__main__":
         args.num_gpus,
         args.load_bit,
         args.load_pt,
+        args.delta_path,
+        args.fast_load,
+        args.continuous_batching,
+        args.max_batch_size,
     )
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
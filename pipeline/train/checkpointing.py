@@ -0,0 +1,143 @@
+import json
+import os
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from safetensors.torch import load_file, save_file
+
+INDEX_SUFFIX = ".safetensors.index.json"
+
+
+def shard_state_dict(state_dict, max_shard_bytes):
+    """Greedily split a state dict into shards of at most `max_shard_bytes` (a single larger tensor gets its own shard)."""
+    shards, current, current_bytes = [], {}, 0
+    for name, tensor in state_dict.items():
+        num_bytes = tensor.numel() * tensor.element_size()
+        if current and current_bytes + num_bytes > max_shard_bytes:
+            shards.append(current)
+            current, current_bytes = {}, 0
+        current[name] = tensor
+        current_bytes += num_bytes
+    if current or not shards:
+        shards.append(current)
+    return shards
+
+
+def checkpoint_files(save_dir, name):
+    """Files making up the safetensors checkpoint `name`, index file last."""
+    index_path = os.path.join(save_dir, name + INDEX_SUFFIX)
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path, "r") as f:
+        weight_map = json.load(f)["weight_map"]
+    return [os.path.join(save_dir, shard) for shard in sorted(set(weight_map.values()))] + [index_path]
+
+
+def remove_checkpoint(save_dir, name):
+    for path in checkpoint_files(save_dir, name):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def load_checkpoint(path, map_location="cpu"):
+    """Load a trainable-weights checkpoint written either by `torch.save` (.pt) or by `AsyncCheckpointWriter` (.safetensors / .safetensors.index.json)."""
+    if path.endswith(INDEX_SUFFIX):
+        with open(path, "r") as f:
+            weight_map = json.load(f)["weight_map"]
+        state_dict = {}
+        for shard in sorted(set(weight_map.values())):
+            state_dict.update(load_file(os.path.join(os.path.dirname(path), shard), device=str(map_location)))
+        return state_dict
+    if path.endswith(".safetensors"):
+        return load_file(path, device=str(map_location))
+    checkpoint = torch.load(path, map_location=map_location)
+    if checkpoint.get("model_state_dict", None) is not None:
+        checkpoint = checkpoint["model_state_dict"]
+    return checkpoint
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints as sharded safetensors files on a background thread.
+
+    `save` copies the tensors into reusable pinned CPU buffers and returns as soon as the copy is done, so training only
+    pays for a device-to-host transfer instead of the full serialization. At most one write is in flight: the next `save`
+    (or `wait`) blocks until the previous one is on disk and re-raises any error it hit.
+
+    A checkpoint named `name` consists of `name-0000i-of-0000n.safetensors` shards and a `name.safetensors.index.json`
+    file in the HF format. The index is written last, so a checkpoint is complete iff its index exists.
+    `keep_last_n` bounds how many checkpoints of each `series` are kept on disk (-1 keeps all of them).
+    """
+
+    def __init__(self, save_dir, max_shard_bytes=2 * 1024**3, keep_last_n=-1):
+        self.save_dir = save_dir
+        self.max_shard_bytes = max_shard_bytes
+        self.keep_last_n = keep_last_n
+        self.buffers = {}
+        self.history = defaultdict(deque)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint_writer")
+        self.pending = None
+        os.makedirs(save_dir, exist_ok=True)
+
+    def snapshot(self, state_dict):
+        snapshot = {}
+        for name, tensor in state_dict.items():
+            tensor = tensor.detach()
+            buffer = self.buffers.get(name)
+            if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+                buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=torch.cuda.is_available())
+                self.buffers[name] = buffer
+            buffer.copy_(tensor, non_blocking=True)
+            snapshot[name] = buffer
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return snapshot
+
+    def save(self, state_dict, name, series=None, metadata=None):
+        """Snapshot `state_dict` and write it as checkpoint `name` in the background."""
+        self.wait()
+        snapshot = self.snapshot(state_dict)
+        metadata = {k: str(v) for k, v in (metadata or {}).items()}
+        self.pending = self.executor.submit(self._write, snapshot, name, series, metadata)
+
+    def wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def _write(self, snapshot, name, series, metadata):
+        previous_files = set(checkpoint_files(self.save_dir, name))
+        shards = shard_state_dict(snapshot, self.max_shard_bytes)
+        weight_map, total_size = {}, 0
+        for i, shard in enumerate(shards):
+            shard_file = f"{name}-{i + 1:05d}-of-{len(shards):05d}.safetensors"
+            tmp_path = os.path.join(self.save_dir, f".{shard_file}.tmp")
+            save_file(shard, tmp_path, metadata={"format": "pt", **metadata})
+            os.replace(tmp_path, os.path.join(self.save_dir, shard_file))
+            for key, tensor in shard.items():
+                weight_map[key] = shard_file
+                total_size += tensor.numel() * tensor.element_size()
+
+        index_path = os.path.join(self.save_dir, name + INDEX_SUFFIX)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump({"metadata": {"total_size": total_size, **metadata}, "weight_map": weight_map}, f, indent=2)
+        os.replace(index_path + ".tmp", index_path)
+
+        # an overwritten checkpoint may have had a different number of shards
+        current_files = {os.path.join(self.save_dir, shard_file) for shard_file in weight_map.values()} | {index_path}
+        for path in previous_files - current_files:
+            if os.path.exists(path):
+                os.remove(path)
+
+        if series is not None and self.keep_last_n > 0:
+            history = self.history[series]
+            if name in history:
+                history.remove(name)
+            history.append(name)
+            while len(history) > self.keep_last_n:
+                remove_checkpoint(self.save_dir, history.popleft())
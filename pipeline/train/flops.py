@@ -0,0 +1,234 @@
+import math
+from collections import defaultdict
+
+import torch
+import torch.nn as nn
+
+# dense bf16 tensor core peak per GPU, in TFLOPs
+PEAK_TFLOPS = {"H100": 989.0, "H800": 989.0, "A100": 312.0, "A800": 312.0, "L40": 181.0, "A6000": 155.0, "4090": 165.0, "A10": 125.0, "V100": 125.0}
+
+KV_PROJECTIONS = ("to_kv", "k_proj", "v_proj")
+Q_PROJECTIONS = ("to_q", "q_proj")
+
+
+def device_peak_tflops():
+    if not torch.cuda.is_available():
+        return None
+    name = torch.cuda.get_device_name()
+    return next((tflops for key, tflops in PEAK_TFLOPS.items() if key in name), None)
+
+
+def config_value(config, *names):
+    return next(getattr(config, name) for name in names if getattr(config, name, None) is not None)
+
+
+def weight_shape(param):
+    # ZeRO-3 partitions parameters in place and keeps the full shape in ds_shape
+    return tuple(getattr(param, "ds_shape", param.shape))
+
+
+class Component:
+    """
+    Matmul cost of one part of a model, from its nn.Linear / nn.Conv2d layers.
+
+    Multiply-accumulates per token are split into projections of the attended-to context (`KV_PROJECTIONS`) and everything
+    else, which runs on the query side; this only matters for perceivers and cross-attention, where the two sides have
+    different lengths. `q_dim` sums the query projection widths, i.e. the attention score and value width.
+    """
+
+    def __init__(self, module, exclude=()):
+        excluded = {id(m) for root in exclude for m in root.modules()}
+        self.query_macs = self.context_macs = self.conv_macs = self.q_dim = 0
+        trainable_macs = 0
+        for name, m in module.named_modules():
+            if id(m) in excluded:
+                continue
+            leaf = name.rsplit(".", 1)[-1]
+            if isinstance(m, nn.Linear):
+                macs = m.in_features * m.out_features
+                if leaf in KV_PROJECTIONS:
+                    self.context_macs += macs
+                else:
+                    self.query_macs += macs
+                if leaf in Q_PROJECTIONS:
+                    self.q_dim += m.out_features
+            elif isinstance(m, nn.Conv2d):
+                macs = m.in_channels * m.out_channels * m.kernel_size[0] * m.kernel_size[1] // m.groups
+                self.conv_macs += macs
+            else:
+                continue
+            if m.weight.requires_grad:
+                trainable_macs += macs
+        total_macs = self.query_macs + self.context_macs + self.conv_macs
+        self.trainable = trainable_macs > 0
+        self.trainable_fraction = trainable_macs / total_macs if total_macs else 0.0
+
+    @property
+    def macs(self):
+        return self.query_macs + self.context_macs
+
+    def training_flops(self, matmul_flops, attention_flops, grad_flows):
+        """Forward, plus input gradients where gradients flow and weight gradients of trainable layers."""
+        if not grad_flows:
+            return matmul_flops + attention_flops
+        return matmul_flops * (2 + self.trainable_fraction) + attention_flops * 3
+
+
+class FlopsAccountant:
+    """
+    Analytic training FLOPs of Otter/Flamingo, Idefics, Fuyu and plain causal LMs, with MFU per task group.
+
+    FLOPs are counted on real work only: non-padding text tokens (attention cost per sequence grows with its own length)
+    and the images/frames in the batch, through the vision encoder, perceiver, gated cross-attention layers and language
+    backbone. Per-step counts stay on the device and are only resolved in `summary()`.
+    """
+
+    def __init__(self, model, peak_tflops=None):
+        self.peak_tflops = peak_tflops or device_peak_tflops()
+        self.vision = self.perceiver = self.xattn = None
+        self.num_latents = None
+        self.patch_embed = None
+        self.max_attended_frames = None
+        self.frame_token_pool = 1
+        if hasattr(model, "lang_encoder") and hasattr(model, "perceiver"):  # Otter / Flamingo
+            vision_config = model.vision_encoder.config
+            self.vision = Component(model.vision_encoder)
+            self.perceiver = Component(model.perceiver)
+            self.num_latents = weight_shape(model.perceiver.latents)[0]
+            xattn_layers = [m for m in model.lang_encoder.modules() if "GatedCrossAttention" in m.__class__.__name__]
+            self.xattn = Component(nn.ModuleList(xattn_layers))
+            self.backbone_model = model.lang_encoder
+            self.backbone = Component(model.lang_encoder, exclude=xattn_layers)
+            # the CLS token is dropped before the perceiver
+            self.drop_cls = True
+            # Otter subsamples long videos before the vision encoder and may pool the patches of each frame
+            self.max_attended_frames = getattr(model.perceiver, "max_attended_frames", None)
+            self.frame_token_pool = getattr(model.perceiver, "frame_token_pool", 1)
+        elif hasattr(model, "model") and hasattr(model.model, "vision_model"):  # Idefics
+            vision_config = model.config.vision_config
+            self.vision = Component(model.model.vision_model)
+            if getattr(model.model, "perceiver_resampler", None) is not None:
+                self.perceiver = Component(model.model.perceiver_resampler)
+                self.num_latents = model.config.perceiver_config.resampler_n_latents
+            self.xattn = Component(model.model.gated_cross_attn_layers)
+            self.backbone_model = model
+            self.backbone = Component(model, exclude=[model.model.vision_model, model.model.gated_cross_attn_layers] + ([model.model.perceiver_resampler] if self.perceiver else []))
+            self.drop_cls = False
+        elif hasattr(model, "vision_embed_tokens"):  # Fuyu, image patches are part of the token sequence
+            self.patch_embed = Component(model.vision_embed_tokens)
+            self.backbone_model = model.language_model
+            self.backbone = Component(model.language_model)
+        else:
+            self.backbone_model = model
+            self.backbone = Component(model)
+
+        if self.vision is not None:
+            self.patch_size = vision_config.patch_size
+            self.vision_layers = vision_config.num_hidden_layers
+            self.vision_dim = config_value(vision_config, "hidden_size", "embed_dim")
+
+        backbone_config = self.backbone_model.config
+        if hasattr(backbone_config, "text_config"):
+            backbone_config = backbone_config.text_config
+        self.backbone_layers = config_value(backbone_config, "num_hidden_layers", "n_layers", "n_layer")
+        self.backbone_dim = config_value(backbone_config, "hidden_size", "d_model", "n_embd")
+        # output projections tied to the input embedding (e.g. MPT) are not nn.Linear layers
+        if not isinstance(self.backbone_model.get_output_embeddings(), nn.Linear):
+            vocab_size, dim = weight_shape(self.backbone_model.get_input_embeddings().weight)
+            self.backbone.query_macs += vocab_size * dim
+
+        # forward order; cross-attention layers are interleaved with the backbone, so the backbone needs input gradients for them
+        components = [c for c in (self.patch_embed, self.vision, self.perceiver, self.backbone, self.xattn) if c is not None]
+        # gradients reach a component if it, or anything after it, is trainable
+        self.grad_flows = {}
+        downstream_trainable = False
+        for component in reversed(components):
+            downstream_trainable = downstream_trainable or component.trainable
+            self.grad_flows[id(component)] = downstream_trainable
+        self.reset()
+
+    def reset(self):
+        self.groups = defaultdict(lambda: {"flops": 0, "seconds": 0.0, "tokens": 0, "images": 0})
+
+    def _flops(self, component, matmul_flops, attention_flops=0):
+        return component.training_flops(matmul_flops, attention_flops, self.grad_flows[id(component)])
+
+    def step_flops(self, attention_mask, images=None, image_patches=None):
+        """
+        Training FLOPs of one batch.
+
+        `images` is the (b, T, F, C, H, W) pixel batch, or (b, T, F, v, d) cached vision features. `image_patches` are Fuyu's
+        per-sample patch tensors. Returns the FLOPs (a device tensor) and the number of images or frames.
+        """
+        lengths = attention_mask.sum(dim=1)
+        num_tokens = lengths.sum()
+        sum_squared_lengths = (lengths * lengths).sum()
+        flops = self._flops(self.backbone, 2 * self.backbone.macs * num_tokens, 4 * self.backbone_layers * self.backbone_dim * sum_squared_lengths)
+
+        num_images = 0
+        if self.patch_embed is not None and image_patches is not None:
+            num_patches = sum(patches.numel() // patches.shape[-1] for patches in image_patches)
+            num_images = len(image_patches)
+            flops = flops + self._flops(self.patch_embed, 2 * self.patch_embed.macs * num_patches)
+        elif self.vision is not None and images is not None:
+            batch_size, num_media, num_frames = images.shape[:3]
+            if self.max_attended_frames is not None:
+                num_frames = min(num_frames, self.max_attended_frames)
+            num_images = batch_size * num_media * num_frames
+            if images.dim() == 6:
+                num_patches = (images.shape[-2] // self.patch_size) * (images.shape[-1] // self.patch_size)
+                vision_tokens = num_patches + 1
+                matmul = 2 * num_images * (self.vision.macs * vision_tokens + self.vision.conv_macs * num_patches)
+                attention = 4 * num_images * self.vision_layers * self.vision_dim * vision_tokens**2
+                flops = flops + self._flops(self.vision, matmul, attention)
+            else:
+                # cached features, the vision encoder does not run
+                num_patches = vision_tokens = images.shape[3]
+            frame_tokens = num_patches if self.drop_cls else vision_tokens
+            if num_frames > 1 and self.frame_token_pool > 1:
+                frame_tokens = math.ceil(math.isqrt(frame_tokens) / self.frame_token_pool) ** 2
+            media_tokens = num_frames * frame_tokens
+
+            if self.perceiver is not None:
+                context = media_tokens + self.num_latents
+                matmul = 2 * batch_size * num_media * (self.perceiver.query_macs * self.num_latents + self.perceiver.context_macs * context)
+                attention = 4 * batch_size * num_media * self.perceiver.q_dim * self.num_latents * context
+                flops = flops + self._flops(self.perceiver, matmul, attention)
+                media_tokens = self.num_latents
+
+            # every text token attends to all media tokens of its sample
+            keys = num_media * media_tokens
+            matmul = 2 * (self.xattn.query_macs * num_tokens + self.xattn.context_macs * batch_size * keys)
+            attention = 4 * self.xattn.q_dim * keys * num_tokens
+            flops = flops + self._flops(self.xattn, matmul, attention)
+        return flops, num_images
+
+    def update(self, group, seconds, attention_mask, images=None, image_patches=None):
+        flops, num_images = self.step_flops(attention_mask, images=images, image_patches=image_patches)
+        stats = self.groups[group]
+        stats["flops"] = stats["flops"] + flops
+        stats["tokens"] = stats["tokens"] + attention_mask.sum()
+        stats["images"] += num_images
+        stats["seconds"] += seconds
+
+    def summary(self):
+        """Achieved TFLOPs, MFU and token/image throughput per GPU, per task group and overall, since the last summary."""
+        stats = {}
+        total_flops, total_seconds = 0.0, 0.0
+        for group, group_stats in self.groups.items():
+            flops, seconds = float(group_stats["flops"]), group_stats["seconds"]
+            if seconds == 0:
+                continue
+            total_flops += flops
+            total_seconds += seconds
+            stats[f"tflops/{group}"] = flops / seconds / 1e12
+            stats[f"tokens_per_second/{group}"] = float(group_stats["tokens"]) / seconds
+            stats[f"images_per_second/{group}"] = group_stats["images"] / seconds
+            if self.peak_tflops:
+                stats[f"mfu/{group}"] = stats[f"tflops/{group}"] / self.peak_tflops
+        if total_seconds > 0:
+            stats["tflops"] = total_flops / total_seconds / 1e12
+            if self.peak_tflops:
+                stats["mfu"] = stats["tflops"] / self.peak_tflops
+        self.reset()
+        return stats
@@ -0,0 +1,206 @@
+from types import MethodType
+
+import torch
+import torch.distributed as dist
+from accelerate.utils import convert_outputs_to_fp32, get_mixed_precision_context_manager
+
+from pipeline.train.train_utils import master_print
+
+
+def auto_bucket_cap_mb(trainable_bytes):
+    # a handful of buckets is enough to overlap with the backward pass, more only adds launch overhead
+    return min(max(trainable_bytes / 8 / 1024**2, 1.0), 25.0)
+
+
+def trainable_bucket_numel(model, bucket_cap_mb=None):
+    """Bucket size in elements for DeepSpeed's `reduce_bucket_size`, tuned to the trainable parameters like `TrainableGradSync`."""
+    params = [p for p in model.parameters() if p.requires_grad]
+    trainable_bytes = sum(p.numel() * p.element_size() for p in params)
+    return int((bucket_cap_mb or auto_bucket_cap_mb(trainable_bytes)) * 1024**2 / params[0].element_size())
+
+
+def autocast_forward(model, accelerator):
+    """
+    Run `model.forward` under the accelerator's mixed precision autocast, the way `accelerator.prepare` does for the models it
+    wraps. Needed when the model is kept out of `prepare` (no DDP wrapper with `TrainableGradSync`).
+    """
+    if not accelerator.native_amp:
+        return model
+    # same patching as `Accelerator.prepare_model`, so that `unwrap_model(keep_fp32_wrapper=False)` can undo it
+    model._original_forward = model.forward
+    model_forward_func = model.forward.__func__ if hasattr(model.forward, "__func__") else model.forward
+    new_forward = get_mixed_precision_context_manager(accelerator.native_amp, accelerator.autocast_handler)(model_forward_func)
+    if hasattr(model.forward, "__func__"):
+        model.forward = MethodType(convert_outputs_to_fp32(new_forward), model)
+    else:
+        model.forward = convert_outputs_to_fp32(new_forward)
+    return model
+
+
+class GradBucket:
+    def __init__(self, params, device, dtype):
+        self.params = params
+        self.buffer = torch.zeros(sum(p.numel() for p in params), device=device, dtype=dtype)
+        self.views = {}
+        offset = 0
+        for p in params:
+            self.views[p] = self.buffer[offset : offset + p.numel()].view_as(p)
+            offset += p.numel()
+        self.num_ready = 0
+        self.work = None
+
+
+class TrainableGradSync:
+    """
+    Data-parallel gradient averaging for the trainable parameters only, used instead of wrapping the whole model in DDP.
+
+    When most of the model is frozen (Otter trains the perceiver, the gated cross-attention layers and optionally some
+    embeddings), DDP still walks every parameter when building its reducer and its buckets are sized for full models. Here
+    hooks are registered on trainable parameters only, and they are packed into a few buckets (in reverse registration
+    order, roughly the order their gradients become ready). A bucket is all-reduced asynchronously as soon as its last
+    gradient is accumulated, overlapping communication with the rest of the backward pass. Buckets are launched strictly in
+    order, so every rank issues the same sequence of collectives.
+
+    Call `prepare(sync)` before each backward pass (`sync=False` on gradient accumulation steps) and `finish()` before
+    clipping / the optimizer step. With `timing=True`, `summary()` reports the all-reduce time and the part of it that was
+    not hidden behind the backward pass.
+    """
+
+    def __init__(self, model, bucket_cap_mb=None, process_group=None, timing=False):
+        self.process_group = process_group
+        self.world_size = dist.get_world_size(process_group)
+        params = list({id(p): p for p in model.parameters() if p.requires_grad}.values())
+        if not params:
+            raise ValueError("The model has no trainable parameters to synchronize.")
+
+        # the same starting point on all ranks, like DDP's broadcast at construction
+        with torch.no_grad():
+            for p in params:
+                dist.broadcast(p.data, src=dist.get_global_rank(process_group, 0) if process_group is not None else 0, group=process_group)
+
+        total_bytes = sum(p.numel() * p.element_size() for p in params)
+        bucket_cap_mb = bucket_cap_mb or auto_bucket_cap_mb(total_bytes)
+        bucket_cap_bytes = bucket_cap_mb * 1024**2
+
+        self.buckets = []
+        current, current_bytes = [], 0
+        for p in reversed(params):
+            if current and (current_bytes + p.numel() * p.element_size() > bucket_cap_bytes or p.dtype != current[0].dtype or p.device != current[0].device):
+                self.buckets.append(GradBucket(current, current[0].device, current[0].dtype))
+                current, current_bytes = [], 0
+            current.append(p)
+            current_bytes += p.numel() * p.element_size()
+        self.buckets.append(GradBucket(current, current[0].device, current[0].dtype))
+        self.bucket_of = {p: bucket for bucket in self.buckets for p in bucket.params}
+        self.ready = set()
+        self.next_bucket = 0
+        self.sync = False
+
+        self.use_cuda = params[0].is_cuda
+        self.comm_stream = torch.cuda.Stream(device=params[0].device) if self.use_cuda else None
+        self.timing = timing and self.use_cuda
+        self.events = []
+        self.handles = [p.register_post_accumulate_grad_hook(self._grad_ready) for p in params]
+        master_print(f"Synchronizing {len(params)} trainable parameters ({total_bytes / 1024**2:.1f} MB) in {len(self.buckets)} buckets of up to {bucket_cap_mb:.1f} MB")
+
+    def prepare(self, sync=True):
+        self.sync = sync
+        self.ready = set()
+        self.next_bucket = 0
+        for bucket in self.buckets:
+            bucket.num_ready = 0
+            bucket.work = None
+        if self.timing and sync:
+            self.events.append({"launch": [], "done": [], "finish": None})
+
+    def _grad_ready(self, p):
+        if not self.sync or p in self.ready:
+            return
+        self._copy_to_bucket(p)
+        self._launch_ready()
+
+    def _copy_to_bucket(self, p):
+        bucket = self.bucket_of[p]
+        view = bucket.views[p]
+        if p.grad is None:
+            # unused in this step; DDP reduces zeros for these as well
+            view.zero_()
+        elif p.grad.data_ptr() != view.data_ptr():
+            view.copy_(p.grad)
+        p.grad = view
+        self.ready.add(p)
+        bucket.num_ready += 1
+
+    def _launch_ready(self):
+        while self.next_bucket < len(self.buckets) and self.buckets[self.next_bucket].num_ready == len(self.buckets[self.next_bucket].params):
+            self._launch(self.buckets[self.next_bucket])
+            self.next_bucket += 1
+
+    def _launch(self, bucket):
+        bucket.buffer.div_(self.world_size)
+        if not self.use_cuda:
+            bucket.work = dist.all_reduce(bucket.buffer, group=self.process_group, async_op=True)
+            return
+        self.comm_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.comm_stream):
+            if self.timing:
+                self.events[-1]["launch"].append(self._record())
+            bucket.work = dist.all_reduce(bucket.buffer, group=self.process_group, async_op=True)
+            bucket.work.wait()
+            if self.timing:
+                self.events[-1]["done"].append(self._record())
+            # the buffer is used by the comm stream, keep the allocator from reusing it early
+            bucket.buffer.record_stream(self.comm_stream)
+
+    @staticmethod
+    def _record():
+        event = torch.cuda.Event(enable_timing=True)
+        event.record()
+        return event
+
+    def finish(self):
+        """Reduce what is left (parameters without gradients in this step included) and wait for all buckets."""
+        if not self.sync:
+            return
+        for bucket in self.buckets[self.next_bucket :]:
+            for p in bucket.params:
+                if p not in self.ready:
+                    self._copy_to_bucket(p)
+        self._launch_ready()
+        if self.use_cuda:
+            if self.timing:
+                self.events[-1]["finish"] = self._record()
+            torch.cuda.current_stream().wait_stream(self.comm_stream)
+            if self.timing:
+                self.events[-1]["synced"] = self._record()
+        else:
+            for bucket in self.buckets:
+                bucket.work.wait()
+        self.sync = False
+
+    def summary(self, step_ms=None):
+        """
+        Average all-reduce time per synchronized step and the part of it the optimizer step had to wait for, in ms, and
+        their fractions of `step_ms` if given.
+        """
+        if not self.events:
+            return {}
+        torch.cuda.synchronize()
+        total_ms = exposed_ms = 0.0
+        steps = [step for step in self.events if step["finish"] is not None]
+        for step in steps:
+            total_ms += step["launch"][0].elapsed_time(step["done"][-1])
+            exposed_ms += step["finish"].elapsed_time(step["synced"])
+        self.events = []
+        if not steps:
+            return {}
+        stats = {"comm/allreduce_ms": total_ms / len(steps), "comm/exposed_allreduce_ms": exposed_ms / len(steps)}
+        if step_ms:
+            stats["comm/allreduce_fraction"] = stats["comm/allreduce_ms"] / step_ms
+            stats["comm/exposed_allreduce_fraction"] = stats["comm/exposed_allreduce_ms"] / step_ms
+        return stats
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
@@ -1,7 +1,6 @@
 """ Main training script """
 
 import argparse
-import gc
 import glob
 import os
 import sys
@@ -30,6 +29,11 @@ from src.otter_ai.models.fuyu.modeling_fuyu import FuyuForCausalLM
 from src.otter_ai.models.fuyu.processing_fuyu import FuyuProcessor
 
 from pipeline.mimicit_utils.data import get_data
+from pipeline.train.checkpointing import load_checkpoint
+from pipeline.train.flops import FlopsAccountant
+from pipeline.train.grad_sync import TrainableGradSync, autocast_forward, trainable_bucket_numel
+from pipeline.train.memory import MemoryPolicy, configure_allocator
+from pipeline.train.step_timer import StepTimer
 from pipeline.train.train_args import parse_args
 from pipeline.train.train_utils import (
     AverageMeter,
@@ -37,13 +41,13 @@ from pipeline.train.train_utils import (
     get_image_attention_mask,
     master_print,
     random_seed,
+    get_checkpoint_writer,
     save_checkpoint,
     save_final_weights,
     verify_yaml,
     get_weights_for_dataloaders,
     get_next_dataloader,
     find_and_remove_tokens,
-    delete_tensors_from_dict,
 )
 from src.otter_ai.models.flamingo.modeling_flamingo import FlamingoForConditionalGeneration
 from src.otter_ai.models.otter.modeling_otter import OtterForConditionalGeneration
@@ -113,7 +117,7 @@ def forward_pass(args, model, tokenizer, images, input_ids, attention_mask, labe
     return loss_mimicit
 
 
-def train_one_epoch(args, model, epoch, mimicit_loaders, tokenizer, optimizer, lr_scheduler, device_id, accelerator, wandb):
+def train_one_epoch(args, model, epoch, mimicit_loaders, tokenizer, optimizer, lr_scheduler, device_id, accelerator, wandb, checkpoint_writer=None, memory_policy=None, grad_sync=None):
     dataloader_iterators = [cycle(dataloader) for dataloader in mimicit_loaders]
     weights = get_weights_for_dataloaders(mimicit_loaders)
     num_batches_per_epoch = sum(len(dataloader) for dataloader in mimicit_loaders) // args.gradient_accumulation_steps
@@ -137,6 +141,9 @@ def train_one_epoch(args, model, epoch, mimicit_loaders, tokenizer, optimizer, l
     model.train()
 
     # setup logging
+    timer = StepTimer(enabled=args.rank == 0, first_step=epoch * num_batches_per_epoch, profile_steps=args.profile_steps, profile_dir=args.profile_dir)
+    timer.attach_otter(accelerator.unwrap_model(model))
+    flops_accountant = FlopsAccountant(accelerator.unwrap_model(model), peak_tflops=args.peak_tflops) if args.rank == 0 else None
     step_time_m = AverageMeter()  # time for one optimizer step (> 1 batch if using gradient accum)
     data_time_m = AverageMeter()  # avg time to load one batch of both C4 AND laion (= 1 batch regardless of gradient accum)
     end = time.time()
@@ -146,16 +153,18 @@ def train_one_epoch(args, model, epoch, mimicit_loaders, tokenizer, optimizer, l
     for num_steps in tqdm(range(args.total_training_steps), disable=args.rank != 0, initial=(epoch * num_batches_per_epoch)):
         if num_steps == num_batches_per_epoch:
             break
+        with timer.section("data_wait"):
+            dataloader_iterator = get_next_dataloader(dataloader_iterators, weights)
+            batch_mimicit = next(dataloader_iterator)  # Fetch a batch from the chosen dataloader
         data_time_m.update(time.time() - end)
-        dataloader_iterator = get_next_dataloader(dataloader_iterators, weights)
-        batch_mimicit = next(dataloader_iterator)  # Fetch a batch from the chosen dataloader
         global_step = num_steps + epoch * num_batches_per_epoch
 
         #### MIMIC-IT FORWARD PASS ####
-        net_input = batch_mimicit.pop("net_input")
-        images = net_input.pop("patch_images").to(device_id, non_blocking=True)
-        input_ids = net_input.pop("input_ids").to(device_id, non_blocking=True)
-        attention_mask = net_input.pop("attention_masks").to(device_id, non_blocking=True)
+        with timer.section("h2d"):
+            net_input = batch_mimicit.pop("net_input")
+            images = net_input.pop("patch_images").to(device_id, non_blocking=True)
+            input_ids = net_input.pop("input_ids").to(device_id, non_blocking=True)
+            attention_mask = net_input.pop("attention_masks").to(device_id, non_blocking=True)
         labels = None  # placeholder to avoid error
 
         if args.model_name != "fuyu":  # design fuyu's process into it's processor, a way better design than following code.
@@ -189,13 +198,14 @@ def train_one_epoch(args, model, epoch, mimicit_loaders, tokenizer, optimizer, l
 
                 return labels
 
-            labels = masking()
+            with timer.section("label_masking"):
+                labels = masking()
 
-            if args.remove_answer_token:
-                input_ids, labels, attention_mask = find_and_remove_tokens(input_ids, labels, attention_mask, answer_token_id, tokenizer)  # find and remove certain tokens from input_ids, labels, and attention_mask
+                if args.remove_answer_token:
+                    input_ids, labels, attention_mask = find_and_remove_tokens(input_ids, labels, attention_mask, answer_token_id, tokenizer)  # find and remove certain tokens from input_ids, labels, and attention_mask
 
-            if args.remove_eos_token:
-                input_ids, labels, attention_mask = find_and_remove_tokens(input_ids, labels, attention_mask, endofchunk_token_id, tokenizer)
+                if args.remove_eos_token:
+                    input_ids, labels, attention_mask = find_and_remove_tokens(input_ids, labels, attention_mask, endofchunk_token_id, tokenizer)
 
         with accelerator.accumulate(model):
             if num_steps == 0:
@@ -203,111 +213,105 @@ def train_one_epoch(args, model, epoch, mimicit_loaders, tokenizer, optimizer, l
                 master_print(f"model: {unwrapped_model.__class__.__name__}")
                 master_print(f"model dtype: {unwrapped_model.dtype if hasattr(unwrapped_model, 'dtype') else 'None'}")
 
-            loss_mimicit = forward_pass(
-                args,
-                model,
-                tokenizer,
-                images,
-                input_ids,
-                attention_mask,
-                labels,
-                device_id,
-                autocast_type,
-                batch_mimicit,
-            )
+            fuyu_inputs = batch_mimicit.get("fuyu_data")  # popped by forward_pass
+            with timer.section("forward"):
+                loss_mimicit = forward_pass(
+                    args,
+                    model,
+                    tokenizer,
+                    images,
+                    input_ids,
+                    attention_mask,
+                    labels,
+                    device_id,
+                    autocast_type,
+                    batch_mimicit,
+                )
 
-            if accelerator.mixed_precision == "fp16":
-                accelerator.backward(loss_mimicit.to(device_id))
-            else:
-                accelerator.backward(loss_mimicit)
+            if grad_sync is not None:
+                grad_sync.prepare(sync=accelerator.sync_gradients)
+            with timer.section("backward"):
+                if accelerator.mixed_precision == "fp16":
+                    accelerator.backward(loss_mimicit.to(device_id))
+                else:
+                    accelerator.backward(loss_mimicit)
 
             #### BACKWARD PASS ####
             mean_loss = loss_mimicit.detach().mean()
             cur_batch_max_tokens = input_ids.shape[1]
 
-            def mask_embedding(m):
-                if m.weight.requires_grad:
-                    zero_mask = torch.zeros_like(m.weight.grad)
-                    zero_mask[answer_token_id] = torch.ones_like(zero_mask[answer_token_id])
-                    # zero_mask[media_token_id] = torch.ones_like(zero_mask[media_token_id])
-                    # zero_mask[endofchunk_token_id] = torch.ones_like(zero_mask[endofchunk_token_id])
-                    m.weight.grad = m.weight.grad * zero_mask
-
-            if args.mask_lm_head and args.distributed_type != "DEEPSPEED":
-                unwrapped_model = accelerator.unwrap_model(model)
-                if isinstance(unwrapped_model, IdeficsForVisionText2Text):
-                    unwrapped_model.lm_head.apply(mask_embedding)
-                elif unwrapped_model.lang_encoder.__class__.__name__ in ["MPTForCausalLM", "MosaicGPT"]:
-                    unwrapped_model.lang_encoder.transformer.wte.apply(mask_embedding)
-                elif "LlamaForCausalLM" in unwrapped_model.lang_encoder.__class__.__name__:
-                    unwrapped_model.lang_encoder.model.embed_tokens.apply(mask_embedding)
-                    unwrapped_model.lang_encoder.lm_head.apply(mask_embedding)
-
-            if accelerator.sync_gradients:
-                accelerator.clip_grad_norm_(model.parameters(), 1.0)
+            if grad_sync is not None:
+                with timer.section("grad_sync"):
+                    grad_sync.finish()
+            with timer.section("optimizer"):
+                if accelerator.sync_gradients:
+                    accelerator.clip_grad_norm_(model.parameters(), 1.0)
 
-            optimizer.step()
-            lr_scheduler.step()
-            optimizer.zero_grad()
+                optimizer.step()
+                lr_scheduler.step()
+                optimizer.zero_grad()
+            timer.step(num_tokens=attention_mask.sum())
+            # gc.collect() / empty_cache() only when host memory grows or the CUDA cache fragments
+            memory_stats = memory_policy.step(global_step) if memory_policy is not None else {}
 
             # step time and reset end outside of rank 0
             step_time_m.update(time.time() - end)
             end = time.time()
+            group_name = batch_mimicit["task_group"][0]
+            if flops_accountant is not None:
+                if fuyu_inputs is not None:
+                    flops_accountant.update(group_name, step_time_m.val, fuyu_inputs["input_ids"].ne(tokenizer.pad_token_id), image_patches=fuyu_inputs["image_patches"])
+                else:
+                    flops_accountant.update(group_name, step_time_m.val, attention_mask, images=images)
             if accelerator.sync_gradients and args.rank == 0 and args.report_to_wandb:
                 # compute within rank 0
                 mimicit_samples_per_second = args.gradient_accumulation_steps * args.batch_size * args.world_size / step_time_m.sum
                 mimicit_samples_per_second_per_gpu = args.gradient_accumulation_steps * args.batch_size / step_time_m.sum
-                step_time_m.reset()
-                data_time_m.reset()
 
-                group_name = batch_mimicit["task_group"][0]
                 assert all(item == group_name for item in batch_mimicit["task_group"]), "Not all items in the list are the same"
-                if args.report_to_wandb:
-                    wandb.log(
-                        {
-                            "data_time": data_time_m.avg,
-                            "step_time": step_time_m.avg,
-                            "max_tokens": cur_batch_max_tokens,
-                            "mimicit_samples_per_second": mimicit_samples_per_second,
-                            "mimicit_samples_per_second_per_gpu": mimicit_samples_per_second_per_gpu,
-                            "lr": optimizer.param_groups[0]["lr"],
-                            "loss_mimicit": mean_loss,
-                            "global_step": global_step // args.gradient_accumulation_steps,
-                            group_name: mean_loss,
-                        },
-                        commit=True,
-                    )
-
-            delete_tensors_from_dict(batch_mimicit)
-            delete_tensors_from_dict(
-                {
-                    "other": [
-                        images,
-                        input_ids,
-                        attention_mask,
-                        labels,
-                    ]
+                log_dict = {
+                    "data_time": data_time_m.avg,
+                    "step_time": step_time_m.avg,
+                    "max_tokens": cur_batch_max_tokens,
+                    "mimicit_samples_per_second": mimicit_samples_per_second,
+                    "mimicit_samples_per_second_per_gpu": mimicit_samples_per_second_per_gpu,
+                    "lr": optimizer.param_groups[0]["lr"],
+                    "loss_mimicit": mean_loss,
+                    "global_step": global_step // args.gradient_accumulation_steps,
+                    group_name: mean_loss,
+                    **memory_stats,
                 }
-            )
+                # the breakdown synchronizes the device, so it is only resolved every logging_steps
+                if (num_steps + 1) % args.logging_steps == 0:
+                    log_dict.update(timer.summary())
+                    log_dict.update(flops_accountant.summary())
+                    if grad_sync is not None:
+                        log_dict.update(grad_sync.summary(step_ms=log_dict.get("time/step_ms")))
+                wandb.log(log_dict, commit=True)
+                step_time_m.reset()
+                data_time_m.reset()
 
         if args.rank == 0 and global_step != 0 and (args.save_steps_interval != -1) and (global_step % args.save_steps_interval == 0):
-            save_checkpoint(epoch=None, global_step=global_step, model=model, args=args, accelerator=accelerator)
+            with timer.section("checkpoint"):
+                save_checkpoint(epoch=None, global_step=global_step, model=model, args=args, accelerator=accelerator, checkpoint_writer=checkpoint_writer)
 
         # Log loss to console
         if ((num_steps + 1) % args.logging_steps == 0) and args.rank == 0:
             print(f"Step {num_steps+1}/{num_batches_per_epoch} of epoch {epoch+1}/{args.num_epochs} complete. Loss MIMIC-IT: {mean_loss.item():.3f}")
-            # reset to avoid CPU oom
-            loss_mimicit = None
-            batch_mimicit = None
-            gc.collect()
-            torch.cuda.empty_cache()
+            if not args.report_to_wandb:
+                print(", ".join(f"{name}: {value:.2f}" for name, value in {**timer.summary(), **flops_accountant.summary()}.items()))
 
+    timer.close()
     del unwrapped_model
 
 
 def main():
     args = parse_args()
     verify_yaml(args)
+    if args.vision_features_path is not None and args.model_name.lower() not in ("otter", "flamingo"):
+        # only the Otter / Flamingo forward takes precomputed vision encoder features
+        raise ValueError(f"--vision_features_path is only supported for otter and flamingo, not {args.model_name}.")
+    configure_allocator(args.cuda_alloc_conf)
     accelerator = Accelerator(
         gradient_accumulation_steps=args.gradient_accumulation_steps,
         mixed_precision="bf16",
@@ -435,10 +439,11 @@ def main():
         with deepspeed.zero.GatheredParameters(params_to_gather, modifier_rank=0):
             master_print(device_id, f"Zero3 Optimization: Trainable Params: {(sum(p.numel() for p in model.parameters() if p.requires_grad)) / 1e9:.3f} B")
 
+    if args.vision_features_path is not None and any(p.requires_grad for p in model.vision_encoder.parameters()):
+        raise ValueError("--vision_features_path replaces the vision encoder forward, so the vision encoder must be frozen.")
+
     if args.trained_ckpt is not None:
-        train_ckpt = torch.load(args.trained_ckpt, map_location="cpu")
-        if train_ckpt.get("model_state_dict", None) is not None:
-            train_ckpt = train_ckpt["model_state_dict"]
+        train_ckpt = load_checkpoint(args.trained_ckpt, map_location="cpu")
         _ = model.load_state_dict(train_ckpt, strict=False)
         print(_[1])
 
@@ -461,6 +466,7 @@ def main():
     total_training_steps = sum(len(dataloader) for dataloader in mimicit_loaders) * args.num_epochs
     resume_from_epoch = 0
     args.external_save_dir = os.path.join(args.external_save_dir, args.run_name) if args.external_save_dir else args.run_name
+    checkpoint_writer = get_checkpoint_writer(args)
 
     optimizer = torch.optim.AdamW(get_grouped_params(model, wd=args.weight_decay), lr=args.learning_rate)
 
@@ -488,12 +494,44 @@ def main():
     if args.rank == 0 and args.report_to_wandb:
         wandb.config.update(vars(args))
 
-    if accelerator.distributed_type == "DEEPSPEED" or accelerator.distributed_type == "MULTI_GPU":
+    if args.mask_lm_head:
+        # only the <answer> embedding row is trained; the hooks mask the gradients of every other row at each backward,
+        # registered before TrainableGradSync so that it reduces the masked gradients
+        answer_token_id = tokenizer("<answer>", add_special_tokens=False)["input_ids"][-1]
+        unwrapped_model = accelerator.unwrap_model(model)
+        lang_encoder_name = unwrapped_model.lang_encoder.__class__.__name__ if hasattr(unwrapped_model, "lang_encoder") else ""
+        if isinstance(unwrapped_model, IdeficsForVisionText2Text):
+            embedding_modules = [unwrapped_model.lm_head]
+        elif lang_encoder_name in ["MPTForCausalLM", "MosaicGPT"]:
+            embedding_modules = [unwrapped_model.lang_encoder.transformer.wte]
+        elif "LlamaForCausalLM" in lang_encoder_name:
+            embedding_modules = [unwrapped_model.lang_encoder.model.embed_tokens, unwrapped_model.lang_encoder.lm_head]
+        else:
+            embedding_modules = []
+        for module in embedding_modules:
+            if module.weight.requires_grad:
+                register_embedding_grad_mask(module, [answer_token_id])
+
+    grad_sync = None
+    if args.ddp_trainable_only and accelerator.distributed_type == "MULTI_GPU":
+        # no DDP wrapper: gradients of the trainable parameters are averaged by grad_sync, and the bf16 autocast that
+        # prepare() would install on the forward is added here (the fp32 vision encoder gets bf16 pixels)
+        model = autocast_forward(model, accelerator)
+        optimizer = accelerator.prepare(optimizer)
+        grad_sync = TrainableGradSync(model, bucket_cap_mb=args.ddp_bucket_cap_mb, timing=args.rank == 0)
+    elif accelerator.distributed_type == "DEEPSPEED" or accelerator.distributed_type == "MULTI_GPU":
+        if args.ddp_trainable_only and accelerator.distributed_type == "DEEPSPEED":
+            # ZeRO only reduces trainable gradients already, size its buckets for them and overlap the reduction
+            zero_config = accelerator.state.deepspeed_plugin.deepspeed_config.setdefault("zero_optimization", {})
+            zero_config["reduce_bucket_size"] = trainable_bucket_numel(model, args.ddp_bucket_cap_mb)
+            zero_config["overlap_comm"] = True
         model, optimizer = accelerator.prepare(model, optimizer)
     else:
         model, optimizer, lr_scheduler, mimicit_loaders = accelerator.prepare(model, optimizer, lr_scheduler, mimicit_loaders)
 
     model.train()
+    # created after setup, so that the model and optimizer are frozen out of the cyclic garbage collector
+    memory_policy = MemoryPolicy.from_args(args)
     # Main Training Loop
     for epoch in range(resume_from_epoch, args.num_epochs):
         train_one_epoch(
@@ -507,6 +545,9 @@ def main():
             accelerator=accelerator,
             device_id=device_id,
             wandb=wandb,
+            checkpoint_writer=checkpoint_writer,
+            memory_policy=memory_policy,
+            grad_sync=grad_sync,
         )
         accelerator.wait_for_everyone()
         if args.save_ckpt_each_epoch:
@@ -517,6 +558,7 @@ def main():
                 accelerator,
                 processor=processor if "idefics" in args.model_name.lower() or "fuyu" in args.model_name.lower() else None,
                 tokenizer=tokenizer if "llama2" in args.model_name.lower() else None,
+                checkpoint_writer=checkpoint_writer,
             )
             master_print(f"Saved checkpoint at epoch {epoch+1}.")
         accelerator.wait_for_everyone()
@@ -528,7 +570,10 @@ def main():
         accelerator,
         processor=processor if "idefics" in args.model_name.lower() or "fuyu" in args.model_name.lower() else None,
         tokenizer=tokenizer if "llama2" in args.model_name.lower() else None,
+        checkpoint_writer=checkpoint_writer,
     )
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
     # accelerator.wait_for_everyone()
 
 
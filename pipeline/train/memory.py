@@ -0,0 +1,113 @@
+import gc
+import os
+from collections import Counter
+
+import psutil
+import torch
+
+
+def add_memory_args(parser):
+    parser.add_argument(
+        "--cuda_alloc_conf",
+        type=str,
+        default=None,
+        help="PYTORCH_CUDA_ALLOC_CONF for this run, e.g. 'expandable_segments:True' or 'max_split_size_mb:512,garbage_collection_threshold:0.8'; an already exported value wins",
+    )
+    parser.add_argument(
+        "--fragmentation_threshold",
+        type=float,
+        default=0.3,
+        help="release cached CUDA blocks when this fraction of reserved memory is unused and reserved memory is above --device_memory_high_watermark",
+    )
+    parser.add_argument("--device_memory_high_watermark", type=float, default=0.9, help="fraction of device memory reserved before fragmentation is acted upon")
+    parser.add_argument("--host_memory_growth_gb", type=float, default=2.0, help="run gc.collect() once host RSS grew this much since the last collection")
+    parser.add_argument("--leak_check_steps", type=int, default=0, help="every n steps, report tensor shapes whose live count grew (expensive, 0 disables)")
+    return parser
+
+
+def configure_allocator(cuda_alloc_conf):
+    """Set the CUDA caching allocator options. Must run before the first CUDA allocation to take effect."""
+    if cuda_alloc_conf is None or "PYTORCH_CUDA_ALLOC_CONF" in os.environ:
+        return
+    if torch.cuda.is_initialized():
+        print(f"CUDA is already initialized, ignoring --cuda_alloc_conf {cuda_alloc_conf}")
+        return
+    os.environ["PYTORCH_CUDA_ALLOC_CONF"] = cuda_alloc_conf
+
+
+def live_tensor_counts():
+    counts = Counter()
+    for obj in gc.get_objects():
+        try:
+            if isinstance(obj, torch.Tensor):
+                counts[(tuple(obj.shape), str(obj.dtype), str(obj.device))] += 1
+        except ReferenceError:
+            continue
+    return counts
+
+
+class MemoryPolicy:
+    """
+    Replaces unconditional `gc.collect()` / `torch.cuda.empty_cache()` in training loops.
+
+    Both are only run when needed, based on counters that are cheap to read every step: the caching allocator's reserved vs
+    allocated bytes (no device sync) and the host RSS. Objects alive after model setup are moved out of the cyclic collector
+    with `gc.freeze()`, so the automatic collections that still happen do not rescan the model.
+    """
+
+    def __init__(self, fragmentation_threshold=0.3, device_memory_high_watermark=0.9, host_memory_growth_gb=2.0, leak_check_steps=0, verbose=True):
+        self.fragmentation_threshold = fragmentation_threshold
+        self.device_memory_high_watermark = device_memory_high_watermark
+        self.host_memory_growth = host_memory_growth_gb * 1024**3
+        self.leak_check_steps = leak_check_steps
+        self.verbose = verbose
+        self.use_cuda = torch.cuda.is_available()
+        self.device_memory = torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory if self.use_cuda else None
+        self.process = psutil.Process()
+        self.host_baseline = self.process.memory_info().rss
+        self.tensor_counts = None
+        self.num_gc = 0
+        self.num_empty_cache = 0
+        gc.collect()
+        gc.freeze()
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            fragmentation_threshold=args.fragmentation_threshold,
+            device_memory_high_watermark=args.device_memory_high_watermark,
+            host_memory_growth_gb=args.host_memory_growth_gb,
+            leak_check_steps=args.leak_check_steps,
+            verbose=args.rank == 0,
+        )
+
+    def step(self, global_step):
+        """Call once per training step; returns the actions taken, for logging."""
+        rss = self.process.memory_info().rss
+        if rss - self.host_baseline > self.host_memory_growth:
+            gc.collect()
+            self.num_gc += 1
+            rss = self.process.memory_info().rss
+            if self.verbose:
+                print(f"Step {global_step}: host RSS grew past {self.host_memory_growth / 1024**3:.1f} GB, gc.collect() -> {rss / 1024**3:.1f} GB")
+            self.host_baseline = rss
+
+        if self.use_cuda:
+            reserved = torch.cuda.memory_reserved()
+            unused = reserved - torch.cuda.memory_allocated()
+            if reserved > self.device_memory_high_watermark * self.device_memory and unused > self.fragmentation_threshold * reserved:
+                torch.cuda.empty_cache()
+                self.num_empty_cache += 1
+
+        if self.leak_check_steps > 0 and global_step % self.leak_check_steps == 0:
+            self.check_leaks(global_step)
+
+        return {"memory/host_rss_gb": rss / 1024**3, "memory/num_gc": self.num_gc, "memory/num_empty_cache": self.num_empty_cache}
+
+    def check_leaks(self, global_step, top_k=5):
+        counts = live_tensor_counts()
+        if self.tensor_counts is not None:
+            growth = counts - self.tensor_counts
+            if growth and self.verbose:
+                print(f"Step {global_step}: live tensors grew since the last check: " + ", ".join(f"{shape} {dtype} {device} +{n}" for (shape, dtype, device), n in growth.most_common(top_k)))
+        self.tensor_counts = counts
@@ -23,9 +23,10 @@ import wandb
 from otter_ai import FlamingoForConditionalGeneration, OtterForConditionalGeneration
 
 sys.path.append("../..")
-from pipeline.mimicit_utils.data import get_data
+from pipeline.mimicit_utils.data import LoaderMixer, get_data
 from pipeline.train.distributed import world_info_from_env
-from pipeline.train.train_utils import AverageMeter, get_checkpoint
+from pipeline.train.step_timer import StepTimer, add_profiling_args
+from pipeline.train.train_utils import AverageMeter, get_checkpoint, register_embedding_grad_mask
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -76,8 +77,25 @@ def parse_args():
     parser.add_argument("--train_num_samples_laion", type=int, default=100)
     parser.add_argument("--batch_size_mmc4", type=int, default=8)
     parser.add_argument("--batch_size_laion", type=int, default=8)
+    parser.add_argument("--mmc4_batches_per_step", type=int, default=1, help="number of mmc4 batches per optimizer step, losses are averaged over them")
+    parser.add_argument("--laion_batches_per_step", type=int, default=1, help="number of laion batches per optimizer step, losses are averaged over them")
+    parser.add_argument("--loader_prefetch", type=int, default=2, help="number of steps each loader prefetches ahead in its background queue")
     parser.add_argument("--workers", type=int, default=8)
     parser.add_argument("--dataset_resampled", action="store_true")
+    parser.add_argument(
+        "--shard_cache_dir",
+        type=str,
+        default=None,
+        help="node-local directory to cache webdataset shards in, shared by all workers and ranks on the node; disabled if not set",
+    )
+    parser.add_argument("--shard_cache_size_gb", type=float, default=100.0, help="disk quota of the shard cache, least recently used shards are evicted beyond it")
+    parser.add_argument("--shard_cache_lookahead", type=int, default=4, help="number of shards each worker fetches ahead of its read position")
+    parser.add_argument("--shard_cache_workers", type=int, default=2, help="number of concurrent shard fetches per dataloader worker")
+    parser.add_argument(
+        "--fast_image_decode",
+        action="store_true",
+        help="decode images with JPEG draft mode straight to the model resolution and normalize per batch instead of running the CLIP image processor per image",
+    )
     parser.add_argument(
         "--mmc4_textsim_threshold",
         default=0.32,
@@ -170,6 +188,7 @@ def parse_args():
         action="store_true",
         help="save checkpoints to wandb",
     )
+    add_profiling_args(parser)
     return parser
 
 
@@ -192,12 +211,14 @@ def train_one_epoch(
     accelerator,
     wandb,
 ):
-    num_batches_per_epoch_laion = laion_loader.num_batches
-    num_batches_per_epoch_mmc4 = mmc4_loader.num_batches
-
-    assert num_batches_per_epoch_laion == num_batches_per_epoch_mmc4, "Number of batches in laion and mmc4 datasets must be the same"
+    # overlap the two pipelines; the epoch lasts as long as the loader with more batches (relative to its ratio), the other one is cycled
+    mixed_loader = LoaderMixer(
+        {"laion": laion_loader, "mmc4": mmc4_loader},
+        ratios={"laion": args.laion_batches_per_step, "mmc4": args.mmc4_batches_per_step},
+        prefetch=args.loader_prefetch,
+    )
 
-    num_batches_per_epoch = num_batches_per_epoch_mmc4
+    num_batches_per_epoch = len(mixed_loader)
     total_training_steps = num_batches_per_epoch * args.num_epochs
 
     media_token_id = tokenizer("<image>", add_special_tokens=False)["input_ids"][-1]
@@ -207,143 +228,151 @@ def train_one_epoch(
     model.train()
 
     # setup logging
+    timer = StepTimer(enabled=args.rank == 0, first_step=epoch * num_batches_per_epoch, profile_steps=args.profile_steps, profile_dir=args.profile_dir)
+    timer.attach_otter(accelerator.unwrap_model(model))
     step_time_m = AverageMeter()  # time for one optimizer step (> 1 batch if using gradient accum)
     data_time_m = AverageMeter()  # avg time to load one batch of both C4 AND laion (= 1 batch regardless of gradient accum)
     end = time.time()
 
     # loop through dataloader
-    for num_steps, (batch_laion, batch_mmc4) in tqdm(
-        enumerate(zip(laion_loader, mmc4_loader)),
+    timer.start("data_wait")
+    for num_steps, batches in tqdm(
+        enumerate(mixed_loader),
         disable=args.rank != 0,
         total=total_training_steps,
         initial=(epoch * num_batches_per_epoch),
     ):
+        timer.stop("data_wait")
         data_time_m.update(time.time() - end)
 
         global_step = num_steps + epoch * num_batches_per_epoch
-        total_losses = []
-
-        #### LAION FORWARD PASS ####
-        images = batch_laion[0].to(device_id, non_blocking=True).unsqueeze(1).unsqueeze(1)
-
-        input_ids = batch_laion[1][0].to(device_id, non_blocking=True)
-        attention_mask = batch_laion[1][1].to(device_id, non_blocking=True)
-
-        labels = input_ids.clone()
-        labels[labels == tokenizer.pad_token_id] = -100
-        labels[:, 0] = -100
-        labels[labels == media_token_id] = -100
-        labels.to(device_id)
-
-        with accelerator.autocast():
-            loss_laion = model(
-                vision_x=images,
-                lang_x=input_ids,
-                attention_mask=attention_mask,
-                labels=labels,
-            )[0]
-
-        # model.eval()
-        # model.text_tokenizer.padding_side = "left"
-        # text_prompt_lang_x = model.text_tokenizer(
-        #     [
-        #         "<image>",
-        #     ],
-        #     return_tensors="pt",
-        # )['input_ids']
-        # outputs_debug = model.generate(
-        #     vision_x=images.to(device_id),
-        #     lang_x=text_prompt_lang_x.to(device_id),
-        #     attention_mask=attention_mask.to(device_id),
-        #     max_length=256,
-        # )
-
-        # print(model.text_tokenizer.batch_decode(outputs_debug))
-        # print(model.text_tokenizer.batch_decode(input_ids))
-        # model.train()
-
-        #### LAION BACKWARD ####
-        accelerator.backward(args.loss_multiplier_laion * loss_laion)
-        total_losses.append(args.loss_multiplier_laion * loss_laion)
-
-        #### MMC4 FORWARD PASS ####
-        images = batch_mmc4[0].to(device_id, non_blocking=True).unsqueeze(2)
-        input_ids = torch.stack([x[0] for x in batch_mmc4[1]]).squeeze(1)
-        attention_mask = torch.stack([x[1] for x in batch_mmc4[1]]).squeeze(1)
-
-        # NOTE: irena: expected shape of clip_text_input_ids / attention_mask is (N, I, max_seq_len)
-        labels = input_ids.clone()
-        labels[labels == tokenizer.pad_token_id] = -100
-        labels[:, 0] = -100
-
-        for i in range(labels.shape[0]):
-            # remove loss for any token before the first <image> token
-            label_idx = 0
-            while label_idx < labels.shape[1] and labels[i][label_idx] != media_token_id:
-                labels[i][label_idx] = -100
-                label_idx += 1
-
-            # get index of all endofchunk tokens in the sequence
-            endofchunk_idxs = torch.where(labels[i] == endofchunk_token_id)[0]
-            for endofchunk_idx in endofchunk_idxs:
-                token_idx = endofchunk_idx + 1
-                while token_idx < labels.shape[1] and labels[i][token_idx] != media_token_id:
-                    labels[i][token_idx] = -100
-                    token_idx += 1
-
-        labels[labels == media_token_id] = -100
-        labels.to(device_id)
-
-        # with accelerator.accumulate(model):
-        with accelerator.autocast():
-            loss_mmc4 = model(
-                vision_x=images,
-                lang_x=input_ids,
-                attention_mask=attention_mask,
-                labels=labels,
-            )[0]
-
-        # model.text_tokenizer.padding_side = "left"
-        # outputs_debug = model.generate(
-        #     vision_x=images.to(device_id),
-        #     lang_x=input_ids.to(device_id),
-        #     attention_mask=attention_mask.to(device_id),
-        #     max_length=256,
-        # )
-
-        # print(model.text_tokenizer.batch_decode(outputs_debug))
-        # print(model.text_tokenizer.batch_decode(input_ids))
-
-        #### MMC4 BACKWARD ####
-        accelerator.backward(args.loss_multiplier_mmc4 * loss_mmc4)
-        total_losses.append(args.loss_multiplier_mmc4 * loss_mmc4)
+
+        laion_losses, mmc4_losses = [], []
+        num_tokens = 0
+        for batch_laion in batches["laion"]:
+            #### LAION FORWARD PASS ####
+            with timer.section("h2d"):
+                images = batch_laion[0].to(device_id, non_blocking=True).unsqueeze(1).unsqueeze(1)
+
+                input_ids = batch_laion[1][0].to(device_id, non_blocking=True)
+                attention_mask = batch_laion[1][1].to(device_id, non_blocking=True)
+            num_tokens += attention_mask.sum()
+
+            with timer.section("label_masking"):
+                labels = input_ids.clone()
+                labels[labels == tokenizer.pad_token_id] = -100
+                labels[:, 0] = -100
+                labels[labels == media_token_id] = -100
+                labels.to(device_id)
+
+            with accelerator.autocast(), timer.section("forward"):
+                loss_laion = model(
+                    vision_x=images,
+                    lang_x=input_ids,
+                    attention_mask=attention_mask,
+                    labels=labels,
+                )[0]
+
+            # model.eval()
+            # model.text_tokenizer.padding_side = "left"
+            # text_prompt_lang_x = model.text_tokenizer(
+            #     [
+            #         "<image>",
+            #     ],
+            #     return_tensors="pt",
+            # )['input_ids']
+            # outputs_debug = model.generate(
+            #     vision_x=images.to(device_id),
+            #     lang_x=text_prompt_lang_x.to(device_id),
+            #     attention_mask=attention_mask.to(device_id),
+            #     max_length=256,
+            # )
+
+            # print(model.text_tokenizer.batch_decode(outputs_debug))
+            # print(model.text_tokenizer.batch_decode(input_ids))
+            # model.train()
+
+            #### LAION BACKWARD ####
+            with timer.section("backward"):
+                accelerator.backward(args.loss_multiplier_laion * loss_laion / len(batches["laion"]))
+            laion_losses.append(loss_laion.detach())
+
+        for batch_mmc4 in batches["mmc4"]:
+            #### MMC4 FORWARD PASS ####
+            with timer.section("h2d"):
+                # the images of all samples packed back to back, (N, F=1, C, H, W)
+                images = batch_mmc4[0].to(device_id, non_blocking=True).unsqueeze(1)
+                num_images = batch_mmc4[2].to(device_id, non_blocking=True)
+                input_ids = torch.stack([x[0] for x in batch_mmc4[1]]).squeeze(1)
+                attention_mask = torch.stack([x[1] for x in batch_mmc4[1]]).squeeze(1)
+            num_tokens += attention_mask.sum()
+
+            # NOTE: irena: expected shape of clip_text_input_ids / attention_mask is (N, I, max_seq_len)
+            with timer.section("label_masking"):
+                labels = input_ids.clone()
+                labels[labels == tokenizer.pad_token_id] = -100
+                labels[:, 0] = -100
+
+                for i in range(labels.shape[0]):
+                    # remove loss for any token before the first <image> token
+                    label_idx = 0
+                    while label_idx < labels.shape[1] and labels[i][label_idx] != media_token_id:
+                        labels[i][label_idx] = -100
+                        label_idx += 1
+
+                    # get index of all endofchunk tokens in the sequence
+                    endofchunk_idxs = torch.where(labels[i] == endofchunk_token_id)[0]
+                    for endofchunk_idx in endofchunk_idxs:
+                        token_idx = endofchunk_idx + 1
+                        while token_idx < labels.shape[1] and labels[i][token_idx] != media_token_id:
+                            labels[i][token_idx] = -100
+                            token_idx += 1
+
+                labels[labels == media_token_id] = -100
+                labels.to(device_id)
+
+            # with accelerator.accumulate(model):
+            with accelerator.autocast(), timer.section("forward"):
+                loss_mmc4 = model(
+                    vision_x=images,
+                    lang_x=input_ids,
+                    attention_mask=attention_mask,
+                    labels=labels,
+                    num_images=num_images,
+                )[0]
+
+            # model.text_tokenizer.padding_side = "left"
+            # outputs_debug = model.generate(
+            #     vision_x=images.to(device_id),
+            #     lang_x=input_ids.to(device_id),
+            #     attention_mask=attention_mask.to(device_id),
+            #     max_length=256,
+            # )
+
+            # print(model.text_tokenizer.batch_decode(outputs_debug))
+            # print(model.text_tokenizer.batch_decode(input_ids))
+
+            #### MMC4 BACKWARD ####
+            with timer.section("backward"):
+                accelerator.backward(args.loss_multiplier_mmc4 * loss_mmc4 / len(batches["mmc4"]))
+            mmc4_losses.append(loss_mmc4.detach())
+
         #### Collect MMC4/LAION Loss Info ####
+        loss_laion = torch.stack(laion_losses).mean()
+        loss_mmc4 = torch.stack(mmc4_losses).mean()
+        total_losses = [args.loss_multiplier_laion * loss_laion, args.loss_multiplier_mmc4 * loss_mmc4]
         total_loss_sum = sum(total_losses)
         mean_loss = total_loss_sum / len(total_losses)
         # accelerator.backward(total_loss_sum.to(device_id))
 
-        def mask_embedding(m):
-            if m.weight.requires_grad:
-                zero_mask = torch.zeros_like(m.weight.grad)
-                # zero_mask[answer_token_id] = torch.ones_like(zero_mask[answer_token_id])
-                zero_mask[media_token_id] = torch.ones_like(zero_mask[media_token_id])
-                zero_mask[endofchunk_token_id] = torch.ones_like(zero_mask[endofchunk_token_id])
-                m.weight.grad = m.weight.grad * zero_mask
-
-        if args.mask_lm_head:
-            unwrapped_model = accelerator.unwrap_model(model)
-            if unwrapped_model.lang_encoder.__class__.__name__ == "MPTForCausalLM":
-                unwrapped_model.lang_encoder.transformer.wte.apply(mask_embedding)
-            elif unwrapped_model.lang_encoder.__class__.__name__ == "LlamaForCausalLM":
-                unwrapped_model.lang_encoder.model.embed_tokens.apply(mask_embedding)
-                unwrapped_model.lang_encoder.lm_head.apply(mask_embedding)
-
-        if accelerator.sync_gradients:
-            accelerator.clip_grad_norm_(model.parameters(), 1.0)
+        with timer.section("optimizer"):
+            if accelerator.sync_gradients:
+                accelerator.clip_grad_norm_(model.parameters(), 1.0)
 
-        optimizer.step()
-        lr_scheduler.step()
-        optimizer.zero_grad()
+            optimizer.step()
+            lr_scheduler.step()
+            optimizer.zero_grad()
+        timer.step(num_tokens=num_tokens)
 
         # step time and reset end outside of rank 0
         step_time_m.update(time.time() - end)
@@ -352,22 +381,23 @@ def train_one_epoch(
         if accelerator.sync_gradients:
             if args.rank == 0 and args.report_to_wandb:
                 # compute within rank 0
-                mmc4_samples_per_second = args.gradient_accumulation_steps * args.batch_size_mmc4 * args.world_size / step_time_m.val
-                mmc4_samples_per_second_per_gpu = args.gradient_accumulation_steps * args.batch_size_mmc4 / step_time_m.val
-                laion_samples_per_second = args.gradient_accumulation_steps * args.batch_size_laion * args.world_size / step_time_m.val
-                laion_samples_per_second_per_gpu = args.gradient_accumulation_steps * args.batch_size_laion / step_time_m.val
-                wandb.log(
-                    {
-                        "data_time": data_time_m.avg,
-                        "step_time": step_time_m.avg,
-                        "mmc4_samples_per_second": mmc4_samples_per_second,
-                        "mmc4_samples_per_second_per_gpu": mmc4_samples_per_second_per_gpu,
-                        "laion_samples_per_second": laion_samples_per_second,
-                        "laion_samples_per_second_per_gpu": laion_samples_per_second_per_gpu,
-                        "lr": optimizer.param_groups[0]["lr"],
-                    },
-                    commit=False,
-                )
+                mmc4_samples_per_second = args.gradient_accumulation_steps * args.batch_size_mmc4 * args.mmc4_batches_per_step * args.world_size / step_time_m.val
+                mmc4_samples_per_second_per_gpu = args.gradient_accumulation_steps * args.batch_size_mmc4 * args.mmc4_batches_per_step / step_time_m.val
+                laion_samples_per_second = args.gradient_accumulation_steps * args.batch_size_laion * args.laion_batches_per_step * args.world_size / step_time_m.val
+                laion_samples_per_second_per_gpu = args.gradient_accumulation_steps * args.batch_size_laion * args.laion_batches_per_step / step_time_m.val
+                log_dict = {
+                    "data_time": data_time_m.avg,
+                    "step_time": step_time_m.avg,
+                    "mmc4_samples_per_second": mmc4_samples_per_second,
+                    "mmc4_samples_per_second_per_gpu": mmc4_samples_per_second_per_gpu,
+                    "laion_samples_per_second": laion_samples_per_second,
+                    "laion_samples_per_second_per_gpu": laion_samples_per_second_per_gpu,
+                    "lr": optimizer.param_groups[0]["lr"],
+                }
+                # the breakdown synchronizes the device, so it is only resolved every logging_steps
+                if (num_steps + 1) % args.logging_steps == 0:
+                    log_dict.update(timer.summary())
+                wandb.log(log_dict, commit=False)
                 step_time_m.reset()
                 data_time_m.reset()
 
@@ -384,8 +414,11 @@ def train_one_epoch(
         # Log loss to console
         if ((num_steps + 1) % args.logging_steps == 0) and args.rank == 0:
             print(f"Step {num_steps+1}/{num_batches_per_epoch} of epoch {epoch+1}/{args.num_epochs} complete. Mean Loss: {mean_loss.item():.3f}")
+            if not args.report_to_wandb:
+                print(", ".join(f"{name}: {value:.2f}" for name, value in timer.summary().items()))
         # Add a process on saving checkpoints during pretraining
         if ((num_steps + 1) % args.checkpointing_steps == 0) and args.rank == 0:
+            timer.start("checkpoint")
             if not os.path.exists(args.external_save_dir):
                 os.makedirs(args.external_save_dir)
 
@@ -409,6 +442,11 @@ def train_one_epoch(
                     previous_checkpoint_path = f"{args.external_save_dir}/checkpoint_steps{num_steps + 1 - args.checkpointing_steps}.pt"
                     if os.path.exists(previous_checkpoint_path):
                         os.remove(previous_checkpoint_path)
+            timer.stop("checkpoint")
+        timer.start("data_wait")
+
+    timer.stop("data_wait")
+    timer.close()
 
 
 def main():
@@ -488,7 +526,13 @@ def main():
         ]
 
     # total_training_steps = ((args.train_num_samples_mmc4) // (args.batch_size_mmc4 * args.world_size)) * args.num_epochs
-    total_training_steps = mmc4_dataset.dataloader.num_batches * args.num_epochs
+    total_training_steps = (
+        LoaderMixer(
+            {"laion": laion_dataset.dataloader, "mmc4": mmc4_dataset.dataloader},
+            ratios={"laion": args.laion_batches_per_step, "mmc4": args.mmc4_batches_per_step},
+        ).num_steps
+        * args.num_epochs
+    )
 
     resume_from_epoch = 0
     # check if a checkpoint exists for this run
@@ -541,6 +585,20 @@ def main():
 
     model, optimizer, lr_scheduler = accelerator.prepare(model, optimizer, lr_scheduler)
 
+    if args.mask_lm_head:
+        # only the <image> and <|endofchunk|> embedding rows are trained; the hooks mask the gradients of every other row at each backward
+        token_ids = [tokenizer(token, add_special_tokens=False)["input_ids"][-1] for token in ["<image>", "<|endofchunk|>"]]
+        unwrapped_model = accelerator.unwrap_model(model)
+        if unwrapped_model.lang_encoder.__class__.__name__ == "MPTForCausalLM":
+            embedding_modules = [unwrapped_model.lang_encoder.transformer.wte]
+        elif unwrapped_model.lang_encoder.__class__.__name__ == "LlamaForCausalLM":
+            embedding_modules = [unwrapped_model.lang_encoder.model.embed_tokens, unwrapped_model.lang_encoder.lm_head]
+        else:
+            embedding_modules = []
+        for module in embedding_modules:
+            if module.weight.requires_grad:
+                register_embedding_grad_mask(module, token_ids)
+
     # YH: hardcode for ddp, reason is related to "split_batch" in accelerator. Currently just fix this bug, need to dig further.
     if accelerator.num_processes > 1:
         lr_scheduler.split_batches = True
@@ -25,7 +25,8 @@ from otter_ai import FlamingoForConditionalGeneration, OtterForConditionalGenera
 sys.path.append("../..")
 from pipeline.mimicit_utils.data import get_data
 from pipeline.train.distributed import world_info_from_env
-from pipeline.train.train_utils import AverageMeter, get_checkpoint
+from pipeline.train.step_timer import StepTimer, add_profiling_args
+from pipeline.train.train_utils import AverageMeter, get_checkpoint, register_embedding_grad_mask
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -71,6 +72,20 @@ def parse_args():
     parser.add_argument("--batch_size_cc3m", type=int, default=8)
     parser.add_argument("--workers", type=int, default=8)
     parser.add_argument("--dataset_resampled", action="store_true")
+    parser.add_argument(
+        "--shard_cache_dir",
+        type=str,
+        default=None,
+        help="node-local directory to cache webdataset shards in, shared by all workers and ranks on the node; disabled if not set",
+    )
+    parser.add_argument("--shard_cache_size_gb", type=float, default=100.0, help="disk quota of the shard cache, least recently used shards are evicted beyond it")
+    parser.add_argument("--shard_cache_lookahead", type=int, default=4, help="number of shards each worker fetches ahead of its read position")
+    parser.add_argument("--shard_cache_workers", type=int, default=2, help="number of concurrent shard fetches per dataloader worker")
+    parser.add_argument(
+        "--fast_image_decode",
+        action="store_true",
+        help="decode images with JPEG draft mode straight to the model resolution and normalize per batch instead of running the CLIP image processor per image",
+    )
     # parser.add_argument("--use_media_placement_augmentation", action="store_true")
     parser.add_argument("--offline", action="store_true")
     parser.add_argument("--num_epochs", type=int, default=1)
@@ -149,6 +164,7 @@ def parse_args():
         action="store_true",
         help="save checkpoints to wandb",
     )
+    add_profiling_args(parser)
     return parser
 
 
@@ -182,6 +198,8 @@ def train_one_epoch(
     model.train()
 
     # setup logging
+    timer = StepTimer(enabled=args.rank == 0, first_step=epoch * num_batches_per_epoch, profile_steps=args.profile_steps, profile_dir=args.profile_dir)
+    timer.attach_otter(accelerator.unwrap_model(model))
     step_time_m = AverageMeter()  # time for one optimizer step (> 1 batch if using gradient accum)
     data_time_m = AverageMeter()  # avg time to load one batch of both C4 AND cc3m (= 1 batch regardless of gradient accum)
     end = time.time()
@@ -189,30 +207,34 @@ def train_one_epoch(
     print(f"Using dtype {dtype}")
 
     # loop through dataloader
+    timer.start("data_wait")
     for num_steps, (batch_cc3m) in tqdm(
         enumerate(cc3m_loader),
         disable=args.rank != 0,
         total=total_training_steps,
         initial=(epoch * num_batches_per_epoch),
     ):
+        timer.stop("data_wait")
         data_time_m.update(time.time() - end)
 
         global_step = num_steps + epoch * num_batches_per_epoch
         total_losses = []
 
         #### LAION FORWARD PASS ####
-        images = batch_cc3m[0].to(device_id, non_blocking=True).unsqueeze(1).unsqueeze(1)
+        with timer.section("h2d"):
+            images = batch_cc3m[0].to(device_id, non_blocking=True).unsqueeze(1).unsqueeze(1)
 
-        input_ids = batch_cc3m[1][0].to(device_id, non_blocking=True)
-        attention_mask = batch_cc3m[1][1].to(device_id, non_blocking=True)
+            input_ids = batch_cc3m[1][0].to(device_id, non_blocking=True)
+            attention_mask = batch_cc3m[1][1].to(device_id, non_blocking=True)
 
-        labels = input_ids.clone()
-        labels[labels == tokenizer.pad_token_id] = -100
-        labels[:, 0] = -100
-        labels[labels == media_token_id] = -100
-        labels.to(device_id)
+        with timer.section("label_masking"):
+            labels = input_ids.clone()
+            labels[labels == tokenizer.pad_token_id] = -100
+            labels[:, 0] = -100
+            labels[labels == media_token_id] = -100
+            labels.to(device_id)
 
-        with accelerator.autocast():
+        with accelerator.autocast(), timer.section("forward"):
             loss_cc3m = model(
                 vision_x=images.to(dtype),
                 lang_x=input_ids,
@@ -221,35 +243,22 @@ def train_one_epoch(
             )[0]
 
         #### LAION BACKWARD ####
-        accelerator.backward(args.loss_multiplier_cc3m * loss_cc3m)
+        with timer.section("backward"):
+            accelerator.backward(args.loss_multiplier_cc3m * loss_cc3m)
         total_losses.append(args.loss_multiplier_cc3m * loss_cc3m)
 
         total_loss_sum = sum(total_losses)
         mean_loss = total_loss_sum / len(total_losses)
         # accelerator.backward(total_loss_sum.to(device_id))
 
-        def mask_embedding(m):
-            if m.weight.requires_grad:
-                zero_mask = torch.zeros_like(m.weight.grad)
-                # zero_mask[answer_token_id] = torch.ones_like(zero_mask[answer_token_id])
-                zero_mask[media_token_id] = torch.ones_like(zero_mask[media_token_id])
-                zero_mask[endofchunk_token_id] = torch.ones_like(zero_mask[endofchunk_token_id])
-                m.weight.grad = m.weight.grad * zero_mask
+        with timer.section("optimizer"):
+            if accelerator.sync_gradients:
+                accelerator.clip_grad_norm_(model.parameters(), 1.0)
 
-        if args.mask_lm_head:
-            unwrapped_model = accelerator.unwrap_model(model)
-            if unwrapped_model.lang_encoder.__class__.__name__ == "MPTForCausalLM":
-                unwrapped_model.lang_encoder.transformer.wte.apply(mask_embedding)
-            elif unwrapped_model.lang_encoder.__class__.__name__ == "LlamaForCausalLM":
-                unwrapped_model.lang_encoder.model.embed_tokens.apply(mask_embedding)
-                unwrapped_model.lang_encoder.lm_head.apply(mask_embedding)
-
-        if accelerator.sync_gradients:
-            accelerator.clip_grad_norm_(model.parameters(), 1.0)
-
-        optimizer.step()
-        lr_scheduler.step()
-        optimizer.zero_grad()
+            optimizer.step()
+            lr_scheduler.step()
+            optimizer.zero_grad()
+        timer.step(num_tokens=attention_mask.sum())
 
         # step time and reset end outside of rank 0
         step_time_m.update(time.time() - end)
@@ -260,16 +269,17 @@ def train_one_epoch(
                 # compute within rank 0
                 cc3m_samples_per_second = args.gradient_accumulation_steps * args.batch_size_cc3m * args.world_size / step_time_m.val
                 cc3m_samples_per_second_per_gpu = args.gradient_accumulation_steps * args.batch_size_cc3m / step_time_m.val
-                wandb.log(
-                    {
-                        "data_time": data_time_m.avg,
-                        "step_time": step_time_m.avg,
-                        "cc3m_samples_per_second": cc3m_samples_per_second,
-                        "cc3m_samples_per_second_per_gpu": cc3m_samples_per_second_per_gpu,
-                        "lr": optimizer.param_groups[0]["lr"],
-                    },
-                    commit=False,
-                )
+                log_dict = {
+                    "data_time": data_time_m.avg,
+                    "step_time": step_time_m.avg,
+                    "cc3m_samples_per_second": cc3m_samples_per_second,
+                    "cc3m_samples_per_second_per_gpu": cc3m_samples_per_second_per_gpu,
+                    "lr": optimizer.param_groups[0]["lr"],
+                }
+                # the breakdown synchronizes the device, so it is only resolved every logging_steps
+                if (num_steps + 1) % args.logging_steps == 0:
+                    log_dict.update(timer.summary())
+                wandb.log(log_dict, commit=False)
                 step_time_m.reset()
                 data_time_m.reset()
 
@@ -285,8 +295,11 @@ def train_one_epoch(
         # Log loss to console
         if ((num_steps + 1) % args.logging_steps == 0) and args.rank == 0:
             print(f"Step {num_steps+1}/{num_batches_per_epoch} of epoch {epoch+1}/{args.num_epochs} complete. Mean Loss: {mean_loss.item():.3f}")
+            if not args.report_to_wandb:
+                print(", ".join(f"{name}: {value:.2f}" for name, value in timer.summary().items()))
         # Add a process on saving checkpoints during pretraining
         if ((num_steps + 1) % args.checkpointing_steps == 0) and args.rank == 0:
+            timer.start("checkpoint")
             if not os.path.exists(args.external_save_dir):
                 os.makedirs(args.external_save_dir)
 
@@ -310,6 +323,11 @@ def train_one_epoch(
                     previous_checkpoint_path = f"{args.external_save_dir}/checkpoint_steps{num_steps + 1 - args.checkpointing_steps}.pt"
                     if os.path.exists(previous_checkpoint_path):
                         os.remove(previous_checkpoint_path)
+            timer.stop("checkpoint")
+        timer.start("data_wait")
+
+    timer.stop("data_wait")
+    timer.close()
 
 
 def main():
@@ -446,6 +464,20 @@ def main():
 
     model, optimizer, lr_scheduler = accelerator.prepare(model, optimizer, lr_scheduler)
 
+    if args.mask_lm_head:
+        # only the <image> and <|endofchunk|> embedding rows are trained; the hooks mask the gradients of every other row at each backward
+        token_ids = [tokenizer(token, add_special_tokens=False)["input_ids"][-1] for token in ["<image>", "<|endofchunk|>"]]
+        unwrapped_model = accelerator.unwrap_model(model)
+        if unwrapped_model.lang_encoder.__class__.__name__ == "MPTForCausalLM":
+            embedding_modules = [unwrapped_model.lang_encoder.transformer.wte]
+        elif unwrapped_model.lang_encoder.__class__.__name__ == "LlamaForCausalLM":
+            embedding_modules = [unwrapped_model.lang_encoder.model.embed_tokens, unwrapped_model.lang_encoder.lm_head]
+        else:
+            embedding_modules = []
+        for module in embedding_modules:
+            if module.weight.requires_grad:
+                register_embedding_grad_mask(module, token_ids)
+
     # YH: hardcode for ddp, reason is related to "split_batch" in accelerator. Currently just fix this bug, need to dig further.
     if accelerator.num_processes > 1:
         lr_scheduler.split_batches = True
@@ -0,0 +1,150 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+def add_profiling_args(parser):
+    parser.add_argument(
+        "--profile_steps",
+        type=str,
+        default=None,
+        help="record a torch.profiler trace of global steps 'start,end' (end excluded), e.g. '20,25'",
+    )
+    parser.add_argument("--profile_dir", type=str, default="profiler_traces", help="where --profile_steps traces are written (tensorboard format)")
+    return parser
+
+
+class StepTimer:
+    """
+    Breaks training steps down into named sections (data wait, forward, backward, ...).
+
+    With CUDA, sections are delimited by CUDA events on the current stream. Recording them does not synchronize, and they
+    measure how long the GPU spent between the two points, so host work that is hidden behind queued kernels shows up as
+    ~0. Events are only resolved in `summary()`, which is meant to be called at logging time. Without CUDA, wall-clock time
+    is used. A disabled timer (e.g. on non-zero ranks) makes every call a no-op.
+
+    `attach` times module forwards through hooks, and `step` optionally drives a torch.profiler window over a global step
+    range, with every section showing up as a labelled range in the trace.
+    """
+
+    def __init__(self, enabled=True, first_step=0, profile_steps=None, profile_dir="profiler_traces"):
+        self.enabled = enabled
+        self.use_cuda = torch.cuda.is_available()
+        self.global_step = first_step
+        self.profile_range = tuple(int(step) for step in profile_steps.split(",")) if profile_steps else None
+        self.profile_dir = profile_dir
+        self.profiler = None
+        self.handles = []
+        self.open = {}
+        self.reset()
+
+    def reset(self):
+        self.intervals = defaultdict(list)
+        self.num_steps = 0
+        self.num_tokens = 0
+        self.window_start = time.perf_counter()
+        if self.enabled and self.use_cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def _mark(self):
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def start(self, name):
+        if self.enabled:
+            self.open[name] = self._mark()
+
+    def stop(self, name):
+        if self.enabled and name in self.open:
+            self.intervals[name].append((self.open.pop(name), self._mark()))
+
+    @contextmanager
+    def section(self, name):
+        if not self.enabled:
+            yield
+            return
+        with torch.profiler.record_function(name) if self.profiler is not None else nullcontext():
+            self.start(name)
+            try:
+                yield
+            finally:
+                self.stop(name)
+
+    def attach(self, module, name):
+        """
+        Time every forward call of `module` as section `name`. Forwards recomputed by gradient checkpointing inside the
+        "backward" section are left out, so that their time is only counted in "backward".
+        """
+        if self.enabled and module is not None:
+            self.handles.append(module.register_forward_pre_hook(lambda *_: self._start_forward(name)))
+            self.handles.append(module.register_forward_hook(lambda *_: self.stop(name)))
+
+    def _start_forward(self, name):
+        if "backward" not in self.open:
+            self.start(name)
+
+    def attach_otter(self, model):
+        """Split the forward of Otter/Flamingo style models into vision encoding and language model forward."""
+        self.attach(getattr(model, "vision_encoder", None), "vision_encode")
+        self.attach(getattr(model, "perceiver", None), "vision_encode")
+        self.attach(getattr(model, "lang_encoder", None), "lm_forward")
+
+    def step(self, num_tokens=None):
+        """Mark the end of a training step; `num_tokens` (tensor or int) counts its non-padding tokens."""
+        if not self.enabled:
+            return
+        self.num_steps += 1
+        if num_tokens is not None:
+            self.num_tokens = self.num_tokens + num_tokens
+        self.global_step += 1
+        self._update_profiler()
+
+    def _update_profiler(self):
+        if self.profile_range is None:
+            return
+        start, end = self.profile_range
+        if self.profiler is None and start <= self.global_step < end:
+            activities = [torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if self.use_cuda else [])
+            self.profiler = torch.profiler.profile(
+                activities=activities,
+                record_shapes=True,
+                profile_memory=True,
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(self.profile_dir),
+            )
+            self.profiler.start()
+        elif self.profiler is not None and self.global_step >= end:
+            self.profiler.stop()
+            self.profiler = None
+            self.profile_range = None
+
+    def summary(self):
+        """Per-step averages since the last summary, in ms, plus peak memory and tokens/sec. Synchronizes the device."""
+        if not self.enabled or self.num_steps == 0:
+            return {}
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        wall_time = time.perf_counter() - self.window_start
+        stats = {"time/step_ms": wall_time * 1000 / self.num_steps}
+        for name, intervals in self.intervals.items():
+            total_ms = sum(start.elapsed_time(end) if self.use_cuda else (end - start) * 1000 for start, end in intervals)
+            stats[f"time/{name}_ms"] = total_ms / self.num_steps
+        if torch.is_tensor(self.num_tokens) or self.num_tokens:
+            stats["tokens_per_second"] = float(self.num_tokens) / wall_time
+        if self.use_cuda:
+            stats["memory/peak_allocated_gb"] = torch.cuda.max_memory_allocated() / 1024**3
+            stats["memory/peak_reserved_gb"] = torch.cuda.max_memory_reserved() / 1024**3
+        self.reset()
+        return stats
+
+    def close(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
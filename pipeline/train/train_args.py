@@ -2,6 +2,8 @@ import argparse
 import os
 
 from pipeline.train.distributed import world_info_from_env
+from pipeline.train.memory import add_memory_args
+from pipeline.train.step_timer import add_profiling_args
 
 
 def parse_tuple(string):
@@ -116,6 +118,12 @@ def parse_args():
     )
     parser.add_argument("--patch-image-size", type=int, default=224)
     parser.add_argument("--resample_frames", type=int, default=32)
+    parser.add_argument(
+        "--vision_features_path",
+        type=str,
+        default=None,
+        help="comma separated directories written by pipeline/utils/extract_vision_features.py; with a frozen vision encoder, train on these features instead of images",
+    )
     # this could potentially save 33GB of all model parameters for otter-9b, including the language and vision model.
     parser.add_argument("--save_hf_model", default=False, action="store_true")
     parser.add_argument(
@@ -145,6 +153,23 @@ def parse_args():
         action="store_true",
         help="delete previous checkpoint when saving new checkpoint",
     ),
+    parser.add_argument(
+        "--async_checkpoint",
+        action="store_true",
+        help="snapshot trainable weights to pinned CPU memory and write them as safetensors shards on a background thread",
+    )
+    parser.add_argument(
+        "--keep_last_n_checkpoints",
+        type=int,
+        default=-1,
+        help="with --async_checkpoint, keep only the last n step/epoch checkpoints (-1 keeps all, --delete_previous_checkpoint implies 1)",
+    )
+    parser.add_argument(
+        "--save_delta",
+        action="store_true",
+        help="save final weights as a safetensors delta against --pretrained_model_name_or_path, loadable with otter_ai.models.delta_checkpoint.DeltaOverlay",
+    )
+    parser.add_argument("--checkpoint_shard_size_gb", type=float, default=2.0, help="max size of a safetensors shard with --async_checkpoint")
     parser.add_argument(
         "--keep_symbols",
         action="store_true",
@@ -191,6 +216,15 @@ def parse_args():
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--ddp_trainable_only",
+        action="store_true",
+        help="multi-GPU: average only trainable gradients in overlapped buckets instead of wrapping the model in DDP; DeepSpeed: size reduce buckets for the trainable parameters",
+    )
+    parser.add_argument("--ddp_bucket_cap_mb", type=float, default=None, help="gradient bucket size with --ddp_trainable_only, by default 1/8 of the trainable parameters (1-25 MB)")
+    parser.add_argument("--peak_tflops", type=float, default=None, help="peak TFLOPs of one GPU for MFU reporting, detected for common GPUs if not set")
+    add_profiling_args(parser)
+    add_memory_args(parser)
     args = parser.parse_args()
 
     # Check for argument consistency and set environment variables if needed
@@ -9,6 +9,9 @@ import torch
 from torch.utils.data.distributed import DistributedSampler
 import torch.distributed as dist
 
+from pipeline.train.checkpointing import INDEX_SUFFIX, AsyncCheckpointWriter
+from src.otter_ai.models.delta_checkpoint import delta_metadata, save_delta
+
 try:
     from transformers.models.idefics.processing_idefics import image_attention_mask_for_packed_input_ids, incremental_to_binary_attention_mask
 except ImportError:
@@ -183,7 +186,7 @@ def get_grouped_params(model, wd):
     ]
 
 
-def save_checkpoint(epoch, model, args, accelerator, unwrapped_model=None, global_step=None):
+def save_checkpoint(epoch, model, args, accelerator, unwrapped_model=None, global_step=None, checkpoint_writer=None):
     """Save a checkpoint for the model."""
     # Ensure the directory exists
     if not os.path.exists(args.external_save_dir):
@@ -192,38 +195,47 @@ def save_checkpoint(epoch, model, args, accelerator, unwrapped_model=None, globa
     if unwrapped_model is None:
         unwrapped_model = accelerator.unwrap_model(model)
 
-    # Formulate the checkpoint filename based on whether it's an epoch or global_step checkpoint
+    # Formulate the checkpoint name based on whether it's an epoch or global_step checkpoint
     if global_step:
-        checkpoint_path = f"{args.external_save_dir}/checkpoint_steps_{global_step}.pt"
-        checkpoint_dict = {
-            "steps": global_step,
-            "model_state_dict": get_checkpoint(unwrapped_model),
-        }
+        checkpoint_name, series, metadata = f"checkpoint_steps_{global_step}", "steps", {"steps": global_step}
     else:
-        checkpoint_path = f"{args.external_save_dir}/checkpoint_{epoch}.pt"
-        checkpoint_dict = {"model_state_dict": get_checkpoint(unwrapped_model)}
+        checkpoint_name, series, metadata = f"checkpoint_{epoch}", "epoch", {"epoch": epoch}
 
     # Save the checkpoint if rank is 0
     if args.rank == 0:
-        print(f"Saving checkpoint to {checkpoint_path}")
-        accelerator.save(checkpoint_dict, checkpoint_path)
-
         # Save the model's configuration
         unwrapped_model.config.save_pretrained(args.external_save_dir)
 
+        if checkpoint_writer is not None:
+            print(f"Saving checkpoint to {args.external_save_dir}/{checkpoint_name}{INDEX_SUFFIX} in the background")
+            checkpoint_writer.save(get_checkpoint(unwrapped_model), checkpoint_name, series=series, metadata=metadata)
+            return
+
+        checkpoint_path = f"{args.external_save_dir}/{checkpoint_name}.pt"
+        print(f"Saving checkpoint to {checkpoint_path}")
+        accelerator.save({**metadata, "model_state_dict": get_checkpoint(unwrapped_model)}, checkpoint_path)
+
         # Remove the previous checkpoint if required
         if args.delete_previous_checkpoint:
             if global_step:
-                prev_checkpoint_path = f"{args.external_save_dir}/checkpoint_step_{global_step-args.save_steps_interval}.pt"
-                if os.path.exists(prev_checkpoint_path):
-                    os.remove(prev_checkpoint_path)
-            elif epoch > 0:
-                os.remove(f"{args.external_save_dir}/checkpoint_{epoch-1}.pt")
-
-
-def save_checkpoint(checkpoint_dict, save_path, is_main_process, save_function):
-    """Helper function to save the checkpoint."""
-    save_function(checkpoint_dict, f"{save_path}/final_weights.pt", is_main_process=is_main_process)
+                prev_checkpoint_path = f"{args.external_save_dir}/checkpoint_steps_{global_step-args.save_steps_interval}.pt"
+            else:
+                prev_checkpoint_path = f"{args.external_save_dir}/checkpoint_{epoch-1}.pt"
+            if os.path.exists(prev_checkpoint_path):
+                os.remove(prev_checkpoint_path)
+
+
+def save_final_checkpoint(checkpoint_dict, save_path, is_main_process, save_function, checkpoint_writer=None, base_model_name_or_path=None):
+    """Helper function to save the final trainable weights, as a delta against `base_model_name_or_path` if given."""
+    if checkpoint_writer is not None:
+        if is_main_process:
+            metadata = delta_metadata(base_model_name_or_path) if base_model_name_or_path is not None else None
+            checkpoint_writer.save(checkpoint_dict, "final_weights", metadata=metadata)
+    elif base_model_name_or_path is not None:
+        if is_main_process:
+            save_delta(checkpoint_dict, f"{save_path}/final_weights.safetensors", base_model_name_or_path)
+    else:
+        save_function(checkpoint_dict, f"{save_path}/final_weights.pt", is_main_process=is_main_process)
 
 
 def save_pretrained(component, save_path, is_main_process, save_function):
@@ -231,7 +243,15 @@ def save_pretrained(component, save_path, is_main_process, save_function):
     component.save_pretrained(save_path, is_main_process=is_main_process, save_function=save_function, safe_serialization=False)
 
 
-def save_final_weights(model, args, accelerator, processor=None, tokenizer=None):
+def get_checkpoint_writer(args):
+    """Background safetensors writer for the main process, or None to save synchronously with `accelerator.save`."""
+    if not args.async_checkpoint or args.rank != 0:
+        return None
+    keep_last_n = 1 if args.delete_previous_checkpoint else args.keep_last_n_checkpoints
+    return AsyncCheckpointWriter(args.external_save_dir, max_shard_bytes=int(args.checkpoint_shard_size_gb * 1024**3), keep_last_n=keep_last_n)
+
+
+def save_final_weights(model, args, accelerator, processor=None, tokenizer=None, checkpoint_writer=None):
     """Save final weights of the model."""
     unwrapped_model = accelerator.unwrap_model(model)
     is_main_process = accelerator.is_main_process
@@ -259,7 +279,28 @@ def save_final_weights(model, args, accelerator, processor=None, tokenizer=None)
             trainable_params_name = [name for name, p in unwrapped_model.named_parameters() if p.requires_grad]
             checkpoint_dict = {k: v for k, v in checkpoint_dict.items() if k in trainable_params_name}
 
-        save_checkpoint(checkpoint_dict, save_path, is_main_process, accelerator.save)
+        base_model_name_or_path = args.pretrained_model_name_or_path if args.save_delta else None
+        save_final_checkpoint(checkpoint_dict, save_path, is_main_process, accelerator.save, checkpoint_writer=checkpoint_writer, base_model_name_or_path=base_model_name_or_path)
+
+
+def register_embedding_grad_mask(module, token_ids):
+    """
+    Keep the gradient of an embedding / lm_head weight only for the rows of `token_ids`, e.g. newly added special tokens.
+
+    The other rows are zeroed in place once the gradient is accumulated into `weight.grad`, by a hook that runs inside the
+    accumulation, ahead of the DDP and DeepSpeed reduction hooks on the accumulation node. Only the kept rows are copied, so no
+    vocab-sized tensor is allocated. With `TrainableGradSync`, register it before the gradient sync. Returns the hook handle.
+    """
+    keep_rows = torch.as_tensor(token_ids, dtype=torch.long, device=module.weight.device)
+
+    def hook(weight):
+        grad = weight.grad
+        rows = keep_rows.to(grad.device)
+        kept = grad.index_select(0, rows)
+        grad.zero_()
+        grad.index_copy_(0, rows, kept)
+
+    return module.weight.register_post_accumulate_grad_hook(hook)
 
 
 def get_weights_for_dataloaders(dataloaders):
@@ -274,47 +315,22 @@ def get_next_dataloader(dataloader_iterators, weights):
 
 
 def find_and_remove_tokens(input_tensor, labels_tensor, attention_mask_tensor, token_id, tokenizer):
-    batch_size, seq_len = input_tensor.size()
+    """
+    Remove every `token_id` from a batch and left-align the remaining tokens, padding rows to the longest one.
 
-    # Create lists to store the new tensors
-    new_input_list = []
-    new_labels_list = []
-    new_attention_mask_list = []
-
-    # Loop over each sequence in the batch
-    for i in range(batch_size):
-        single_input = input_tensor[i, :]
-        single_label = labels_tensor[i, :]
-        single_attention_mask = attention_mask_tensor[i, :]
-
-        # Remove the token_id
-        new_single_input = torch.masked_select(single_input, single_input != token_id)
-        new_single_label = torch.masked_select(single_label, single_input != token_id)
-        new_single_attention_mask = torch.masked_select(single_attention_mask, single_input != token_id)
-
-        # Append the new sequence to the list
-        new_input_list.append(new_single_input)
-        new_labels_list.append(new_single_label)
-        new_attention_mask_list.append(new_single_attention_mask)
-
-    # Pad sequences within each batch to match the longest sequence
-    new_input = torch.nn.utils.rnn.pad_sequence(new_input_list, batch_first=True, padding_value=tokenizer.pad_token_id)
-    new_labels = torch.nn.utils.rnn.pad_sequence(new_labels_list, batch_first=True, padding_value=-100)
-    new_attention_mask = torch.nn.utils.rnn.pad_sequence(new_attention_mask_list, batch_first=True, padding_value=0)
-
-    return new_input, new_labels, new_attention_mask
-
-
-def delete_tensors_from_dict(d):
-    """Recursively delete tensors from a nested dictionary."""
-    keys_to_delete = []
-    for k, v in d.items():
-        if isinstance(v, torch.Tensor):
-            keys_to_delete.append(k)
-        elif isinstance(v, list):
-            new_list = [item for item in v if not isinstance(item, torch.Tensor)]
-            d[k] = new_list
-        elif isinstance(v, dict):
-            delete_tensors_from_dict(v)
-    for key in keys_to_delete:
-        del d[key]
+    All three tensors are compacted together with a single scatter: each kept token is sent to its rank among the kept tokens
+    of its row (a cumsum over the keep-mask), removed tokens go to a spare column that is sliced off.
+    """
+    batch_size, seq_len = input_tensor.size()
+    keep = input_tensor != token_id
+    positions = keep.cumsum(dim=1) - 1
+    new_len = int(positions[:, -1].max().item()) + 1 if seq_len > 0 else 0
+    target = torch.where(keep, positions, new_len)
+
+    stacked = torch.stack([input_tensor, labels_tensor.to(input_tensor.dtype), attention_mask_tensor.to(input_tensor.dtype)])
+    pad_values = torch.tensor([tokenizer.pad_token_id, -100, 0], dtype=input_tensor.dtype, device=input_tensor.device)
+    compacted = pad_values.view(3, 1, 1).repeat(1, batch_size, new_len + 1)
+    compacted.scatter_(2, target.unsqueeze(0).expand(3, -1, -1), stacked)
+    compacted = compacted[:, :, :new_len]
+
+    return compacted[0], compacted[1].to(labels_tensor.dtype), compacted[2].to(attention_mask_tensor.dtype)
@@ -0,0 +1,59 @@
+import argparse
+import sys
+import time
+from types import SimpleNamespace
+
+import torch
+
+sys.path.append("../..")
+from pipeline.train.train_utils import find_and_remove_tokens
+
+
+def loop_find_and_remove_tokens(input_tensor, labels_tensor, attention_mask_tensor, token_id, tokenizer):
+    """The previous per-row implementation, kept as the reference."""
+    keep = input_tensor != token_id
+    new_input = torch.nn.utils.rnn.pad_sequence([torch.masked_select(x, m) for x, m in zip(input_tensor, keep)], batch_first=True, padding_value=tokenizer.pad_token_id)
+    new_labels = torch.nn.utils.rnn.pad_sequence([torch.masked_select(x, m) for x, m in zip(labels_tensor, keep)], batch_first=True, padding_value=-100)
+    new_attention_mask = torch.nn.utils.rnn.pad_sequence([torch.masked_select(x, m) for x, m in zip(attention_mask_tensor, keep)], batch_first=True, padding_value=0)
+    return new_input, new_labels, new_attention_mask
+
+
+def make_batch(batch_size, seq_len, token_id, token_rate, device):
+    input_ids = torch.randint(0, 32000, (batch_size, seq_len), device=device)
+    input_ids[torch.rand(batch_size, seq_len, device=device) < token_rate] = token_id
+    labels = torch.where(torch.rand(batch_size, seq_len, device=device) < 0.5, input_ids, -100)
+    attention_mask = torch.ones_like(input_ids)
+    return input_ids, labels, attention_mask
+
+
+def benchmark(fn, batch, tokenizer, token_id, iters, device):
+    for _ in range(3):
+        fn(*batch, token_id, tokenizer)
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn(*batch, token_id, tokenizer)
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", type=str, default="1,8,32")
+    parser.add_argument("--seq_len", type=int, default=2048)
+    parser.add_argument("--token_rate", type=float, default=0.01, help="fraction of positions holding the removed token")
+    parser.add_argument("--iters", type=int, default=50)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    token_id = 50277
+    tokenizer = SimpleNamespace(pad_token_id=1)
+    for batch_size in map(int, args.batch_sizes.split(",")):
+        batch = make_batch(batch_size, args.seq_len, token_id, args.token_rate, args.device)
+        for expected, actual in zip(loop_find_and_remove_tokens(*batch, token_id, tokenizer), find_and_remove_tokens(*batch, token_id, tokenizer)):
+            assert torch.equal(expected, actual)
+        loop_ms = benchmark(loop_find_and_remove_tokens, batch, tokenizer, token_id, args.iters, args.device)
+        vectorized_ms = benchmark(find_and_remove_tokens, batch, tokenizer, token_id, args.iters, args.device)
+        print(f"batch {batch_size:>3} x {args.seq_len} on {args.device}: loop {loop_ms:.3f} ms, vectorized {vectorized_ms:.3f} ms ({loop_ms / vectorized_ms:.1f}x)")
@@ -0,0 +1,63 @@
+import argparse
+import sys
+import time
+
+import torch
+
+sys.path.append("../..")
+from otter_ai import OtterForConditionalGeneration
+from otter_ai.models.static_decoding import StaticDecoder
+
+
+def make_inputs(model, batch_size, prompt, device, dtype):
+    tokens = model.text_tokenizer([prompt] * batch_size, return_tensors="pt").to(device)
+    vision_x = torch.randn(batch_size, 1, 1, 3, 224, 224, device=device, dtype=dtype)
+    return vision_x, tokens["input_ids"], tokens["attention_mask"]
+
+
+def hf_generate(model, vision_x, lang_x, attention_mask, max_new_tokens):
+    # no early stop, every method generates the same number of tokens
+    return model.generate(vision_x=vision_x, lang_x=lang_x, attention_mask=attention_mask, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, num_beams=1, do_sample=False)
+
+
+def tokens_per_second(generate_fn, inputs, new_tokens, iters, device):
+    generate_fn(*inputs, max_new_tokens=new_tokens)
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        output = generate_fn(*inputs, max_new_tokens=new_tokens)
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    assert output.shape[1] == inputs[1].shape[1] + new_tokens
+    return inputs[1].shape[0] * new_tokens * iters / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", type=str, default="luodian/OTTER-Image-MPT7B")
+    parser.add_argument("--batch_sizes", type=str, default="1,8")
+    parser.add_argument("--new_tokens", type=int, default=128)
+    parser.add_argument("--prompt", type=str, default="<image>User: What is happening in this image? Describe it in detail. GPT:<answer>")
+    parser.add_argument("--precision", type=str, default="bf16", choices=["bf16", "fp16", "fp32"])
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    dtype = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}[args.precision]
+    model = OtterForConditionalGeneration.from_pretrained(args.model_path, torch_dtype=dtype, device_map={"": args.device}).eval()
+    model.text_tokenizer.padding_side = "left"
+    max_length = len(model.text_tokenizer(args.prompt)["input_ids"]) + args.new_tokens
+    methods = {
+        "generate": lambda *inputs, **kwargs: hf_generate(model, *inputs, **kwargs),
+        "static cache": StaticDecoder(model, max_length=max_length, use_cuda_graph=False).generate,
+    }
+    if args.device.startswith("cuda"):
+        methods["static cache + CUDA graph"] = StaticDecoder(model, max_length=max_length, use_cuda_graph=True).generate
+
+    for batch_size in map(int, args.batch_sizes.split(",")):
+        inputs = make_inputs(model, batch_size, args.prompt, args.device, dtype)
+        results = {name: tokens_per_second(fn, inputs, args.new_tokens, args.iters, args.device) for name, fn in methods.items()}
+        baseline = results["generate"]
+        summary = ", ".join(f"{name} {tps:.1f} tok/s ({tps / baseline:.2f}x)" for name, tps in results.items())
+        print(f"batch {batch_size:>2}, {args.new_tokens} new tokens on {args.device}: {summary}")
@@ -0,0 +1,110 @@
+import argparse
+import base64
+import json
+import os
+import sys
+from io import BytesIO
+
+import numpy as np
+import orjson
+import pandas as pd
+import pyarrow.parquet as pq
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+from torchvision import transforms
+from tqdm import tqdm
+from transformers import CLIPVisionConfig, CLIPVisionModel
+
+sys.path.append("../..")
+from pipeline.mimicit_utils.mimicit_dataset import FLAMINGO_MEAN, FLAMINGO_STD, VisionFeatureStore
+from src.otter_ai.models.delta_checkpoint import model_tensor_index, resolve_model_dir
+
+
+def load_images(images_path):
+    """Load a MIMIC-IT images file (id -> base64) the same way MimicitDataset does."""
+    if images_path.endswith(".parquet"):
+        return pd.concat([batch.to_pandas() for batch in pq.ParquetFile(images_path).iter_batches(batch_size=1000)])
+    with open(images_path, "rb") as f:
+        return pd.DataFrame(orjson.loads(f.read()))
+
+
+def load_vision_encoder(model_path):
+    """Only the CLIP vision tower of an Otter/Flamingo checkpoint, without instantiating the language model."""
+    model_dir = resolve_model_dir(model_path)
+    with open(os.path.join(model_dir, "config.json"), "r") as f:
+        vision_config = CLIPVisionConfig(**json.load(f)["vision_config"])
+    vision_encoder = CLIPVisionModel(vision_config)
+    prefix = "vision_encoder."
+    state_dict = {name[len(prefix) :]: load_tensor() for name, load_tensor in model_tensor_index(model_dir).items() if name.startswith(prefix)}
+    vision_encoder.load_state_dict(state_dict)
+    return vision_encoder
+
+
+class ImageDataset(Dataset):
+    def __init__(self, images, image_ids, patch_image_size):
+        self.images = images
+        self.image_ids = image_ids
+        # must match MimicitDataset.patch_resize_transform for otter
+        self.transform = transforms.Compose(
+            [
+                transforms.Resize((patch_image_size, patch_image_size), interpolation=transforms.InterpolationMode.BICUBIC),
+                transforms.ToTensor(),
+                transforms.Normalize(mean=FLAMINGO_MEAN, std=FLAMINGO_STD),
+            ]
+        )
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __getitem__(self, index):
+        image = Image.open(BytesIO(base64.urlsafe_b64decode(self.images.loc[self.image_ids[index]]["base64"]))).convert("RGB")
+        return self.transform(image)
+
+
+@torch.no_grad()
+def main(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    dtype = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}[args.precision]
+    vision_encoder = load_vision_encoder(args.model_path).to(args.device, dtype=dtype).eval()
+
+    images = load_images(args.images_path)
+    image_ids = list(images.index)
+    num_patches = (args.patch_image_size // vision_encoder.config.patch_size) ** 2
+    features = np.lib.format.open_memmap(
+        os.path.join(args.output_dir, VisionFeatureStore.FEATURES_FILE),
+        mode="w+",
+        dtype=np.float16,
+        shape=(len(image_ids) + 1, num_patches, vision_encoder.config.hidden_size),
+    )
+
+    def encode(pixel_values):
+        return vision_encoder(pixel_values.to(args.device, dtype=dtype, non_blocking=True))[0][:, 1:, :].to(torch.float16).cpu().numpy()
+
+    loader = DataLoader(ImageDataset(images, image_ids, args.patch_image_size), batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=True)
+    row = 0
+    for pixel_values in tqdm(loader, desc="Extracting vision features"):
+        features[row : row + len(pixel_values)] = encode(pixel_values)
+        row += len(pixel_values)
+    # text-only samples use an all-zero image
+    features[row] = encode(torch.zeros(1, 3, args.patch_image_size, args.patch_image_size))[0]
+    features.flush()
+
+    # written last, so a store without ids is an incomplete extraction
+    with open(os.path.join(args.output_dir, VisionFeatureStore.IDS_FILE), "wb") as f:
+        f.write(orjson.dumps(image_ids + [VisionFeatureStore.BLANK_IMAGE_ID]))
+    print(f"Saved features of {len(image_ids)} images to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images_path", type=str, required=True, help="MIMIC-IT images file (.parquet or .json) as used in the training yaml")
+    parser.add_argument("--model_path", type=str, required=True, help="Otter/Flamingo checkpoint whose frozen vision encoder is used for training")
+    parser.add_argument("--output_dir", type=str, required=True, help="pass it to --vision_features_path for training")
+    parser.add_argument("--patch_image_size", type=int, default=224)
+    parser.add_argument("--precision", type=str, default="fp16", choices=["fp16", "bf16", "fp32"])
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--device", type=str, default="cuda")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,93 @@
+import argparse
+import base64
+import io
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import braceexpand
+import webdataset as wds
+from PIL import Image
+from tqdm import tqdm
+
+Image.MAX_IMAGE_PIXELS = 1000000000
+IMAGE_KEYS = ("jpg", "jpeg", "png")
+
+
+def resize_image_bytes(rawbytes, max_side, quality):
+    """
+    Re-encode an image so that its longest side is at most `max_side` pixels. JPEG images are re-encoded at `quality`,
+    the others as (lossless) PNG, so that the payload still matches the key it is stored under.
+    """
+    image = Image.open(io.BytesIO(rawbytes))
+    if max(image.size) <= max_side:
+        return rawbytes
+    buffer = io.BytesIO()
+    if image.format == "JPEG":
+        image.draft("RGB", (max_side, max_side))
+        image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.BICUBIC)
+        image.save(buffer, format="JPEG", quality=quality)
+    else:
+        has_alpha = "A" in image.getbands() or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        image.thumbnail((max_side, max_side), Image.BICUBIC)
+        image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def resize_shard(shard, output_dir, max_side, quality, base64_keys):
+    output_path = os.path.join(output_dir, os.path.basename(shard))
+    num_samples = 0
+    with wds.TarWriter(output_path) as sink:
+        for sample in wds.WebDataset(shard, shardshuffle=False):
+            for key in IMAGE_KEYS:
+                if key not in sample:
+                    continue
+                try:
+                    if key in base64_keys:
+                        resized = resize_image_bytes(base64.b64decode(sample[key]), max_side, quality)
+                        sample[key] = base64.b64encode(resized)
+                    else:
+                        sample[key] = resize_image_bytes(sample[key], max_side, quality)
+                except Exception as e:
+                    print(f"Error resizing {sample['__key__']}.{key} in {shard}: {e}")
+            sample.pop("__url__", None)
+            sink.write(sample)
+            num_samples += 1
+    return shard, num_samples
+
+
+def main(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    shards = list(braceexpand.braceexpand(args.input_shards))
+    base64_keys = tuple(args.base64_keys.split(",")) if args.base64_keys else ()
+
+    with ProcessPoolExecutor(max_workers=args.mp_num) as executor:
+        tasks = [executor.submit(resize_shard, shard, args.output_dir, args.max_side, args.quality, base64_keys) for shard in shards]
+        for task in tqdm(tasks, desc="Resizing shards"):
+            shard, num_samples = task.result()
+            print(f"Resized {num_samples} samples from {shard}")
+
+    # sample counts are unchanged, so dataset size metadata can be carried over as is
+    input_dir = os.path.dirname(shards[0])
+    for meta_file in ("sizes.json", "__len__"):
+        if os.path.exists(os.path.join(input_dir, meta_file)):
+            shutil.copy(os.path.join(input_dir, meta_file), os.path.join(args.output_dir, meta_file))
+
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument(
+    "--input_shards",
+    type=str,
+    required=True,
+    help="Pass in a list of shards in the format path_to_shard/{000000000..000001000}.tar",
+)
+arg_parser.add_argument("--output_dir", type=str, required=True)
+arg_parser.add_argument("--max_side", type=int, default=448, help="Longest image side after resizing")
+arg_parser.add_argument("--quality", type=int, default=95, help="JPEG quality of re-encoded JPEG images, the others stay lossless PNG")
+arg_parser.add_argument("--base64_keys", type=str, default="", help="Comma separated image keys stored as base64, e.g. 'png' for LAION shards")
+arg_parser.add_argument("--mp_num", type=int, default=8, help="Number of processes")
+
+if __name__ == "__main__":
+    main(args=arg_parser.parse_args())
@@ -0,0 +1,335 @@
+"""Continuous batching for Otter generation.
+
+`ContinuousBatchingEngine` keeps a single running batch of sequences, each conditioned on its own images, and extends
+all of them by one token per step. Requests submitted in the meantime join the batch at the next step: they are
+prefilled together, then their cache, attention mask and media are padded and appended to the running ones, while the
+sequences that finished leave the batch. The model neither waits for the longest sequence of a batch nor serves the
+requests one at a time, and the tokens of each request are streamed to its `GenerationRequest` as they are generated.
+"""
+
+import queue
+import threading
+from typing import List, Optional, Tuple
+
+import torch
+from transformers import LogitsProcessorList, NoRepeatNGramLogitsProcessor, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+
+from .otter.modeling_otter import OtterGenerationState, OtterPrefixState
+
+
+def cache_seq_dims(lang_encoder) -> Tuple[int, int]:
+    """Sequence dimensions of the cached keys and values of `lang_encoder`."""
+    name = lang_encoder.__class__.__name__
+    if name == "LlamaForCausalLM":
+        return 2, 2
+    if name == "MPTForCausalLM":
+        # the torch attention caches the keys transposed, (B, h, d, S), the other implementations cache (B, S, h * d)
+        return (3, 2) if lang_encoder.config.attn_config["attn_impl"] == "torch" else (1, 1)
+    raise NotImplementedError(f"Continuous batching is not implemented for {name}.")
+
+
+def pad(x: torch.Tensor, length: int, dim: int, left: bool = True) -> torch.Tensor:
+    """Zero-pad `x` to `length` along `dim`, on the left or on the right."""
+    if x.shape[dim] == length:
+        return x
+    shape = list(x.shape)
+    shape[dim] = length - x.shape[dim]
+    padding = x.new_zeros(shape)
+    return torch.cat([padding, x] if left else [x, padding], dim=dim)
+
+
+class GenerationRequest:
+    """
+    A prompt submitted to a `ContinuousBatchingEngine`. Iterating over it yields the generated token ids as they come,
+    then raises the error that stopped the generation, if any.
+    """
+
+    def __init__(self, vision_x: torch.Tensor, lang_x: torch.LongTensor, max_new_tokens: int, eos_token_id: int, do_sample: bool, logits_processor: LogitsProcessorList):
+        self.vision_x = vision_x
+        self.lang_x = lang_x
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_id = eos_token_id
+        self.do_sample = do_sample
+        self.logits_processor = logits_processor
+        # the prompt followed by the generated tokens, as seen by the logits processors
+        self.output_ids = lang_x.cpu()
+        self.num_generated = 0
+        self.error = None
+        self.tokens = queue.Queue()
+
+    def put(self, token: int) -> bool:
+        """Stream a generated token, returns whether the request is finished."""
+        self.output_ids = torch.cat([self.output_ids, torch.tensor([[token]])], dim=1)
+        self.num_generated += 1
+        self.tokens.put(token)
+        finished = token == self.eos_token_id or self.num_generated == self.max_new_tokens
+        if finished:
+            self.finish()
+        return finished
+
+    def finish(self, error: Optional[Exception] = None) -> None:
+        self.error = error
+        self.tokens.put(None)
+
+    def __iter__(self):
+        while True:
+            token = self.tokens.get()
+            if token is None:
+                break
+            yield token
+        if self.error is not None:
+            raise self.error
+
+
+class ContinuousBatchingEngine:
+    """
+    Generation for many concurrent requests, see the module docstring. Drive it with `step`, or run it in a background
+    thread with `start`, and `submit` the requests from any thread.
+
+    Args:
+        model: an `OtterForConditionalGeneration` whose language model is Llama or MPT
+        max_batch_size: largest number of sequences generated together, later requests wait for a sequence to finish
+    """
+
+    def __init__(self, model, max_batch_size: int = 8):
+        self.model = model
+        self.lang_encoder = model.lang_encoder
+        self.max_batch_size = max_batch_size
+        self.cache_seq_dims = cache_seq_dims(self.lang_encoder)
+        # MPT has no positions beyond max_seq_len, which bounds the padded length of the running batch
+        self.max_length = getattr(self.lang_encoder.config, "max_seq_len", None)
+        self.xattn_layers = [layer for layer in self.lang_encoder._get_decoder_layers() if layer.gated_cross_attn_layer is not None]
+        self.waiting = queue.Queue()
+        # requests taken from `waiting` that did not fit in the running batch yet
+        self.pending: List[GenerationRequest] = []
+        self.requests: List[GenerationRequest] = []
+        # the running batch, one row per request
+        self.state: Optional[OtterPrefixState] = None
+        # for each cross-attention layer, the keys and values of the media of every row
+        self.media_kv = None
+        self.stopping = False
+        self.thread = None
+
+    def submit(
+        self,
+        vision_x: torch.Tensor,
+        lang_x: torch.LongTensor,
+        max_new_tokens: int = 512,
+        eos_token_id: Optional[int] = None,
+        do_sample: bool = False,
+        temperature: float = 1.0,
+        top_k: int = 50,
+        top_p: float = 1.0,
+        no_repeat_ngram_size: int = 0,
+    ) -> GenerationRequest:
+        """
+        Queue a prompt, which joins the running batch at the next step.
+
+        Args:
+            vision_x (torch.Tensor): images of the prompt, see `OtterForConditionalGeneration._encode_vision_x`
+                shape (1, T_img, F, C, H, W) or (1, T_img, F, v, d)
+            lang_x (torch.LongTensor): the prompt, without padding
+                shape (1, T_txt)
+            max_new_tokens (int): maximum number of generated tokens
+            eos_token_id (int, optional): the request finishes after generating it, `<|endofchunk|>` by default
+            do_sample (bool): sample the tokens instead of taking the most likely one
+            temperature, top_k, top_p (optional): sampling parameters, as taken by `generate`
+            no_repeat_ngram_size (int): never repeat n-grams of that size, as in `generate`
+        Returns:
+            GenerationRequest: iterate over it for the generated tokens
+        """
+        if vision_x is None:
+            raise ValueError("Otter prompts need images.")
+        if vision_x.shape[0] != 1 or lang_x.shape[0] != 1:
+            raise ValueError("Submit one prompt at a time.")
+        if self.max_length is not None and lang_x.shape[1] + max_new_tokens > self.max_length:
+            raise ValueError(f"{lang_x.shape[1]} prompt tokens + {max_new_tokens} new tokens exceed max_seq_len={self.max_length}.")
+        logits_processor = LogitsProcessorList()
+        if no_repeat_ngram_size > 0:
+            logits_processor.append(NoRepeatNGramLogitsProcessor(no_repeat_ngram_size))
+        if do_sample:
+            if temperature != 1.0:
+                logits_processor.append(TemperatureLogitsWarper(temperature))
+            if top_k > 0:
+                logits_processor.append(TopKLogitsWarper(top_k))
+            if top_p < 1.0:
+                logits_processor.append(TopPLogitsWarper(top_p))
+        eos_token_id = self.model.eoc_token_id if eos_token_id is None else eos_token_id
+        request = GenerationRequest(vision_x, lang_x, max_new_tokens, eos_token_id, do_sample, logits_processor)
+        self.waiting.put(request)
+        return request
+
+    def start(self) -> "ContinuousBatchingEngine":
+        """Run the engine in a background thread, which sleeps while there is no request."""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop the background thread once the requests submitted so far are finished."""
+        self.waiting.put(None)
+        if self.thread is not None:
+            self.thread.join()
+
+    def serve_forever(self) -> None:
+        while not self.stopping or self.requests or self.pending:
+            try:
+                self.step(block=True)
+            except Exception as error:
+                # the running batch cannot be continued, fail its requests and go on with the next ones
+                for request in self.requests:
+                    request.finish(error)
+                self.requests = []
+                self.reset()
+
+    @torch.no_grad()
+    def step(self, block: bool = False) -> bool:
+        """
+        Admit the waiting requests the batch has room for, then generate one token for every running sequence and drop
+        the finished ones. With `block`, wait for a request if there is none.
+
+        Returns:
+            bool: whether any request is still running or waiting
+        """
+        self.take_waiting(block)
+        self.admit()
+        if self.requests:
+            self.decode()
+        return bool(self.requests or self.pending or not self.waiting.empty())
+
+    def take_waiting(self, block: bool) -> None:
+        while not self.stopping and len(self.requests) + len(self.pending) < self.max_batch_size:
+            try:
+                request = self.waiting.get(block=block and not (self.requests or self.pending))
+            except queue.Empty:
+                break
+            if request is None:
+                self.stopping = True
+            else:
+                self.pending.append(request)
+
+    def admit(self) -> None:
+        # requests are admitted in order, as long as the padded batch keeps within max_length until all of it finishes
+        length = self.state.attention_mask.shape[1] if self.state is not None else 0
+        remaining = max((r.max_new_tokens - r.num_generated for r in self.requests), default=0)
+        admitted = []
+        for request in self.pending:
+            new_length, new_remaining = max(length, request.lang_x.shape[1]), max(remaining, request.max_new_tokens)
+            if self.max_length is not None and new_length + new_remaining > self.max_length:
+                break
+            length, remaining = new_length, new_remaining
+            admitted.append(request)
+        self.pending = self.pending[len(admitted) :]
+
+        # prompts whose images have the same frames are prefilled together, their images packed
+        groups = {}
+        for request in admitted:
+            groups.setdefault(tuple(request.vision_x.shape[2:]), []).append(request)
+        for group in groups.values():
+            try:
+                state = self.prefill(group)
+            except Exception as error:
+                for request in group:
+                    request.finish(error)
+                continue
+            self.merge(group, state)
+
+    def prefill(self, requests: List[GenerationRequest]) -> OtterPrefixState:
+        prompts = [request.lang_x[0] for request in requests]
+        length = max(len(prompt) for prompt in prompts)
+        lang_x = torch.stack([pad(prompt, length, dim=0) for prompt in prompts])
+        attention_mask = torch.stack([pad(torch.ones_like(prompt), length, dim=0) for prompt in prompts])
+        vision_x = torch.cat([request.vision_x[0] for request in requests])
+        num_images = torch.tensor([request.vision_x.shape[1] for request in requests], device=vision_x.device)
+        return self.model.prefill(vision_x, lang_x, attention_mask, num_images=num_images)
+
+    def merge(self, requests: List[GenerationRequest], state: OtterPrefixState) -> None:
+        """Append the prefilled `requests` to the running batch."""
+        media_kv = [layer.gated_cross_attn_layer.attn.project_media(state.vision_x) for layer in self.xattn_layers]
+        if self.state is None:
+            self.requests, self.state, self.media_kv = requests, state, media_kv
+            return
+
+        # the caches and attention masks are padded on the left, the media on the right (padding media are never attended)
+        length = max(self.state.attention_mask.shape[1], state.attention_mask.shape[1])
+        num_media = max(self.state.vision_x.shape[1], state.vision_x.shape[1])
+        k_dim, v_dim = self.cache_seq_dims
+        self.state = OtterPrefixState(
+            vision_x=torch.cat([pad(s.vision_x, num_media, dim=1, left=False) for s in (self.state, state)]),
+            past_key_values=[
+                (torch.cat([pad(k, length, k_dim) for k in (k_run, k_new)]), torch.cat([pad(v, length, v_dim) for v in (v_run, v_new)])) for (k_run, v_run), (k_new, v_new) in zip(self.state.past_key_values, state.past_key_values)
+            ],
+            attention_mask=torch.cat([pad(s.attention_mask, length, dim=1) for s in (self.state, state)]),
+            logits=torch.cat([self.state.logits, state.logits]),
+            generation_state=OtterGenerationState.cat([self.state.generation_state, state.generation_state]),
+        )
+        kv_length = self.state.vision_x.shape[1] * self.state.vision_x.shape[2]
+        self.media_kv = [tuple(torch.cat([pad(t_run, kv_length, dim=1, left=False), pad(t_new, kv_length, dim=1, left=False)]) for t_run, t_new in zip(kv_run, kv_new)) for kv_run, kv_new in zip(self.media_kv, media_kv)]
+        self.requests = self.requests + requests
+
+    def decode(self) -> None:
+        tokens = self.sample()
+        keep = [row for row, (request, token) in enumerate(zip(self.requests, tokens.tolist())) if not request.put(token)]
+        if not keep:
+            self.requests = []
+            self.reset()
+            return
+        if len(keep) < len(self.requests):
+            index = torch.tensor(keep, device=tokens.device)
+            self.evict(keep, index)
+            tokens = tokens.index_select(0, index)
+        self.forward(tokens)
+
+    def sample(self) -> torch.LongTensor:
+        logits = self.state.logits
+        next_tokens = logits.argmax(dim=-1)
+        for row, request in enumerate(self.requests):
+            if request.do_sample or request.logits_processor:
+                scores = request.logits_processor(request.output_ids, logits[row : row + 1].float())
+                next_tokens[row] = torch.multinomial(scores.softmax(dim=-1), num_samples=1)[0, 0] if request.do_sample else scores.argmax(dim=-1)[0]
+        return next_tokens
+
+    def evict(self, keep: List[int], index: torch.LongTensor) -> None:
+        """Keep the rows `keep` of the running batch."""
+        self.requests = [self.requests[row] for row in keep]
+        attention_mask = self.state.attention_mask.index_select(0, index)
+        # drop the columns that only hold padding now
+        start = int((attention_mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+        k_dim, v_dim = self.cache_seq_dims
+        self.state = OtterPrefixState(
+            vision_x=self.state.vision_x.index_select(0, index),
+            past_key_values=[(k.index_select(0, index).narrow(k_dim, start, k.shape[k_dim] - start), v.index_select(0, index).narrow(v_dim, start, v.shape[v_dim] - start)) for k, v in self.state.past_key_values],
+            attention_mask=attention_mask[:, start:],
+            logits=self.state.logits.index_select(0, index),
+            generation_state=self.state.generation_state.index_select(index),
+        )
+        self.media_kv = [tuple(t.index_select(0, index) for t in kv) for kv in self.media_kv]
+
+    def forward(self, tokens: torch.LongTensor) -> None:
+        """Run the running batch over its next tokens (B,)."""
+        attention_mask = torch.cat([self.state.attention_mask, self.state.attention_mask.new_ones(len(tokens), 1)], dim=1)
+        for layer in self.lang_encoder._get_decoder_layers():
+            layer.condition_vis_x(self.state.vision_x)
+        for layer, media_kv in zip(self.xattn_layers, self.media_kv):
+            layer.condition_media_kv(media_kv)
+        generation_state = self.state.generation_state.fork()
+        self.lang_encoder.generation_state = generation_state
+        output = self.lang_encoder(
+            input_ids=tokens[:, None],
+            attention_mask=attention_mask,
+            past_key_values=self.state.past_key_values,
+            use_cache=True,
+            **self.model._position_kwargs(attention_mask, 1),
+        )
+        self.state = OtterPrefixState(
+            vision_x=self.state.vision_x,
+            past_key_values=list(output.past_key_values),
+            attention_mask=attention_mask,
+            logits=output.logits[:, -1],
+            generation_state=generation_state,
+        )
+
+    def reset(self) -> None:
+        self.state = None
+        self.media_kv = None
+        self.lang_encoder.clear_conditioned_layers()
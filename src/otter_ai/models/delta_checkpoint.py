@@ -0,0 +1,234 @@
+"""Delta checkpoints: only the tensors a fine-tune changed (perceiver, gated cross-attention, optionally embeddings), stored as
+safetensors together with a fingerprint of the base model they were trained from.
+
+A fine-tuned variant is served by loading the base model once (`from_pretrained` memory-maps its safetensors) and overlaying
+the delta in place with `DeltaOverlay`; switching to another variant only restores and copies the overlaid tensors.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import struct
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+DELTA_FORMAT = "otter_delta_v1"
+WEIGHT_PATTERNS = ("*.safetensors", "*.bin")
+# bytes of each tensor (64x that of each pickled file) hashed by `base_model_hash`, in blocks spread over its data
+SAMPLE_BYTES = 1 << 16
+SAMPLE_BLOCKS = 16
+
+
+def resolve_model_dir(name_or_path, local_files_only=False):
+    """Local directory of a model given either a path or a huggingface hub id (uses the hub cache)."""
+    if os.path.isdir(name_or_path):
+        return name_or_path
+    from huggingface_hub import snapshot_download
+
+    # only fetch the pickled weights when the repo has no safetensors, instead of downloading both formats
+    for pattern in WEIGHT_PATTERNS:
+        model_dir = snapshot_download(name_or_path, allow_patterns=["*.json", pattern], local_files_only=local_files_only)
+        if glob.glob(os.path.join(model_dir, pattern)):
+            return model_dir
+    return model_dir
+
+
+def weight_files(model_dir):
+    for pattern in WEIGHT_PATTERNS:
+        files = sorted(glob.glob(os.path.join(model_dir, pattern)))
+        if files:
+            return files
+    raise FileNotFoundError(f"No weight files found in {model_dir}")
+
+
+def hash_sample(sha, f, start, end, sample_bytes=SAMPLE_BYTES, num_blocks=SAMPLE_BLOCKS):
+    """Hash the bytes in [start, end) of `f`, all of them up to `sample_bytes` and otherwise `num_blocks` evenly spaced blocks."""
+    if end - start <= sample_bytes:
+        f.seek(start)
+        sha.update(f.read(end - start))
+        return
+    block_size = sample_bytes // num_blocks
+    stride = (end - start - block_size) / (num_blocks - 1)
+    for i in range(num_blocks):
+        f.seek(start + int(i * stride))
+        sha.update(f.read(block_size))
+
+
+def base_model_hash(name_or_path, local_files_only=False):
+    """
+    Fingerprint of a model's weight files that is cheap enough to compute at every load.
+
+    Hashes each file's name and size plus, for safetensors, its header (names, dtypes, shapes and offsets of every tensor) and
+    a strided sample of every tensor's data, and for other formats a strided sample of the whole file, so that checkpoints of
+    the same architecture with different weights get different hashes.
+    """
+    sha = hashlib.sha256()
+    for path in weight_files(resolve_model_dir(name_or_path, local_files_only=local_files_only)):
+        size = os.path.getsize(path)
+        sha.update(f"{os.path.basename(path)}:{size}".encode())
+        with open(path, "rb") as f:
+            if path.endswith(".safetensors"):
+                (header_size,) = struct.unpack("<Q", f.read(8))
+                header = f.read(header_size)
+                sha.update(header)
+                data_start = 8 + header_size
+                for name, info in sorted(json.loads(header).items()):
+                    if name != "__metadata__":
+                        start, end = info["data_offsets"]
+                        hash_sample(sha, f, data_start + start, data_start + end)
+            else:
+                hash_sample(sha, f, 0, size, sample_bytes=SAMPLE_BYTES * 64, num_blocks=SAMPLE_BLOCKS * 64)
+    return sha.hexdigest()
+
+
+def delta_metadata(base_model_name_or_path, local_files_only=False):
+    return {
+        "format": "pt",
+        "delta_format": DELTA_FORMAT,
+        "base_model": base_model_name_or_path,
+        "base_model_hash": base_model_hash(base_model_name_or_path, local_files_only=local_files_only),
+    }
+
+
+def save_delta(state_dict, path, base_model_name_or_path, local_files_only=False):
+    """Write `state_dict` (the trainable or otherwise changed tensors) as a delta against the given base model."""
+    tensors = {name: tensor.detach().to("cpu", copy=True).contiguous() for name, tensor in state_dict.items()}
+    save_file(tensors, path, metadata=delta_metadata(base_model_name_or_path, local_files_only=local_files_only))
+
+
+def delta_files(path):
+    """Safetensors files of a delta given either a single file or a sharded `.safetensors.index.json`."""
+    if path.endswith(".index.json"):
+        with open(path, "r") as f:
+            shards = sorted(set(json.load(f)["weight_map"].values()))
+        return [os.path.join(os.path.dirname(path), shard) for shard in shards]
+    return [path]
+
+
+def read_delta_metadata(path):
+    with safe_open(delta_files(path)[0], framework="pt") as f:
+        return f.metadata() or {}
+
+
+def iter_delta(path, device="cpu"):
+    """Yield (name, tensor) pairs of a delta, memory-mapped and materialized directly on `device`."""
+    for shard in delta_files(path):
+        with safe_open(shard, framework="pt", device=str(device)) as f:
+            for name in f.keys():
+                yield name, f.get_tensor(name)
+
+
+def file_tensor_index(path):
+    """Map every tensor name of a weight file to a zero-argument loader, without reading any tensor data."""
+    index = {}
+    if path.endswith(".safetensors"):
+        handle = safe_open(path, framework="pt")
+        for name in handle.keys():
+            index[name] = lambda handle=handle, name=name: handle.get_tensor(name)
+    else:
+        for name, tensor in torch.load(path, map_location="cpu", mmap=True).items():
+            index[name] = lambda tensor=tensor: tensor
+    return index
+
+
+def model_tensor_index(model_dir):
+    index = {}
+    for path in weight_files(model_dir):
+        index.update(file_tensor_index(path))
+    return index
+
+
+def make_delta(base_model_name_or_path, finetuned_name_or_path, output_path, local_files_only=False):
+    """Extract the tensors that differ between a full fine-tuned checkpoint and its base model into a delta file."""
+    base_index = model_tensor_index(resolve_model_dir(base_model_name_or_path, local_files_only=local_files_only))
+    finetuned_index = model_tensor_index(resolve_model_dir(finetuned_name_or_path, local_files_only=local_files_only))
+
+    delta = {}
+    for name, load_tensor in finetuned_index.items():
+        tensor = load_tensor()
+        base = base_index[name]() if name in base_index else None
+        if base is None or base.shape != tensor.shape or not torch.equal(base.to(tensor.dtype), tensor):
+            delta[name] = tensor
+    save_delta(delta, output_path, base_model_name_or_path, local_files_only=local_files_only)
+    return list(delta)
+
+
+class DeltaOverlay:
+    """
+    Applies delta checkpoints in place on top of a loaded base model.
+
+    The base values of every overlaid tensor are kept on their device, so `apply` can switch between fine-tuned variants and
+    `reset` can return to the base model without touching any other weight.
+    """
+
+    def __init__(self, model, base_model_name_or_path=None, local_files_only=False):
+        self.model = model
+        self.base_model_name_or_path = base_model_name_or_path
+        self.local_files_only = local_files_only
+        self._base_hash = None
+        self.base_tensors = {}
+        self.delta_path = None
+
+    @property
+    def base_hash(self):
+        if self._base_hash is None and self.base_model_name_or_path is not None:
+            self._base_hash = base_model_hash(self.base_model_name_or_path, local_files_only=self.local_files_only)
+        return self._base_hash
+
+    def check_base(self, path):
+        metadata = read_delta_metadata(path)
+        if metadata.get("delta_format") != DELTA_FORMAT:
+            raise ValueError(f"{path} is not a delta checkpoint (missing delta_format metadata)")
+        if self.base_hash is not None and metadata["base_model_hash"] != self.base_hash:
+            raise ValueError(f"Delta {path} was trained from {metadata['base_model']}, which does not match the loaded base model {self.base_model_name_or_path}")
+
+    @torch.no_grad()
+    def reset(self):
+        targets = self.model.state_dict(keep_vars=True)
+        for name, tensor in self.base_tensors.items():
+            targets[name].data.copy_(tensor)
+        self.base_tensors = {}
+        self.delta_path = None
+
+    @torch.no_grad()
+    def apply(self, path, check_base=True):
+        """Overlay the delta at `path`, undoing the previously applied one first. Returns the overlaid tensor names."""
+        if check_base:
+            self.check_base(path)
+        self.reset()
+
+        targets = self.model.state_dict(keep_vars=True)
+        for name, tensor in iter_delta(path):
+            if name not in targets:
+                raise KeyError(f"Delta tensor {name} does not exist in {self.model.__class__.__name__}")
+            target = targets[name].data
+            if target.shape != tensor.shape:
+                raise ValueError(f"Delta tensor {name} has shape {tuple(tensor.shape)}, expected {tuple(target.shape)}")
+            self.base_tensors[name] = target.clone()
+            target.copy_(tensor.to(device=target.device, dtype=target.dtype, non_blocking=True))
+        self.delta_path = path
+        return list(self.base_tensors)
+
+
+def from_pretrained_with_delta(model_cls, base_model_name_or_path, delta_path=None, **kwargs):
+    """Load `base_model_name_or_path` with `model_cls.from_pretrained(**kwargs)` and overlay `delta_path` if given."""
+    model = model_cls.from_pretrained(base_model_name_or_path, **kwargs)
+    overlay = DeltaOverlay(model, base_model_name_or_path, local_files_only=kwargs.get("local_files_only", False))
+    if delta_path is not None:
+        overlay.apply(delta_path)
+    return model, overlay
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract a delta checkpoint from a full fine-tuned checkpoint.")
+    parser.add_argument("--base", type=str, required=True, help="Path or hub id of the base model, e.g. luodian/OTTER-MPT7B-Init")
+    parser.add_argument("--finetuned", type=str, required=True, help="Path or hub id of the fine-tuned model")
+    parser.add_argument("--output", type=str, required=True, help="Output .safetensors file")
+    parser.add_argument("--local_files_only", action="store_true")
+    args = parser.parse_args()
+    names = make_delta(args.base, args.finetuned, args.output, local_files_only=args.local_files_only)
+    print(f"Saved {len(names)} changed tensors to {args.output}")
@@ -0,0 +1,185 @@
+"""Fast model loading for serving and evaluation.
+
+`fast_from_pretrained` builds the model on the meta device and fills it from a fused safetensors checkpoint that is already in
+the target dtype (base weights with an optional trained checkpoint merged in). Tensors are memory-mapped and copied straight to
+the target device, so no CPU fp32 copy of the model is ever materialized. The fused checkpoint is converted once and cached
+under a sha256 of the source files' contents.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+
+import torch
+from accelerate import init_empty_weights
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from .delta_checkpoint import DeltaOverlay, file_tensor_index, resolve_model_dir, weight_files
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "otter_ai", "fused")
+# sha256 of every source file, keyed by path, size and mtime, so that unchanged files are only hashed once
+DIGESTS_FILE = "digests.json"
+# the fingerprint a fused checkpoint was built for, checked before it is reused
+FINGERPRINT_FILE = "fingerprint.txt"
+
+
+def load_trained_checkpoint(checkpoint_path):
+    """Trainable weights saved by the training scripts (`final_weights.pt` / `checkpoint_*.pt`), memory-mapped."""
+    checkpoint = torch.load(checkpoint_path, map_location="cpu", mmap=True)
+    if "model_state_dict" in checkpoint:
+        checkpoint = {k.replace("module.", ""): v for k, v in checkpoint["model_state_dict"].items()}
+    return checkpoint
+
+
+def file_sha256(path, chunk_size=1 << 24):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def content_fingerprint(paths, cache_dir):
+    """sha256 over the contents of `paths`, with the per-file digests kept in a sidecar of `cache_dir`."""
+    digests_path = os.path.join(cache_dir, DIGESTS_FILE)
+    try:
+        with open(digests_path, "r") as f:
+            digests = json.load(f)
+    except (OSError, ValueError):
+        digests = {}
+
+    sha, updated = hashlib.sha256(), False
+    for path in paths:
+        # hub snapshots are symlinks to the blobs
+        real_path = os.path.realpath(path)
+        stat = os.stat(real_path)
+        entry = digests.get(real_path)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            entry = digests[real_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_sha256(real_path)}
+            updated = True
+        sha.update(f"{os.path.basename(path)}:{entry['sha256']}".encode())
+
+    if updated:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{digests_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(digests, f)
+        os.replace(tmp_path, digests_path)
+    return sha.hexdigest()
+
+
+def fused_checkpoint_dir(model_dir, torch_dtype, checkpoint_path=None, cache_dir=None):
+    """Cache directory of a fused checkpoint and the fingerprint (contents of its sources and dtype) it must be built for."""
+    cache_dir = cache_dir or os.environ.get("OTTER_FUSED_CACHE", DEFAULT_CACHE_DIR)
+    sources = weight_files(model_dir) + ([checkpoint_path] if checkpoint_path is not None else [])
+    fingerprint = f"{content_fingerprint(sources, cache_dir)}:{torch_dtype}"
+    return os.path.join(cache_dir, hashlib.sha256(fingerprint.encode()).hexdigest()[:32]), fingerprint
+
+
+def read_fingerprint(fused_dir):
+    try:
+        with open(os.path.join(fused_dir, FINGERPRINT_FILE), "r") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def cast_tensor(tensor, torch_dtype):
+    # copy=True also unties tensors sharing storage in pickled checkpoints, which safetensors refuses to serialize
+    if tensor.is_floating_point():
+        return tensor.to(dtype=torch_dtype, copy=True).contiguous()
+    return tensor.to(copy=True).contiguous()
+
+
+def build_fused_checkpoint(model_dir, output_dir, torch_dtype, fingerprint, checkpoint_path=None):
+    """Convert a model's weights (one shard per source file) to `torch_dtype`, with `checkpoint_path` merged in."""
+    overrides = load_trained_checkpoint(checkpoint_path) if checkpoint_path is not None else {}
+    tmp_dir = f"{output_dir}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_dir)
+
+    source_files = weight_files(model_dir)
+    for i, path in enumerate(source_files):
+        shard = {}
+        for name, load_tensor in file_tensor_index(path).items():
+            shard[name] = cast_tensor(overrides.pop(name) if name in overrides else load_tensor(), torch_dtype)
+        save_file(shard, os.path.join(tmp_dir, f"model-{i:05d}.safetensors"), metadata={"format": "pt"})
+        del shard
+    if overrides:
+        save_file({name: cast_tensor(tensor, torch_dtype) for name, tensor in overrides.items()}, os.path.join(tmp_dir, f"model-{len(source_files):05d}.safetensors"), metadata={"format": "pt"})
+    with open(os.path.join(tmp_dir, FINGERPRINT_FILE), "w") as f:
+        f.write(fingerprint)
+
+    # another worker may have finished the same conversion in the meantime
+    try:
+        os.rename(tmp_dir, output_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+@contextmanager
+def default_dtype(torch_dtype):
+    previous = torch.get_default_dtype()
+    torch.set_default_dtype(torch_dtype)
+    try:
+        yield
+    finally:
+        torch.set_default_dtype(previous)
+
+
+def assign_tensor(model, name, tensor):
+    module_name, _, attr = name.rpartition(".")
+    module = model.get_submodule(module_name)
+    if attr in module._parameters:
+        module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+    elif attr in module._buffers:
+        module._buffers[attr] = tensor
+    else:
+        raise KeyError(f"{name} is neither a parameter nor a buffer of {model.__class__.__name__}")
+
+
+@torch.no_grad()
+def fast_from_pretrained(model_cls, name_or_path, device="cuda", torch_dtype=torch.bfloat16, checkpoint_path=None, delta_path=None, cache_dir=None, local_files_only=False):
+    """
+    Load `model_cls` from `name_or_path` directly onto `device` in `torch_dtype` for inference.
+
+    `checkpoint_path` (a training `.pt` checkpoint) is merged into the cached fused weights, `delta_path` is overlaid after
+    loading. Returns the model and the `DeltaOverlay` used to swap deltas later, like `from_pretrained_with_delta`.
+    """
+    model_dir = resolve_model_dir(name_or_path, local_files_only=local_files_only)
+    fused_dir, fingerprint = fused_checkpoint_dir(model_dir, torch_dtype, checkpoint_path=checkpoint_path, cache_dir=cache_dir)
+    if read_fingerprint(fused_dir) != fingerprint:
+        if os.path.isdir(fused_dir):
+            # e.g. built before fingerprints were recorded
+            print(f"Removing stale fused checkpoint {fused_dir}")
+            shutil.rmtree(fused_dir, ignore_errors=True)
+        print(f"Converting {name_or_path} to a fused {torch_dtype} checkpoint at {fused_dir}")
+        os.makedirs(os.path.dirname(fused_dir), exist_ok=True)
+        build_fused_checkpoint(model_dir, fused_dir, torch_dtype, fingerprint, checkpoint_path=checkpoint_path)
+
+    config = model_cls.config_class.from_pretrained(model_dir)
+    with init_empty_weights(), default_dtype(torch_dtype):
+        model = model_cls(config)
+
+    expected = model.state_dict(keep_vars=True)
+    for shard in weight_files(fused_dir):
+        with safe_open(shard, framework="pt", device=str(device)) as f:
+            for name in f.keys():
+                if name in expected:
+                    assign_tensor(model, name, f.get_tensor(name))
+
+    model.tie_weights()
+    missing = [name for name, tensor in model.state_dict(keep_vars=True).items() if tensor.is_meta]
+    if missing:
+        raise ValueError(f"Weights missing from {name_or_path}: {missing[:10]}{' ...' if len(missing) > 10 else ''}")
+    # non-persistent buffers were created on the CPU at init
+    model.to(device)
+    model.eval()
+
+    overlay = DeltaOverlay(model, model_dir, local_files_only=local_files_only)
+    if delta_path is not None:
+        overlay.apply(delta_path)
+    return model, overlay
@@ -1,6 +1,6 @@
 import random
 from dataclasses import dataclass
-from typing import Callable, Optional
+from typing import Callable, Optional, Tuple
 
 import torch
 import torch.nn as nn
@@ -80,10 +80,35 @@ def setattr_recursive(obj, att, val):
     setattr(obj, att.split(".")[-1], val)
 
 
+# fused attention kernels (flash / memory-efficient / math) through `torch.nn.functional.scaled_dot_product_attention`
+SDPA_AVAIL = hasattr(nn.functional, "scaled_dot_product_attention")
+
+
 def exists(val):
     return val is not None
 
 
+def repeat_batch(x: torch.Tensor, repeats: int) -> torch.Tensor:
+    """`x.repeat_interleave(repeats, dim=0)`, as a view when the batch holds a single element."""
+    if repeats == 1:
+        return x
+    if x.shape[0] == 1:
+        return x.expand(repeats, *x.shape[1:])
+    return x.repeat_interleave(repeats, dim=0)
+
+
+def unpack_media(media: torch.Tensor, num_images: torch.LongTensor) -> torch.Tensor:
+    """
+    Scatter the packed media (N, ...) of all samples into (B, T_img, ...), T_img being the largest image count (at
+    least 1), zero-filled after the last image of each sample.
+    """
+    T_img = max(int(num_images.max()), 1)
+    is_image = torch.arange(T_img, device=media.device) < rearrange(num_images.to(media.device), "b -> b 1")
+    unpacked = media.new_zeros(num_images.shape[0], T_img, *media.shape[1:])
+    unpacked[is_image] = media
+    return unpacked
+
+
 class FlamingoPerceiverBlock(nn.Module):
     def __init__(self, *, dim: int, dim_head: int = 64, heads: int = 8, mult: int = 4):
         super().__init__()
@@ -97,6 +122,7 @@ class FlamingoPerceiverBlock(nn.Module):
         self.to_q = nn.Linear(dim, inner_dim, bias=False)
         self.to_kv = nn.Linear(dim, inner_dim * 2, bias=False)
         self.to_out = nn.Linear(inner_dim, dim, bias=False)
+        self.use_sdpa = SDPA_AVAIL
         self.feed_forward = nn.ModuleList(
             [
                 nn.LayerNorm(dim),
@@ -123,18 +149,24 @@ class FlamingoPerceiverBlock(nn.Module):
         q = self.to_q(latents)
         kv_input = torch.cat((x, latents), dim=-2)
         k, v = self.to_kv(kv_input).chunk(2, dim=-1)
-        q = rearrange(q, "b t n (h d) -> b h t n d", h=h)
-        k = rearrange(k, "b t n (h d) -> b h t n d", h=h)
-        v = rearrange(v, "b t n (h d) -> b h t n d", h=h)
-        q = q * self.scale
-
-        # attention
-        sim = torch.einsum("... i d, ... j d  -> ... i j", q, k)
-        sim = sim - sim.amax(dim=-1, keepdim=True).detach()
-        attn = sim.softmax(dim=-1)
-
-        out = torch.einsum("... i j, ... j d -> ... i d", attn, v)
-        out = rearrange(out, "b h t n d -> b t n (h d)", h=h)
+        if self.use_sdpa:
+            # the default scale of scaled_dot_product_attention is dim_head**-0.5
+            q, k, v = (rearrange(t, "b t n (h d) -> (b t) h n d", h=h) for t in (q, k, v))
+            out = nn.functional.scaled_dot_product_attention(q, k, v)
+            out = rearrange(out, "(b t) h n d -> b t n (h d)", t=latents.shape[1])
+        else:
+            q = rearrange(q, "b t n (h d) -> b h t n d", h=h)
+            k = rearrange(k, "b t n (h d) -> b h t n d", h=h)
+            v = rearrange(v, "b t n (h d) -> b h t n d", h=h)
+            q = q * self.scale
+
+            # attention
+            sim = torch.einsum("... i d, ... j d  -> ... i j", q, k)
+            sim = sim - sim.amax(dim=-1, keepdim=True).detach()
+            attn = sim.softmax(dim=-1)
+
+            out = torch.einsum("... i j, ... j d -> ... i d", attn, v)
+            out = rearrange(out, "b h t n d -> b t n (h d)", h=h)
         out = self.to_out(out) + residual_latents
         residual_out = out
         for layer in self.feed_forward:
@@ -217,6 +249,7 @@ class FlamingoMaskedCrossAttention(nn.Module):
 
         # whether for text to only attend to immediate preceding image, or all previous images
         self.only_attend_immediate_media = only_attend_immediate_media
+        self.use_sdpa = SDPA_AVAIL
 
     def forward(
         self,
@@ -224,6 +257,8 @@ class FlamingoMaskedCrossAttention(nn.Module):
         media: torch.Tensor,
         media_locations: Optional[torch.BoolTensor] = None,
         attend_previous: bool = True,
+        media_kv: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        media_offset: Optional[torch.LongTensor] = None,
     ) -> torch.Tensor:
         """
         Args:
@@ -235,6 +270,9 @@ class FlamingoMaskedCrossAttention(nn.Module):
                 shape (B, T_txt)
             attend_previous: bool
                 If false, ignores immediately preceding image and starts attending when following image
+            media_kv: keys and values of `media` from `project_media`, computed here if not given
+            media_offset: number of media tokens preceding x in each sequence, when x continues a cached sequence
+                shape (B,)
         """
         _, T_img, n = media.shape[:3]
         h = self.heads
@@ -242,57 +280,104 @@ class FlamingoMaskedCrossAttention(nn.Module):
         x = self.norm(x)
 
         q = self.to_q(x)
-        media = rearrange(media, "b t n d -> b (t n) d")
-
-        k, v = self.to_kv(media).chunk(2, dim=-1)
+        k, v = media_kv if media_kv is not None else self.project_media(media)
         q = rearrange(q, "b n (h d) -> b h n d", h=h)
         k = rearrange(k, "b n (h d) -> b h n d", h=h)
         v = rearrange(v, "b n (h d) -> b h n d", h=h)
 
-        q = q * self.scale
-
-        sim = torch.einsum("... i d, ... j d -> ... i j", q, k)
-
+        text_time = text_to_media_mask = None
         if exists(media_locations):
-            # at each boolean of True, increment the time counter (relative to media time)
-            text_time = media_locations.cumsum(dim=-1)
-            media_time = torch.arange(T_img, device=x.device) + 1
-
-            if not attend_previous:
-                text_time[~media_locations] += 1
-                # make sure max is still the number of images in the sequence
-                text_time[
-                    text_time
-                    > repeat(
-                        torch.count_nonzero(media_locations, dim=1),
-                        "b -> b i",
-                        i=text_time.shape[1],
-                    )
-                ] = 0
-
-            # text time must equal media time if only attending to most immediate image
-            # otherwise, as long as text time is greater than media time (if attending to all previous images / media)
-            mask_op = torch.eq if self.only_attend_immediate_media else torch.ge
-
-            text_to_media_mask = mask_op(
-                rearrange(text_time, "b i -> b 1 i 1"),
-                repeat(media_time, "j -> 1 1 1 (j n)", n=n),
-            )
-            sim = sim.masked_fill(~text_to_media_mask, -torch.finfo(sim.dtype).max)
+            text_time, text_to_media_mask = self.text_to_media_mask(media_locations, T_img, n, attend_previous, media_offset)
 
-        sim = sim - sim.amax(dim=-1, keepdim=True).detach()
-        attn = sim.softmax(dim=-1)
+        if self.use_sdpa:
+            out = self.sdpa_attend(q, k, v, text_time, text_to_media_mask)
+        else:
+            q = q * self.scale
+            sim = torch.einsum("... i d, ... j d -> ... i j", q, k)
+            if exists(media_locations):
+                sim = sim.masked_fill(~text_to_media_mask, -torch.finfo(sim.dtype).max)
 
-        if exists(media_locations) and self.only_attend_immediate_media:
-            # any text without a preceding media needs to have attention zeroed out
-            text_without_media_mask = text_time == 0
-            text_without_media_mask = rearrange(text_without_media_mask, "b i -> b 1 i 1")
-            attn = attn.masked_fill(text_without_media_mask, 0.0)
+            sim = sim - sim.amax(dim=-1, keepdim=True).detach()
+            attn = sim.softmax(dim=-1)
+
+            if exists(media_locations) and self.only_attend_immediate_media:
+                # any text without a preceding media needs to have attention zeroed out
+                text_without_media_mask = text_time == 0
+                text_without_media_mask = rearrange(text_without_media_mask, "b i -> b 1 i 1")
+                attn = attn.masked_fill(text_without_media_mask, 0.0)
 
-        out = torch.einsum("... i j, ... j d -> ... i d", attn, v)
+            out = torch.einsum("... i j, ... j d -> ... i d", attn, v)
         out = rearrange(out, "b h n d -> b n (h d)")
         return self.to_out(out)
 
+    def text_to_media_mask(
+        self,
+        media_locations: torch.BoolTensor,
+        T_img: int,
+        n: int,
+        attend_previous: bool = True,
+        media_offset: Optional[torch.LongTensor] = None,
+    ) -> Tuple[torch.LongTensor, torch.BoolTensor]:
+        """
+        Index of the media each text token attends to (0 for none), shape (B, T_txt), and the boolean mask of the media
+        latents it may attend to, shape (B, 1, T_txt, T_img * n).
+        """
+        # at each boolean of True, increment the time counter (relative to media time)
+        text_time = media_locations.cumsum(dim=-1)
+        num_media = torch.count_nonzero(media_locations, dim=1)
+        if exists(media_offset):
+            text_time = text_time + rearrange(media_offset, "b -> b 1")
+            num_media = num_media + media_offset
+        media_time = torch.arange(T_img, device=media_locations.device) + 1
+
+        if not attend_previous:
+            text_time[~media_locations] += 1
+            # make sure max is still the number of images in the sequence
+            text_time[
+                text_time
+                > repeat(
+                    num_media,
+                    "b -> b i",
+                    i=text_time.shape[1],
+                )
+            ] = 0
+
+        # text time must equal media time if only attending to most immediate image
+        # otherwise, as long as text time is greater than media time (if attending to all previous images / media)
+        mask_op = torch.eq if self.only_attend_immediate_media else torch.ge
+
+        text_to_media_mask = mask_op(
+            rearrange(text_time, "b i -> b 1 i 1"),
+            repeat(media_time, "j -> 1 1 1 (j n)", n=n),
+        )
+        return text_time, text_to_media_mask
+
+    def sdpa_attend(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        text_time: Optional[torch.LongTensor] = None,
+        text_to_media_mask: Optional[torch.BoolTensor] = None,
+    ) -> torch.Tensor:
+        """Same result as the einsum path of `forward` through `scaled_dot_product_attention`, q/k/v shaped (B, h, T, d)."""
+        if text_to_media_mask is None:
+            return nn.functional.scaled_dot_product_attention(q, k, v)
+        # text that may attend to no media gets uniform attention over all of it in the einsum path (every score is
+        # masked to the same value); a fully masked row would give NaNs here, so unmask it and patch its output after
+        sees_no_media = ~text_to_media_mask.any(dim=-1, keepdim=True)
+        out = nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=text_to_media_mask | sees_no_media)
+        out = torch.where(sees_no_media, v.mean(dim=-2, keepdim=True), out)
+        if self.only_attend_immediate_media:
+            # any text without a preceding media needs to have attention zeroed out
+            out = out.masked_fill(rearrange(text_time == 0, "b i -> b 1 i 1"), 0.0)
+        return out
+
+    def project_media(self, media: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Keys and values of the media latents (B, T_img, n, D_img), each of shape (B, T_img * n, inner_dim)."""
+        media = rearrange(media, "b t n d -> b (t n) d")
+        return self.to_kv(media).chunk(2, dim=-1)
+
 
 class FlamingoGatedCrossAttentionBlock(nn.Module):
     def __init__(
@@ -330,6 +415,8 @@ class FlamingoGatedCrossAttentionBlock(nn.Module):
         media: torch.Tensor,
         media_locations: Optional[torch.BoolTensor] = None,
         attend_previous: bool = True,
+        media_kv: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        media_offset: Optional[torch.LongTensor] = None,
     ) -> torch.Tensor:
         x = (
             self.attn(
@@ -337,6 +424,8 @@ class FlamingoGatedCrossAttentionBlock(nn.Module):
                 media,
                 media_locations=media_locations,
                 attend_previous=attend_previous,
+                media_kv=media_kv,
+                media_offset=media_offset,
             )
             * self.attn_gate.tanh()
             + x
@@ -355,15 +444,21 @@ class FlamingoLayer(nn.Module):
         self.gated_cross_attn_layer = gated_cross_attn_layer
         self.decoder_layer = decoder_layer
         self.vis_x = None
+        self.media_repeats = 1
+        self.media_kv = None
         self.media_locations = None
+        self.media_offset = None
 
     def is_conditioned(self) -> bool:
         """Check whether the layer is conditioned."""
         return self.vis_x is not None
 
     # Used this great idea from this implementation of Flamingo (https://github.com/dhansmair/flamingo-mini/)
-    def condition_vis_x(self, vis_x) -> None:
+    def condition_vis_x(self, vis_x, repeats: int = 1) -> None:
+        """`repeats`: number of consecutive sequences (e.g. beams) sharing each element of `vis_x`."""
         self.vis_x = vis_x
+        self.media_repeats = repeats
+        self.media_kv = None
 
     def condition_media_locations(self, media_locations) -> None:
         self.media_locations = media_locations
@@ -371,6 +466,9 @@ class FlamingoLayer(nn.Module):
     def condition_attend_previous(self, attend_previous) -> None:
         self.attend_previous = attend_previous
 
+    def condition_media_offset(self, media_offset) -> None:
+        self.media_offset = media_offset
+
     def forward(
         self,
         lang_x: torch.Tensor,
@@ -386,16 +484,46 @@ class FlamingoLayer(nn.Module):
         if self.media_locations is None:
             raise ValueError("media_locations must be conditioned before forward pass")
 
+        media = self.vis_x
+        media_kv = None
+        if not torch.is_grad_enabled():
+            # the media keys/values do not change between decoding steps, project them once per conditioning
+            # and only then expand them over the sequences sharing the media
+            if self.media_kv is None:
+                self.media_kv = tuple(repeat_batch(t, self.media_repeats) for t in self.gated_cross_attn_layer.attn.project_media(self.vis_x))
+            media_kv = self.media_kv
+        else:
+            media = repeat_batch(self.vis_x, self.media_repeats)
+
         lang_x = self.gated_cross_attn_layer(
             lang_x,
-            self.vis_x,
+            media,
             media_locations=self.media_locations,
             attend_previous=self.attend_previous,
+            media_kv=media_kv,
+            media_offset=self.media_offset,
         )
         lang_x = self.decoder_layer(lang_x, attention_mask=attention_mask, **decoder_layer_kwargs)
         return lang_x
 
 
+class FlamingoGenerationState:
+    """
+    Media seen so far by each sequence, so that cached decoding steps, which only see the new tokens, attend to the
+    same images as a full forward pass over the whole sequence would.
+    """
+
+    def __init__(self, media_locations: torch.BoolTensor, attend_previous: bool):
+        self.num_media = media_locations.sum(dim=-1)
+        self.attend_previous = attend_previous
+
+    def advance(self, media_locations: torch.BoolTensor) -> torch.LongTensor:
+        """Number of media tokens before `media_locations`, which are then added to the count."""
+        media_offset = self.num_media
+        self.num_media = media_offset + media_locations.sum(dim=-1)
+        return media_offset
+
+
 class FlamingoLMMixin(nn.Module):
     """
     Mixin to add cross-attention layers to a language model.
@@ -444,21 +572,31 @@ class FlamingoLMMixin(nn.Module):
 
         input_ids = kwargs["input_ids"] if "input_ids" in kwargs else input[0]
         media_locations = input_ids == self.media_token_id
-        # IMPORTANT: Force `attend_previous` to True when we place training data as <image>caption<|endofchunk|>
-        # attend_previous = (
-        #     (random.random() < 0.5) if self.use_media_placement_augmentation else False
-        # )
-        attend_previous = (random.random() < 0.5) if self.use_media_placement_augmentation else True
-        # attend_previous = self.only_attend_previous
+        generation_state = getattr(self, "generation_state", None)
+        if kwargs.get("past_key_values") is not None and generation_state is not None:
+            # cached decoding: input_ids only holds the new tokens, continue from the media seen so far
+            media_offset = generation_state.advance(media_locations)
+            attend_previous = generation_state.attend_previous
+        else:
+            media_offset = None
+            # IMPORTANT: Force `attend_previous` to True when we place training data as <image>caption<|endofchunk|>
+            # attend_previous = (
+            #     (random.random() < 0.5) if self.use_media_placement_augmentation else False
+            # )
+            attend_previous = (random.random() < 0.5) if self.use_media_placement_augmentation else True
+            # attend_previous = self.only_attend_previous
+            self.generation_state = FlamingoGenerationState(media_locations, attend_previous)
 
         if self.__class__.__name__ == "LlamaForCausalLM":
             for layer in self.get_decoder().layers:
                 layer.condition_media_locations(media_locations)
                 layer.condition_attend_previous(attend_previous)
+                layer.condition_media_offset(media_offset)
         elif self.__class__.__name__ in ["MPTForCausalLM", "MosaicGPT"]:
             for layer in self.get_decoder().blocks:
                 layer.condition_media_locations(media_locations)
                 layer.condition_attend_previous(attend_previous)
+                layer.condition_media_offset(media_offset)
         else:
             print("inavaliable text encoder")
         return super().forward(*input, **kwargs)  # Call the other parent's forward method
@@ -472,6 +610,8 @@ class FlamingoLMMixin(nn.Module):
             layer.condition_vis_x(None)
             layer.condition_media_locations(None)
             layer.condition_attend_previous(None)
+            layer.condition_media_offset(None)
+        self.generation_state = None
 
 
 class FlamingoPreTrainedModel(PreTrainedModel):
@@ -618,6 +758,7 @@ class FlamingoModel(FlamingoPreTrainedModel):
         clear_conditioned_layers: bool = True,
         past_key_values: Optional[torch.Tensor] = None,
         use_cache: bool = False,
+        num_images: Optional[torch.LongTensor] = None,
         **kwargs,
     ) -> CausalLMOutputWithPast:
         """
@@ -639,6 +780,7 @@ class FlamingoModel(FlamingoPreTrainedModel):
                 CausalLM models.
             use_cache: whether to use cached key values. See use_cache
                 documentation in Hugging Face CausalLM models.
+            num_images: number of images of each sample when vision_x is packed, see `_encode_vision_x`.
         """
         assert (vision_x is not None) or use_cached_vision_x, "Must provide either vision_x or use_cached_vision_x to True."
 
@@ -650,7 +792,7 @@ class FlamingoModel(FlamingoPreTrainedModel):
 
         else:
             # Case: do not use caching (i.e. this is a standard forward pass);
-            self._encode_vision_x(vision_x=vision_x)
+            self._encode_vision_x(vision_x=vision_x, num_images=num_images)
 
         output = self.lang_encoder(
             input_ids=lang_x,
@@ -666,7 +808,7 @@ class FlamingoModel(FlamingoPreTrainedModel):
 
         return output
 
-    def _encode_vision_x(self, vision_x: torch.Tensor):
+    def _encode_vision_x(self, vision_x: torch.Tensor, num_images: Optional[torch.LongTensor] = None):
         """
         Compute media tokens from vision input by passing it through vision encoder and conditioning language model.
         Args:
@@ -674,20 +816,31 @@ class FlamingoModel(FlamingoPreTrainedModel):
                 shape (B, T_img, F, C, H, W)
                 Images in the same chunk are collated along T_img, and frames are collated along F
                 Currently only F=1 is supported (single-frame videos)
+                or precomputed vision encoder features of shape (B, T_img, F, v, d),
+                see pipeline/utils/extract_vision_features.py
+            num_images (torch.LongTensor, optional): number of images of each sample, shape (B,). When given, vision_x
+                only holds the real images of all samples back to back, shape (N, F, C, H, W) or (N, F, v, d) with
+                N = num_images.sum(), so that no padding images are encoded; the media of samples with fewer images than
+                the largest count are zero-filled.
 
         rearrange code based on https://github.com/dhansmair/flamingo-mini
         """
 
-        assert vision_x.ndim == 6, "vision_x should be of shape (b, T_img, F, C, H, W)"
-        b, T, F = vision_x.shape[:3]
-        assert F == 1, "Only single frame supported"
-
-        vision_x = rearrange(vision_x, "b T F c h w -> (b T F) c h w")
-        with torch.no_grad():
-            vision_x = self.vision_encoder(vision_x)[0][:, 1:, :]
-        vision_x = rearrange(vision_x, "(b T F) v d -> b T F v d", b=b, T=T, F=F)
+        if exists(num_images):
+            # packed images are encoded as the media of a single sample, then scattered back per sample
+            vision_x = vision_x.unsqueeze(0)
+        assert vision_x.ndim in (5, 6), "vision_x should be of shape (b, T_img, F, C, H, W) or (b, T_img, F, v, d)"
+        assert vision_x.shape[2] == 1, "Only single frame supported"
+        if vision_x.ndim == 6:
+            b, T, F = vision_x.shape[:3]
+            vision_x = rearrange(vision_x, "b T F c h w -> (b T F) c h w")
+            with torch.no_grad():
+                vision_x = self.vision_encoder(vision_x)[0][:, 1:, :]
+            vision_x = rearrange(vision_x, "(b T F) v d -> b T F v d", b=b, T=T, F=F)
 
         vision_x = self.perceiver(vision_x)  # reshapes to (b, T, n, d)
+        if exists(num_images):
+            vision_x = unpack_media(vision_x[0], num_images)
 
         for layer in self.lang_encoder._get_decoder_layers():
             layer.condition_vis_x(vision_x)
@@ -834,6 +987,7 @@ class FlamingoForConditionalGeneration(FlamingoPreTrainedModel):
         clear_conditioned_layers: bool = True,
         past_key_values: Optional[torch.Tensor] = None,
         use_cache: bool = False,
+        num_images: Optional[torch.LongTensor] = None,
         **kwargs,
     ) -> CausalLMOutputWithPast:
         """
@@ -855,6 +1009,7 @@ class FlamingoForConditionalGeneration(FlamingoPreTrainedModel):
                 CausalLM models.
             use_cache: whether to use cached key values. See use_cache
                 documentation in Hugging Face CausalLM models.
+            num_images: number of images of each sample when vision_x is packed, see `_encode_vision_x`.
         """
         assert (vision_x is not None) or use_cached_vision_x, "Must provide either vision_x or use_cached_vision_x to True."
 
@@ -866,7 +1021,7 @@ class FlamingoForConditionalGeneration(FlamingoPreTrainedModel):
 
         else:
             # Case: do not use caching (i.e. this is a standard forward pass);
-            self._encode_vision_x(vision_x=vision_x)
+            self._encode_vision_x(vision_x=vision_x, num_images=num_images)
 
         output = self.lang_encoder(
             input_ids=lang_x,
@@ -882,7 +1037,7 @@ class FlamingoForConditionalGeneration(FlamingoPreTrainedModel):
 
         return output
 
-    def _encode_vision_x(self, vision_x: torch.Tensor):
+    def _encode_vision_x(self, vision_x: torch.Tensor, repeats: int = 1, num_images: Optional[torch.LongTensor] = None):
         """
         Compute media tokens from vision input by passing it through vision encoder and conditioning language model.
         Args:
@@ -890,23 +1045,36 @@ class FlamingoForConditionalGeneration(FlamingoPreTrainedModel):
                 shape (B, T_img, F, C, H, W)
                 Images in the same chunk are collated along T_img, and frames are collated along F
                 Currently only F=1 is supported (single-frame videos)
+                or precomputed vision encoder features of shape (B, T_img, F, v, d),
+                see pipeline/utils/extract_vision_features.py
+            num_images (torch.LongTensor, optional): number of images of each sample, shape (B,). When given, vision_x
+                only holds the real images of all samples back to back, shape (N, F, C, H, W) or (N, F, v, d) with
+                N = num_images.sum(), so that no padding images are encoded; the media of samples with fewer images than
+                the largest count are zero-filled.
+            repeats (int): number of consecutive language sequences sharing each element of vision_x, e.g. beams.
+                The media is encoded once per element and only expanded in the cross-attention layers.
 
         rearrange code based on https://github.com/dhansmair/flamingo-mini
         """
 
-        assert vision_x.ndim == 6, "vision_x should be of shape (b, T_img, F, C, H, W)"
-        b, T, F = vision_x.shape[:3]
-        # assert F == 1, "Only single frame supported"
-
-        vision_x = rearrange(vision_x, "b T F c h w -> (b T F) c h w")
-        with torch.no_grad():
-            vision_x = self.vision_encoder(vision_x)[0][:, 1:, :]
-        vision_x = rearrange(vision_x, "(b T F) v d -> b T F v d", b=b, T=T, F=F)
+        if exists(num_images):
+            # packed images are encoded as the media of a single sample, then scattered back per sample
+            vision_x = vision_x.unsqueeze(0)
+        assert vision_x.ndim in (5, 6), "vision_x should be of shape (b, T_img, F, C, H, W) or (b, T_img, F, v, d)"
+        if vision_x.ndim == 6:
+            b, T, F = vision_x.shape[:3]
+            # assert F == 1, "Only single frame supported"
+            vision_x = rearrange(vision_x, "b T F c h w -> (b T F) c h w")
+            with torch.no_grad():
+                vision_x = self.vision_encoder(vision_x)[0][:, 1:, :]
+            vision_x = rearrange(vision_x, "(b T F) v d -> b T F v d", b=b, T=T, F=F)
 
         vision_x = self.perceiver(vision_x)  # reshapes to (b, T, n, d)
+        if exists(num_images):
+            vision_x = unpack_media(vision_x[0], num_images)
 
         for layer in self.lang_encoder._get_decoder_layers():
-            layer.condition_vis_x(vision_x)
+            layer.condition_vis_x(vision_x, repeats=repeats)
 
     @torch.no_grad()
     def generate(
@@ -925,6 +1093,7 @@ class FlamingoForConditionalGeneration(FlamingoPreTrainedModel):
         num_return_sequences: int = 1,
         do_sample: bool = False,
         early_stopping: bool = False,
+        num_images: Optional[torch.LongTensor] = None,
         **kwargs,
     ):
         """
@@ -949,6 +1118,7 @@ class FlamingoForConditionalGeneration(FlamingoPreTrainedModel):
             num_return_sequences (int, optional): Number of return sequences. Defaults to 1.
             do_sample (bool, optional): Do sample. Defaults to False.
             early_stopping (bool, optional): Early stopping. Defaults to False.
+            num_images (torch.LongTensor, optional): number of images of each sample when vision_x is packed, see `_encode_vision_x`.
         Returns:
             torch.Tensor: lang_x with generated tokens appended to it
         """
@@ -960,9 +1130,8 @@ class FlamingoForConditionalGeneration(FlamingoPreTrainedModel):
                 place_submodules=False,
             )
             add_hook_to_module(self.lang_encoder, hook)
-        if num_beams > 1:
-            vision_x = vision_x.repeat_interleave(num_beams, dim=0)
-        self._encode_vision_x(vision_x=vision_x)
+        # beams of a sequence share its media, encode it once rather than once per beam
+        self._encode_vision_x(vision_x=vision_x, repeats=num_beams, num_images=num_images)
         output = self.lang_encoder.generate(
             lang_x,
             attention_mask=attention_mask,
@@ -322,28 +322,15 @@ class FuyuProcessor(ProcessorMixin):
         self.dummy_image_index = -1
 
     def find_and_remove_tokens(self, input_ids, labels, token_id):
-        batch_size, seq_len = input_ids.size()
-
-        # Create lists to store the new tensors
-        new_input_list = []
-        new_labels_list = []
-
-        for i in range(batch_size):
-            single_input = input_ids[i, :]
-            single_label = labels[i, :]
-
-            # Remove the last token_id
-            token_indices = (single_input == token_id).nonzero(as_tuple=True)[0]
-            if len(token_indices) > 1:
-                last_token_index = token_indices[-1]
-                single_input[last_token_index] = self.tokenizer.eos_token_id
-                single_label[last_token_index] = self.tokenizer.eos_token_id
-
-            # Append the new sequence to the list
-            new_input_list.append(single_input)
-            new_labels_list.append(single_label)
-
-        return torch.stack(new_input_list), torch.stack(new_labels_list)
+        """Replace the last `token_id` of every row that contains it more than once with the eos token."""
+        is_token = input_ids == token_id
+        rows = (is_token.sum(dim=1) > 1).nonzero(as_tuple=True)[0]
+        last_token_index = input_ids.size(1) - 1 - is_token.flip(dims=[1]).int().argmax(dim=1)
+
+        input_ids, labels = input_ids.clone(), labels.clone()
+        input_ids[rows, last_token_index[rows]] = self.tokenizer.eos_token_id
+        labels[rows, last_token_index[rows]] = self.tokenizer.eos_token_id
+        return input_ids, labels
 
     def get_labels(self, input_ids, special_token_id, masking_number=-100):
         # Initialize labels tensor filled with masking_number
@@ -222,6 +222,88 @@ def triton_flash_attn_fn(
     return (output, None, past_key_value)
 
 
+class StaticKVCache:
+    """Keys and values of every block in preallocated buffers of a fixed capacity, written in place.
+
+    Passed as `past_key_values`, every tensor of a decoding step keeps its address and shape from one step to the next,
+    so that the step can be captured in a CUDA graph and replayed. The number of positions written is kept on the
+    device for the same reason.
+    """
+
+    def __init__(self, n_layers: int, batch_size: int, kv_n_heads: int, head_dim: int, max_seq_len: int, device=None, dtype=None):
+        self.keys = torch.zeros(n_layers, batch_size, kv_n_heads, max_seq_len, head_dim, device=device, dtype=dtype)
+        self.values = torch.zeros_like(self.keys)
+        # positions holding a (non padding) token
+        self.key_mask = torch.zeros(batch_size, max_seq_len, dtype=torch.bool, device=device)
+        self.seq_len = torch.zeros((), dtype=torch.long, device=device)
+        self.positions = None
+        self.layers = [StaticLayerCache(self, layer_idx) for layer_idx in range(n_layers)]
+
+    @property
+    def batch_size(self) -> int:
+        return self.key_mask.shape[0]
+
+    @property
+    def max_seq_len(self) -> int:
+        return self.key_mask.shape[1]
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __getitem__(self, layer_idx):
+        return self.layers[layer_idx]
+
+    def reset(self):
+        self.seq_len.zero_()
+        self.key_mask.zero_()
+
+    def begin(self, num_new_tokens: int, attention_mask: Optional[torch.Tensor] = None) -> torch.LongTensor:
+        """Reserve the positions of the new tokens (the attention mask of which defaults to all ones) before the blocks write them."""
+        self.positions = self.seq_len + torch.arange(num_new_tokens, device=self.key_mask.device)
+        if attention_mask is None:
+            attention_mask = torch.ones(self.batch_size, num_new_tokens, dtype=torch.bool, device=self.key_mask.device)
+        self.key_mask.index_copy_(1, self.positions, attention_mask.bool())
+        return self.positions
+
+    def end(self, num_new_tokens: int):
+        self.seq_len.add_(num_new_tokens)
+
+    def token_positions(self) -> torch.LongTensor:
+        """Position of each new token counting the non padding tokens only, as the eager path does, shape (B, S)."""
+        return (self.key_mask.long().cumsum(dim=1) - 1).clamp(min=0).index_select(1, self.positions)
+
+
+class StaticLayerCache:
+    """The slice of a `StaticKVCache` a block writes to."""
+
+    def __init__(self, cache: StaticKVCache, layer_idx: int):
+        self.cache = cache
+        self.layer_idx = layer_idx
+
+    def update(self, key: torch.Tensor, value: torch.Tensor):
+        """Write the keys and values (B, h, S, d) of the new tokens and return the whole buffers."""
+        keys, values = self.cache.keys[self.layer_idx], self.cache.values[self.layer_idx]
+        keys.index_copy_(2, self.cache.positions, key.to(keys.dtype))
+        values.index_copy_(2, self.cache.positions, value.to(values.dtype))
+        return keys, values
+
+
+def static_cache_attention(query, key, value, n_heads, layer_cache: StaticLayerCache, softmax_scale=None, attn_bias=None, multiquery=False):
+    """Attention of the new tokens over every position of a `StaticKVCache`, `attn_bias` masks the positions not to attend to.
+
+    The shapes only depend on the capacity of the cache, whatever the number of tokens written so far.
+    """
+    kv_n_heads = 1 if multiquery else n_heads
+    q = rearrange(query, "b s (h d) -> b h s d", h=n_heads)
+    k, v = layer_cache.update(rearrange(key, "b s (h d) -> b h s d", h=kv_n_heads), rearrange(value, "b s (h d) -> b h s d", h=kv_n_heads))
+    if multiquery:
+        k = k.expand(-1, n_heads, -1, -1)
+        v = v.expand(-1, n_heads, -1, -1)
+    attn_mask = attn_bias.to(q.dtype) if attn_bias is not None else None
+    out = nn.functional.scaled_dot_product_attention(q, k.to(q.dtype), v.to(q.dtype), attn_mask=attn_mask, scale=softmax_scale)
+    return rearrange(out, "b h s d -> b s (h d)")
+
+
 class MultiheadAttention(nn.Module):
     """Multi-head self attention.
 
@@ -297,6 +379,9 @@ class MultiheadAttention(nn.Module):
             dtype = query.dtype
             query = self.q_ln(query).to(dtype)
             key = self.k_ln(key).to(dtype)
+        if isinstance(past_key_value, StaticLayerCache):
+            context = static_cache_attention(query, key, value, self.n_heads, past_key_value, softmax_scale=self.softmax_scale, attn_bias=attn_bias)
+            return (self.out_proj(context), None, past_key_value)
         (context, attn_weights, past_key_value) = self.attn_fn(
             query,
             key,
@@ -390,6 +475,9 @@ class MultiQueryAttention(nn.Module):
             dtype = query.dtype
             query = self.q_ln(query).to(dtype)
             key = self.k_ln(key).to(dtype)
+        if isinstance(past_key_value, StaticLayerCache):
+            context = static_cache_attention(query, key, value, self.n_heads, past_key_value, softmax_scale=self.softmax_scale, attn_bias=attn_bias, multiquery=True)
+            return (self.out_proj(context), None, past_key_value)
         (context, attn_weights, past_key_value) = self.attn_fn(
             query,
             key,
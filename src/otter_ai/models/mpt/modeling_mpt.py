@@ -15,7 +15,7 @@ from transformers.modeling_outputs import (
     CausalLMOutputWithPast,
 )
 
-from .attention import attn_bias_shape, build_attn_bias
+from .attention import StaticKVCache, attn_bias_shape, build_attn_bias
 from .blocks import MPTBlock
 from .configuration_mpt import MPTConfig
 from .custom_embedding import SharedEmbedding
@@ -144,6 +144,22 @@ class MPTModel(MPTPreTrainedModel):
             attn_bias = attn_bias.masked_fill(~attention_mask.view(-1, 1, 1, s_k), min_val)
         return (attn_bias, None)
 
+    @torch.no_grad()
+    def _static_attn_bias(self, cache: StaticKVCache, dtype):
+        """
+        Additive bias of the new tokens over every position of `cache`: the alibi bias, the padding and the causal mask
+        (which also hides the positions not written yet) in one tensor of shape (B, 1 or n_heads, S, cache.max_seq_len).
+        """
+        attn_bias, _ = self._attn_bias(device=cache.key_mask.device, dtype=torch.float32)
+        if attn_bias is None:
+            attn_bias = torch.zeros((1, 1, 1, cache.max_seq_len), device=cache.key_mask.device)
+        else:
+            # only the alibi bias, which is linear in the key position, so any slice of the right length gives the same attention
+            attn_bias = attn_bias[..., -cache.max_seq_len :]
+        key_positions = torch.arange(cache.max_seq_len, device=cache.key_mask.device)
+        can_attend = cache.key_mask[:, None, None, :] & (key_positions <= cache.positions[:, None])
+        return attn_bias.to(dtype).masked_fill(~can_attend, torch.finfo(dtype).min)
+
     def _apply_prefix_mask(self, attn_bias: torch.Tensor, prefix_mask: torch.Tensor):
         (s_k, s_q) = attn_bias.shape[-2:]
         if s_k != self.config.max_seq_len or s_q != self.config.max_seq_len:
@@ -223,8 +239,18 @@ class MPTModel(MPTPreTrainedModel):
         assert S <= self.config.max_seq_len, f"Cannot forward input with seq_len={S}, this model only supports seq_len<={self.config.max_seq_len}"
 
         tok_emb = self.wte(input_ids)  # type: ignore
+        static_cache = isinstance(past_key_values, StaticKVCache)
+        if static_cache:
+            if self.prefix_lm or (self.attn_uses_sequence_id and sequence_id is not None):
+                raise NotImplementedError("StaticKVCache does not support prefix_lm or sequence_id.")
+            if past_key_values.max_seq_len > self.config.max_seq_len:
+                raise ValueError(f"StaticKVCache capacity {past_key_values.max_seq_len} exceeds max_seq_len={self.config.max_seq_len}.")
+            past_key_values.begin(S, attention_mask)
+
         if self.alibi:
             x = tok_emb
+        elif static_cache:
+            x = tok_emb + self.wpe(past_key_values.token_positions())
         else:
             past_position = 0
             if past_key_values is not None:
@@ -263,13 +289,17 @@ class MPTModel(MPTPreTrainedModel):
             assert isinstance(self.emb_drop, nn.Module)  # pyright
             x = self.emb_drop(x_shrunk)
 
-        attn_bias, attention_mask = self._attn_bias(
-            device=x.device,
-            dtype=torch.float32,
-            attention_mask=attention_mask,
-            prefix_mask=prefix_mask,
-            sequence_id=sequence_id,
-        )
+        if static_cache:
+            # the padding is part of the bias, and the cache keeps the mask of the previous tokens
+            attn_bias, attention_mask = self._static_attn_bias(past_key_values, x.dtype), None
+        else:
+            attn_bias, attention_mask = self._attn_bias(
+                device=x.device,
+                dtype=torch.float32,
+                attention_mask=attention_mask,
+                prefix_mask=prefix_mask,
+                sequence_id=sequence_id,
+            )
 
         # initialize the past key values cache if it should be used
         if use_cache and past_key_values is None:
@@ -289,13 +319,16 @@ class MPTModel(MPTPreTrainedModel):
                 attention_mask=attention_mask,
                 is_causal=self.is_causal,
             )
-            if past_key_values is not None:
+            if past_key_values is not None and not static_cache:
                 past_key_values[b_idx] = past_key_value
 
             if output_attentions:
                 assert all_self_attns is not None  # pyright
                 all_self_attns = all_self_attns + (attn_weights,)
 
+        if static_cache:
+            past_key_values.end(S)
+
         x = self.norm_f(x)  # type: ignore
 
         # add hidden states from the last decoder layer
@@ -457,6 +490,21 @@ class MPTForCausalLM(MPTPreTrainedModel):
     def activation_checkpointing_fn(self, module):
         return isinstance(module, MPTBlock)
 
+    def make_static_cache(self, batch_size: int, max_seq_len: Optional[int] = None) -> StaticKVCache:
+        """A `StaticKVCache` for `batch_size` sequences of up to `max_seq_len` tokens (`config.max_seq_len` by default), to pass as `past_key_values`."""
+        n_heads = self.config.n_heads
+        kv_n_heads = 1 if self.config.attn_config["attn_type"] == "multiquery_attention" else n_heads
+        weight = self.transformer.wte.weight
+        return StaticKVCache(
+            self.config.n_layers,
+            batch_size,
+            kv_n_heads,
+            self.config.d_model // n_heads,
+            max_seq_len or self.config.max_seq_len,
+            device=weight.device,
+            dtype=weight.dtype,
+        )
+
     def prepare_inputs_for_generation(
         self,
         input_ids,
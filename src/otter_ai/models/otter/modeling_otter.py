@@ -1,6 +1,7 @@
 import random
 import sys
-from typing import List, Optional
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
 
 import torch
 import torch.distributed as dist
@@ -122,10 +123,45 @@ def setattr_recursive(obj, att, val):
     setattr(obj, att.split(".")[-1], val)
 
 
+# fused attention kernels (flash / memory-efficient / math) through `torch.nn.functional.scaled_dot_product_attention`
+SDPA_AVAIL = hasattr(nn.functional, "scaled_dot_product_attention")
+
+
 def exists(val):
     return val is not None
 
 
+def repeat_batch(x: torch.Tensor, repeats: int) -> torch.Tensor:
+    """`x.repeat_interleave(repeats, dim=0)`, as a view when the batch holds a single element."""
+    if repeats == 1:
+        return x
+    if x.shape[0] == 1:
+        return x.expand(repeats, *x.shape[1:])
+    return x.repeat_interleave(repeats, dim=0)
+
+
+def unpack_media(media: torch.Tensor, num_images: torch.LongTensor) -> torch.Tensor:
+    """
+    Scatter the packed media (N, ...) of all samples into (B, T_img, ...), T_img being the largest image count (at
+    least 1), zero-filled after the last image of each sample.
+    """
+    T_img = max(int(num_images.max()), 1)
+    is_image = torch.arange(T_img, device=media.device) < rearrange(num_images.to(media.device), "b -> b 1")
+    unpacked = media.new_zeros(num_images.shape[0], T_img, *media.shape[1:])
+    unpacked[is_image] = media
+    return unpacked
+
+
+def encode_frames(vision_encoder: nn.Module, frames: torch.Tensor, chunk_size: Optional[int] = None) -> torch.Tensor:
+    """
+    Patch features (N, v, d) of frames (N, C, H, W), running the vision encoder on at most `chunk_size` frames at a
+    time, which bounds its activation memory when it is frozen or at inference (e.g. for long videos).
+    """
+    if not exists(chunk_size) or frames.shape[0] <= chunk_size:
+        return vision_encoder(frames)[0][:, 1:, :]
+    return torch.cat([vision_encoder(chunk)[0][:, 1:, :] for chunk in frames.split(chunk_size)])
+
+
 class OtterPerceiverBlock(nn.Module):
     def __init__(self, *, dim: int, dim_head: int = 64, heads: int = 8, mult: int = 4):
         super().__init__()
@@ -139,6 +175,7 @@ class OtterPerceiverBlock(nn.Module):
         self.to_q = nn.Linear(dim, inner_dim, bias=False)
         self.to_kv = nn.Linear(dim, inner_dim * 2, bias=False)
         self.to_out = nn.Linear(inner_dim, dim, bias=False)
+        self.use_sdpa = SDPA_AVAIL
         self.feed_forward = nn.ModuleList(
             [
                 nn.LayerNorm(dim),
@@ -165,18 +202,24 @@ class OtterPerceiverBlock(nn.Module):
         q = self.to_q(latents)
         kv_input = torch.cat((x, latents), dim=-2)
         k, v = self.to_kv(kv_input).chunk(2, dim=-1)
-        q = rearrange(q, "b t n (h d) -> b h t n d", h=h)
-        k = rearrange(k, "b t n (h d) -> b h t n d", h=h)
-        v = rearrange(v, "b t n (h d) -> b h t n d", h=h)
-        q = q * self.scale
-
-        # attention
-        sim = torch.einsum("... i d, ... j d  -> ... i j", q, k)
-        sim = sim - sim.amax(dim=-1, keepdim=True).detach()
-        attn = sim.softmax(dim=-1)
-
-        out = torch.einsum("... i j, ... j d -> ... i d", attn, v)
-        out = rearrange(out, "b h t n d -> b t n (h d)", h=h)
+        if self.use_sdpa:
+            # the default scale of scaled_dot_product_attention is dim_head**-0.5
+            q, k, v = (rearrange(t, "b t n (h d) -> (b t) h n d", h=h) for t in (q, k, v))
+            out = nn.functional.scaled_dot_product_attention(q, k, v)
+            out = rearrange(out, "(b t) h n d -> b t n (h d)", t=latents.shape[1])
+        else:
+            q = rearrange(q, "b t n (h d) -> b h t n d", h=h)
+            k = rearrange(k, "b t n (h d) -> b h t n d", h=h)
+            v = rearrange(v, "b t n (h d) -> b h t n d", h=h)
+            q = q * self.scale
+
+            # attention
+            sim = torch.einsum("... i d, ... j d  -> ... i j", q, k)
+            sim = sim - sim.amax(dim=-1, keepdim=True).detach()
+            attn = sim.softmax(dim=-1)
+
+            out = torch.einsum("... i j, ... j d -> ... i d", attn, v)
+            out = rearrange(out, "b h t n d -> b t n (h d)", h=h)
         out = self.to_out(out) + residual_latents
         residual_out = out
         for layer in self.feed_forward:
@@ -197,10 +240,16 @@ class OtterPerceiverResampler(nn.Module):
         max_num_media: Optional[int] = None,
         max_num_frames: Optional[int] = None,
         ff_mult: int = 4,
+        max_attended_frames: Optional[int] = None,
+        frame_token_pool: int = 1,
     ):
         super().__init__()
         self.latents = nn.Parameter(torch.randn(num_latents, dim))
         self.frame_embs = nn.Parameter(torch.randn(max_num_frames, dim)) if exists(max_num_frames) else None
+        # videos with more frames are uniformly subsampled to max_attended_frames, see `select_frames`
+        self.max_attended_frames = max_attended_frames
+        # for videos, average pool the patch grid of each frame by this factor before the attention
+        self.frame_token_pool = frame_token_pool
 
         self.media_time_embs = nn.Parameter(torch.randn(max_num_media, 1, dim)) if exists(max_num_media) else None
 
@@ -210,19 +259,40 @@ class OtterPerceiverResampler(nn.Module):
 
         self.norm = nn.LayerNorm(dim)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def select_frames(self, num_frames: int) -> Optional[torch.LongTensor]:
+        """
+        Indices of the frames attended to out of `num_frames`, evenly spaced like the dataset's frame resampling, or None
+        to keep them all. Callers drop the other frames before the vision encoder and pass the indices to `forward`.
+        """
+        if not exists(self.max_attended_frames) or num_frames <= self.max_attended_frames:
+            return None
+        return torch.linspace(0, num_frames - 1, self.max_attended_frames).long()
+
+    def forward(self, x: torch.Tensor, frame_ids: Optional[torch.LongTensor] = None) -> torch.Tensor:
         """
         Args:
             x (torch.Tensor): image features
                 shape (b, T, F, v, D)
+            frame_ids (torch.LongTensor, optional): positions of the F frames in the original video, from `select_frames`
+                shape (F,)
         Returns:
             shape (b, T, n, D) where n is self.num_latents
         """
         b, T, F, v = x.shape[:4]
 
+        if F > 1 and self.frame_token_pool > 1:
+            # merge neighbouring patches of each frame, the keys grow with F * v for every block
+            grid = int(v**0.5)
+            assert grid * grid == v, "frame_token_pool needs a square patch grid"
+            x = rearrange(x, "b T F (h w) d -> (b T F) d h w", h=grid)
+            x = nn.functional.avg_pool2d(x, self.frame_token_pool, ceil_mode=True)
+            x = rearrange(x, "(b T F) d h w -> b T F (h w) d", b=b, T=T)
+            v = x.shape[3]
+
         # frame and media time embeddings
         if exists(self.frame_embs):
-            frame_embs = repeat(self.frame_embs[:F], "F d -> b T F v d", b=b, T=T, v=v)
+            frame_embs = self.frame_embs[frame_ids.to(x.device)] if exists(frame_ids) else self.frame_embs[:F]
+            frame_embs = repeat(frame_embs, "F d -> b T F v d", b=b, T=T, v=v)
             x = x + frame_embs
         x = rearrange(x, "b T F v d -> b T (F v) d")  # flatten the frame and spatial dimensions
         if exists(self.media_time_embs):
@@ -258,6 +328,7 @@ class OtterMaskedCrossAttention(nn.Module):
 
         # whether for text to only attend to immediate preceding image, or all previous images
         self.only_attend_immediate_media = only_attend_immediate_media
+        self.use_sdpa = SDPA_AVAIL
 
     def forward(
         self,
@@ -265,6 +336,8 @@ class OtterMaskedCrossAttention(nn.Module):
         media: torch.Tensor,
         media_locations: Optional[torch.BoolTensor] = None,
         attend_previous: bool = True,
+        media_kv: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        media_offset: Optional[torch.LongTensor] = None,
     ) -> torch.Tensor:
         """
         Args:
@@ -276,6 +349,9 @@ class OtterMaskedCrossAttention(nn.Module):
                 shape (B, T_txt)
             attend_previous: bool
                 If false, ignores immediately preceding image and starts attending when following image
+            media_kv: keys and values of `media` from `project_media`, computed here if not given
+            media_offset: number of media tokens preceding x in each sequence, when x continues a cached sequence
+                shape (B,)
         """
         _, T_img, n = media.shape[:3]
         h = self.heads
@@ -283,53 +359,35 @@ class OtterMaskedCrossAttention(nn.Module):
         x = self.norm(x)
 
         q = self.to_q(x)
-        media = rearrange(media, "b t n d -> b (t n) d")
-
-        k, v = self.to_kv(media).chunk(2, dim=-1)
-        if not XFORMERS_AVAIL:
+        k, v = media_kv if media_kv is not None else self.project_media(media)
+        # the xformers kernel takes no media mask, only use it when there is nothing to mask
+        if self.use_sdpa or not XFORMERS_AVAIL or exists(media_locations):
             q = rearrange(q, "b n (h d) -> b h n d", h=h)
             k = rearrange(k, "b n (h d) -> b h n d", h=h)
             v = rearrange(v, "b n (h d) -> b h n d", h=h)
-            q = q * self.scale
 
-            sim = torch.einsum("... i d, ... j d -> ... i j", q, k)
+            text_time = text_to_media_mask = None
             if exists(media_locations):
-                # at each boolean of True, increment the time counter (relative to media time)
-                text_time = media_locations.cumsum(dim=-1)
-                media_time = torch.arange(T_img, device=x.device) + 1
-
-                if not attend_previous:
-                    text_time[~media_locations] += 1
-                    # make sure max is still the number of images in the sequence
-                    text_time[
-                        text_time
-                        > repeat(
-                            torch.count_nonzero(media_locations, dim=1),
-                            "b -> b i",
-                            i=text_time.shape[1],
-                        )
-                    ] = 0
-
-                # text time must equal media time if only attending to most immediate image
-                # otherwise, as long as text time is greater than media time (if attending to all previous images / media)
-                mask_op = torch.eq if self.only_attend_immediate_media else torch.ge
-
-                text_to_media_mask = mask_op(
-                    rearrange(text_time, "b i -> b 1 i 1"),
-                    repeat(media_time, "j -> 1 1 1 (j n)", n=n),
-                )
-                sim = sim.masked_fill(~text_to_media_mask, -torch.finfo(sim.dtype).max)
+                text_time, text_to_media_mask = self.text_to_media_mask(media_locations, T_img, n, attend_previous, media_offset)
 
-            sim = sim - sim.amax(dim=-1, keepdim=True).detach()
-            attn = sim.softmax(dim=-1)
+            if self.use_sdpa:
+                out = self.sdpa_attend(q, k, v, text_time, text_to_media_mask)
+            else:
+                q = q * self.scale
+                sim = torch.einsum("... i d, ... j d -> ... i j", q, k)
+                if exists(media_locations):
+                    sim = sim.masked_fill(~text_to_media_mask, -torch.finfo(sim.dtype).max)
 
-            if exists(media_locations) and self.only_attend_immediate_media:
-                # any text without a preceding media needs to have attention zeroed out
-                text_without_media_mask = text_time == 0
-                text_without_media_mask = rearrange(text_without_media_mask, "b i -> b 1 i 1")
-                attn = attn.masked_fill(text_without_media_mask, 0.0)
+                sim = sim - sim.amax(dim=-1, keepdim=True).detach()
+                attn = sim.softmax(dim=-1)
 
-            out = torch.einsum("... i j, ... j d -> ... i d", attn, v)
+                if exists(media_locations) and self.only_attend_immediate_media:
+                    # any text without a preceding media needs to have attention zeroed out
+                    text_without_media_mask = text_time == 0
+                    text_without_media_mask = rearrange(text_without_media_mask, "b i -> b 1 i 1")
+                    attn = attn.masked_fill(text_without_media_mask, 0.0)
+
+                out = torch.einsum("... i j, ... j d -> ... i d", attn, v)
             out = rearrange(out, "b h n d -> b n (h d)")
         else:
             q = rearrange(q, "b n (h d) -> b n h d", h=h)
@@ -339,6 +397,68 @@ class OtterMaskedCrossAttention(nn.Module):
             out = xops.memory_efficient_attention(q, k, v, attn_bias=attn_mask, scale=self.scale)
         return self.to_out(out)
 
+    def text_to_media_mask(
+        self,
+        media_locations: torch.BoolTensor,
+        T_img: int,
+        n: int,
+        attend_previous: bool = True,
+        media_offset: Optional[torch.LongTensor] = None,
+    ) -> Tuple[torch.LongTensor, torch.BoolTensor]:
+        """
+        Index of the media each text token attends to (0 for none), shape (B, T_txt), and the boolean mask of the media
+        latents it may attend to, shape (B, 1, T_txt, T_img * n).
+        """
+        # at each boolean of True, increment the time counter (relative to media time)
+        text_time = media_locations.cumsum(dim=-1)
+        num_media = torch.count_nonzero(media_locations, dim=1)
+        if exists(media_offset):
+            text_time = text_time + rearrange(media_offset, "b -> b 1")
+            num_media = num_media + media_offset
+        media_time = torch.arange(T_img, device=media_locations.device) + 1
+
+        if not attend_previous:
+            # without boolean indexing, which would synchronize with the host
+            text_time = torch.where(media_locations, text_time, text_time + 1)
+            # make sure max is still the number of images in the sequence
+            text_time = text_time.masked_fill(text_time > rearrange(num_media, "b -> b 1"), 0)
+
+        # text time must equal media time if only attending to most immediate image
+        # otherwise, as long as text time is greater than media time (if attending to all previous images / media)
+        mask_op = torch.eq if self.only_attend_immediate_media else torch.ge
+
+        text_to_media_mask = mask_op(
+            rearrange(text_time, "b i -> b 1 i 1"),
+            repeat(media_time, "j -> 1 1 1 (j n)", n=n),
+        )
+        return text_time, text_to_media_mask
+
+    def sdpa_attend(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        text_time: Optional[torch.LongTensor] = None,
+        text_to_media_mask: Optional[torch.BoolTensor] = None,
+    ) -> torch.Tensor:
+        """Same result as the einsum path of `forward` through `scaled_dot_product_attention`, q/k/v shaped (B, h, T, d)."""
+        if text_to_media_mask is None:
+            return nn.functional.scaled_dot_product_attention(q, k, v)
+        # text that may attend to no media gets uniform attention over all of it in the einsum path (every score is
+        # masked to the same value); a fully masked row would give NaNs here, so unmask it and patch its output after
+        sees_no_media = ~text_to_media_mask.any(dim=-1, keepdim=True)
+        out = nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=text_to_media_mask | sees_no_media)
+        out = torch.where(sees_no_media, v.mean(dim=-2, keepdim=True), out)
+        if self.only_attend_immediate_media:
+            # any text without a preceding media needs to have attention zeroed out
+            out = out.masked_fill(rearrange(text_time == 0, "b i -> b 1 i 1"), 0.0)
+        return out
+
+    def project_media(self, media: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Keys and values of the media latents (B, T_img, n, D_img), each of shape (B, T_img * n, inner_dim)."""
+        media = rearrange(media, "b t n d -> b (t n) d")
+        return self.to_kv(media).chunk(2, dim=-1)
+
 
 class OtterGatedCrossAttentionBlock(nn.Module):
     def __init__(
@@ -376,6 +496,8 @@ class OtterGatedCrossAttentionBlock(nn.Module):
         media: torch.Tensor,
         media_locations: Optional[torch.BoolTensor] = None,
         attend_previous: bool = True,
+        media_kv: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        media_offset: Optional[torch.LongTensor] = None,
     ) -> torch.Tensor:
         x = (
             self.attn(
@@ -383,6 +505,8 @@ class OtterGatedCrossAttentionBlock(nn.Module):
                 media,
                 media_locations=media_locations,
                 attend_previous=attend_previous,
+                media_kv=media_kv,
+                media_offset=media_offset,
             )
             * self.attn_gate.tanh()
             + x
@@ -401,15 +525,25 @@ class OtterLayer(nn.Module):
         self.gated_cross_attn_layer = gated_cross_attn_layer
         self.decoder_layer = decoder_layer
         self.vis_x = None
+        self.media_repeats = 1
+        self.media_kv = None
         self.media_locations = None
+        self.media_offset = None
 
     def is_conditioned(self) -> bool:
         """Check whether the layer is conditioned."""
         return self.vis_x is not None
 
     # Used this great idea from this implementation of Otter (https://github.com/dhansmair/otter-mini/)
-    def condition_vis_x(self, vis_x) -> None:
+    def condition_vis_x(self, vis_x, repeats: int = 1) -> None:
+        """`repeats`: number of consecutive sequences (e.g. beams) sharing each element of `vis_x`."""
         self.vis_x = vis_x
+        self.media_repeats = repeats
+        self.media_kv = None
+
+    def condition_media_kv(self, media_kv) -> None:
+        """Cross-attention keys/values of `vis_x` projected beforehand, e.g. gathered from the media of each sequence of a running batch."""
+        self.media_kv = media_kv
 
     def condition_media_locations(self, media_locations) -> None:
         self.media_locations = media_locations
@@ -417,6 +551,9 @@ class OtterLayer(nn.Module):
     def condition_attend_previous(self, attend_previous) -> None:
         self.attend_previous = attend_previous
 
+    def condition_media_offset(self, media_offset) -> None:
+        self.media_offset = media_offset
+
     def forward(
         self,
         lang_x: torch.Tensor,
@@ -432,16 +569,89 @@ class OtterLayer(nn.Module):
         if self.media_locations is None:
             raise ValueError("media_locations must be conditioned before forward pass")
 
+        media = self.vis_x
+        media_kv = None
+        if not torch.is_grad_enabled():
+            # the media keys/values do not change between decoding steps, project them once per conditioning
+            # and only then expand them over the sequences sharing the media
+            if self.media_kv is None:
+                self.media_kv = tuple(repeat_batch(t, self.media_repeats) for t in self.gated_cross_attn_layer.attn.project_media(self.vis_x))
+            media_kv = self.media_kv
+        else:
+            media = repeat_batch(self.vis_x, self.media_repeats)
+
         lang_x = self.gated_cross_attn_layer(
             lang_x,
-            self.vis_x,
+            media,
             media_locations=self.media_locations,
             attend_previous=self.attend_previous,
+            media_kv=media_kv,
+            media_offset=self.media_offset,
         )
         lang_x = self.decoder_layer(lang_x, attention_mask=attention_mask, **decoder_layer_kwargs)
         return lang_x
 
 
+class OtterGenerationState:
+    """
+    Media seen so far by each sequence, so that cached decoding steps, which only see the new tokens, attend to the
+    same images as a full forward pass over the whole sequence would.
+    """
+
+    def __init__(self, media_locations: torch.BoolTensor, attend_previous: bool):
+        self.num_media = media_locations.sum(dim=-1)
+        self.attend_previous = attend_previous
+
+    def advance(self, media_locations: torch.BoolTensor) -> torch.LongTensor:
+        """Number of media tokens before `media_locations`, which are then added to the count."""
+        media_offset = self.num_media.clone()
+        # in place, so that a decoding step captured in a CUDA graph keeps counting in the same tensor
+        self.num_media.add_(media_locations.sum(dim=-1))
+        return media_offset
+
+    def fork(self, repeats: int = 1) -> "OtterGenerationState":
+        """A copy for `repeats` consecutive continuations of each sequence, which advances independently."""
+        state = OtterGenerationState.__new__(OtterGenerationState)
+        state.num_media = self.num_media.repeat_interleave(repeats, dim=0)
+        state.attend_previous = self.attend_previous
+        return state
+
+    def index_select(self, index: torch.LongTensor) -> "OtterGenerationState":
+        """The state of the sequences at `index`."""
+        state = OtterGenerationState.__new__(OtterGenerationState)
+        state.num_media = self.num_media.index_select(0, index)
+        state.attend_previous = self.attend_previous
+        return state
+
+    @staticmethod
+    def cat(states: List["OtterGenerationState"]) -> "OtterGenerationState":
+        """The state of the sequences of all `states`, one batch after the other."""
+        assert len({s.attend_previous for s in states}) == 1, "Expect the same media placement for all sequences."
+        state = OtterGenerationState.__new__(OtterGenerationState)
+        state.num_media = torch.cat([s.num_media for s in states])
+        state.attend_previous = states[0].attend_previous
+        return state
+
+
+@dataclass
+class OtterPrefixState:
+    """
+    Prefix sequences encoded by `OtterForConditionalGeneration.prefill`, to be continued with `extend` or `score`. A
+    state is never modified, the same prefix can be continued any number of times.
+    """
+
+    # perceiver output the prefix is conditioned on, (B, T_img, n, d)
+    vision_x: torch.Tensor
+    # language model cache of the prefix
+    past_key_values: Tuple
+    # (B, T_prefix)
+    attention_mask: torch.Tensor
+    # next token logits after the last (non padding) token of each prefix, (B, vocab_size)
+    logits: torch.Tensor
+    # media tokens seen in each prefix
+    generation_state: OtterGenerationState
+
+
 class OtterLMMixin(nn.Module):
     """
     Mixin to add cross-attention layers to a language model.
@@ -490,21 +700,31 @@ class OtterLMMixin(nn.Module):
 
         input_ids = kwargs["input_ids"] if "input_ids" in kwargs else input[0]
         media_locations = input_ids == self.media_token_id
-        # IMPORTANT: Force `attend_previous` to True when we place training data as <image>caption<|endofchunk|>
-        # attend_previous = (
-        #     (random.random() < 0.5) if self.use_media_placement_augmentation else False
-        # )
-        attend_previous = (random.random() < 0.5) if self.use_media_placement_augmentation else True
-        # attend_previous = self.only_attend_previous
+        generation_state = getattr(self, "generation_state", None)
+        if kwargs.get("past_key_values") is not None and generation_state is not None:
+            # cached decoding: input_ids only holds the new tokens, continue from the media seen so far
+            media_offset = generation_state.advance(media_locations)
+            attend_previous = generation_state.attend_previous
+        else:
+            media_offset = None
+            # IMPORTANT: Force `attend_previous` to True when we place training data as <image>caption<|endofchunk|>
+            # attend_previous = (
+            #     (random.random() < 0.5) if self.use_media_placement_augmentation else False
+            # )
+            attend_previous = (random.random() < 0.5) if self.use_media_placement_augmentation else True
+            # attend_previous = self.only_attend_previous
+            self.generation_state = OtterGenerationState(media_locations, attend_previous)
 
         if self.__class__.__name__ == "LlamaForCausalLM":
             for layer in self.get_decoder().layers:
                 layer.condition_media_locations(media_locations)
                 layer.condition_attend_previous(attend_previous)
+                layer.condition_media_offset(media_offset)
         elif self.__class__.__name__ in ["MPTForCausalLM", "MosaicGPT"]:
             for layer in self.get_decoder().blocks:
                 layer.condition_media_locations(media_locations)
                 layer.condition_attend_previous(attend_previous)
+                layer.condition_media_offset(media_offset)
         else:
             master_print("inavaliable text encoder")
         return super().forward(*input, **kwargs)  # Call the other parent's forward method
@@ -518,6 +738,8 @@ class OtterLMMixin(nn.Module):
             layer.condition_vis_x(None)
             layer.condition_media_locations(None)
             layer.condition_attend_previous(None)
+            layer.condition_media_offset(None)
+        self.generation_state = None
 
 
 class OtterPreTrainedModel(PreTrainedModel):
@@ -583,7 +805,15 @@ class OtterModel(OtterPreTrainedModel):
         self.vision_encoder = vision_encoder
 
         self.vis_dim = 1024
-        self.perceiver = OtterPerceiverResampler(dim=self.vis_dim, max_num_frames=self.max_num_frames)
+        # video knobs, set in the model config (e.g. through --customized_config): frames attended per video, pooling of
+        # the patch grid of each frame, and frames per vision encoder call
+        self.perceiver = OtterPerceiverResampler(
+            dim=self.vis_dim,
+            max_num_frames=self.max_num_frames,
+            max_attended_frames=config.max_attended_frames if hasattr(config, "max_attended_frames") else None,
+            frame_token_pool=config.frame_token_pool if hasattr(config, "frame_token_pool") else 1,
+        )
+        self.vision_encoder_chunk_size = config.vision_encoder_chunk_size if hasattr(config, "vision_encoder_chunk_size") else None
 
         self.lang_encoder.init_otter(
             media_token_id=self.media_token_id,
@@ -663,6 +893,7 @@ class OtterModel(OtterPreTrainedModel):
         clear_conditioned_layers: bool = True,
         past_key_values: Optional[List[torch.FloatTensor]] = None,
         use_cache: bool = False,
+        num_images: Optional[torch.LongTensor] = None,
         **kwargs,
     ) -> CausalLMOutputWithPast:
         """
@@ -684,6 +915,7 @@ class OtterModel(OtterPreTrainedModel):
                 CausalLM models.
             use_cache: whether to use cached key values. See use_cache
                 documentation in Hugging Face CausalLM models.
+            num_images: number of images of each sample when vision_x is packed, see `_encode_vision_x`.
         """
         assert (vision_x is not None) or use_cached_vision_x, "Must provide either vision_x or use_cached_vision_x to True."
 
@@ -695,7 +927,7 @@ class OtterModel(OtterPreTrainedModel):
 
         else:
             # Case: do not use caching (i.e. this is a standard forward pass);
-            self._encode_vision_x(vision_x=vision_x)
+            self._encode_vision_x(vision_x=vision_x, num_images=num_images)
 
         output = self.lang_encoder(
             input_ids=lang_x,
@@ -711,7 +943,7 @@ class OtterModel(OtterPreTrainedModel):
 
         return output
 
-    def _encode_vision_x(self, vision_x: torch.Tensor):
+    def _encode_vision_x(self, vision_x: torch.Tensor, num_images: Optional[torch.LongTensor] = None):
         """
         Compute media tokens from vision input by passing it through vision encoder and conditioning language model.
         Args:
@@ -719,18 +951,33 @@ class OtterModel(OtterPreTrainedModel):
                 shape (B, T_img, F, C, H, W)
                 Images in the same chunk are collated along T_img, and frames are collated along F
                 Currently only F=1 is supported (single-frame videos)
+                or precomputed vision encoder features of shape (B, T_img, F, v, d),
+                see pipeline/utils/extract_vision_features.py
+            num_images (torch.LongTensor, optional): number of images of each sample, shape (B,). When given, vision_x
+                only holds the real images of all samples back to back, shape (N, F, C, H, W) or (N, F, v, d) with
+                N = num_images.sum(), so that no padding images are encoded; the media of samples with fewer images than
+                the largest count are zero-filled.
 
         rearrange code based on https://github.com/dhansmair/flamingo-mini
         """
 
-        assert vision_x.ndim == 6, "vision_x should be of shape (b, T_img, F, C, H, W)"
-        b, T, F = vision_x.shape[:3]
-
-        vision_x = rearrange(vision_x, "b T F c h w -> (b T F) c h w")
-        vision_x = self.vision_encoder(vision_x)[0][:, 1:, :]
-        vision_x = rearrange(vision_x, "(b T F) v d -> b T F v d", b=b, T=T, F=F)
-
-        vision_x = self.perceiver(vision_x)  # reshapes to (b, T, n, d)
+        if exists(num_images):
+            # packed images are encoded as the media of a single sample, then scattered back per sample
+            vision_x = vision_x.unsqueeze(0)
+        assert vision_x.ndim in (5, 6), "vision_x should be of shape (b, T_img, F, C, H, W) or (b, T_img, F, v, d)"
+        frame_ids = self.perceiver.select_frames(vision_x.shape[2])
+        if exists(frame_ids):
+            # frames the perceiver does not attend to are not encoded either
+            vision_x = vision_x[:, :, frame_ids.to(vision_x.device)]
+        if vision_x.ndim == 6:
+            b, T, F = vision_x.shape[:3]
+            vision_x = rearrange(vision_x, "b T F c h w -> (b T F) c h w")
+            vision_x = encode_frames(self.vision_encoder, vision_x, self.vision_encoder_chunk_size)
+            vision_x = rearrange(vision_x, "(b T F) v d -> b T F v d", b=b, T=T, F=F)
+
+        vision_x = self.perceiver(vision_x, frame_ids=frame_ids)  # reshapes to (b, T, n, d)
+        if exists(num_images):
+            vision_x = unpack_media(vision_x[0], num_images)
 
         for layer in self.lang_encoder._get_decoder_layers():
             layer.condition_vis_x(vision_x)
@@ -796,7 +1043,15 @@ class OtterForConditionalGeneration(OtterPreTrainedModel):
         self.vision_encoder = vision_encoder
 
         self.vis_dim = 1024
-        self.perceiver = OtterPerceiverResampler(dim=self.vis_dim, max_num_frames=self.max_num_frames)
+        # video knobs, set in the model config (e.g. through --customized_config): frames attended per video, pooling of
+        # the patch grid of each frame, and frames per vision encoder call
+        self.perceiver = OtterPerceiverResampler(
+            dim=self.vis_dim,
+            max_num_frames=self.max_num_frames,
+            max_attended_frames=config.max_attended_frames if hasattr(config, "max_attended_frames") else None,
+            frame_token_pool=config.frame_token_pool if hasattr(config, "frame_token_pool") else 1,
+        )
+        self.vision_encoder_chunk_size = config.vision_encoder_chunk_size if hasattr(config, "vision_encoder_chunk_size") else None
 
         self.lang_encoder.init_otter(
             media_token_id=self.media_token_id,
@@ -924,6 +1179,7 @@ class OtterForConditionalGeneration(OtterPreTrainedModel):
         clear_conditioned_layers: bool = True,
         past_key_values: Optional[List[torch.FloatTensor]] = None,
         use_cache: bool = False,
+        num_images: Optional[torch.LongTensor] = None,
         **kwargs,
     ) -> CausalLMOutputWithPast:
         """
@@ -945,6 +1201,7 @@ class OtterForConditionalGeneration(OtterPreTrainedModel):
                 CausalLM models.
             use_cache: whether to use cached key values. See use_cache
                 documentation in Hugging Face CausalLM models.
+            num_images: number of images of each sample when vision_x is packed, see `_encode_vision_x`.
         """
         assert (vision_x is not None) or use_cached_vision_x, "Must provide either vision_x or use_cached_vision_x to True."
 
@@ -956,7 +1213,7 @@ class OtterForConditionalGeneration(OtterPreTrainedModel):
 
         else:
             # Case: do not use caching (i.e. this is a standard forward pass);
-            self._encode_vision_x(vision_x=vision_x)
+            self._encode_vision_x(vision_x=vision_x, num_images=num_images)
 
         output = self.lang_encoder(
             input_ids=lang_x,
@@ -972,7 +1229,7 @@ class OtterForConditionalGeneration(OtterPreTrainedModel):
 
         return output
 
-    def _encode_vision_x(self, vision_x: torch.Tensor):
+    def _encode_vision_x(self, vision_x: torch.Tensor, repeats: int = 1, num_images: Optional[torch.LongTensor] = None):
         """
         Compute media tokens from vision input by passing it through vision encoder and conditioning language model.
         Args:
@@ -980,21 +1237,38 @@ class OtterForConditionalGeneration(OtterPreTrainedModel):
                 shape (B, T_img, F, C, H, W)
                 Images in the same chunk are collated along T_img, and frames are collated along F
                 Currently only F=1 is supported (single-frame videos)
+                or precomputed vision encoder features of shape (B, T_img, F, v, d),
+                see pipeline/utils/extract_vision_features.py
+            num_images (torch.LongTensor, optional): number of images of each sample, shape (B,). When given, vision_x
+                only holds the real images of all samples back to back, shape (N, F, C, H, W) or (N, F, v, d) with
+                N = num_images.sum(), so that no padding images are encoded; the media of samples with fewer images than
+                the largest count are zero-filled.
+            repeats (int): number of consecutive language sequences sharing each element of vision_x, e.g. beams.
+                The media is encoded once per element and only expanded in the cross-attention layers.
 
         rearrange code based on https://github.com/dhansmair/flamingo-mini
         """
 
-        assert vision_x.ndim == 6, "vision_x should be of shape (b, T_img, F, C, H, W)"
-        b, T, F = vision_x.shape[:3]
-
-        vision_x = rearrange(vision_x, "b T F c h w -> (b T F) c h w")
-        vision_x = self.vision_encoder(vision_x)[0][:, 1:, :]
-        vision_x = rearrange(vision_x, "(b T F) v d -> b T F v d", b=b, T=T, F=F)
-
-        vision_x = self.perceiver(vision_x)  # reshapes to (b, T, n, d)
+        if exists(num_images):
+            # packed images are encoded as the media of a single sample, then scattered back per sample
+            vision_x = vision_x.unsqueeze(0)
+        assert vision_x.ndim in (5, 6), "vision_x should be of shape (b, T_img, F, C, H, W) or (b, T_img, F, v, d)"
+        frame_ids = self.perceiver.select_frames(vision_x.shape[2])
+        if exists(frame_ids):
+            # frames the perceiver does not attend to are not encoded either
+            vision_x = vision_x[:, :, frame_ids.to(vision_x.device)]
+        if vision_x.ndim == 6:
+            b, T, F = vision_x.shape[:3]
+            vision_x = rearrange(vision_x, "b T F c h w -> (b T F) c h w")
+            vision_x = encode_frames(self.vision_encoder, vision_x, self.vision_encoder_chunk_size)
+            vision_x = rearrange(vision_x, "(b T F) v d -> b T F v d", b=b, T=T, F=F)
+
+        vision_x = self.perceiver(vision_x, frame_ids=frame_ids)  # reshapes to (b, T, n, d)
+        if exists(num_images):
+            vision_x = unpack_media(vision_x[0], num_images)
 
         for layer in self.lang_encoder._get_decoder_layers():
-            layer.condition_vis_x(vision_x)
+            layer.condition_vis_x(vision_x, repeats=repeats)
 
     @torch.no_grad()
     def generate(
@@ -1002,6 +1276,7 @@ class OtterForConditionalGeneration(OtterPreTrainedModel):
         vision_x: torch.Tensor,
         lang_x: torch.Tensor,
         attention_mask: Optional[torch.Tensor] = None,
+        num_images: Optional[torch.LongTensor] = None,
         **generate_kwargs,
     ):
         """
@@ -1016,6 +1291,7 @@ class OtterForConditionalGeneration(OtterPreTrainedModel):
                 shape (B, T_txt)
             max_length (int, optional): Maximum length of the output. Defaults to None.
             attention_mask (torch.Tensor, optional): Attention mask. Defaults to None.
+            num_images (torch.LongTensor, optional): number of images of each sample when vision_x is packed, see `_encode_vision_x`.
         Returns:
             torch.Tensor: lang_x with generated tokens appended to it
         """
@@ -1028,9 +1304,8 @@ class OtterForConditionalGeneration(OtterPreTrainedModel):
             )
             add_hook_to_module(self.lang_encoder, hook)
         num_beams = generate_kwargs.get("num_beams", 1)
-        if num_beams > 1:
-            vision_x = vision_x.repeat_interleave(num_beams, dim=0)
-        self._encode_vision_x(vision_x=vision_x)
+        # beams of a sequence share its media, encode it once rather than once per beam
+        self._encode_vision_x(vision_x=vision_x, repeats=num_beams, num_images=num_images)
         output = self.lang_encoder.generate(
             input_ids=lang_x,
             attention_mask=attention_mask,
@@ -1040,3 +1315,128 @@ class OtterForConditionalGeneration(OtterPreTrainedModel):
 
         self.lang_encoder.clear_conditioned_layers()
         return output
+
+    def _position_kwargs(self, attention_mask: torch.Tensor, num_new_tokens: int) -> dict:
+        # Llama takes its positions from the caller: count real tokens only, so that padding on either side of a prefix
+        # or continuation does not shift them (like `generate`); other language models place the tokens themselves
+        if self.lang_encoder.__class__.__name__ != "LlamaForCausalLM":
+            return {}
+        position_ids = (attention_mask.long().cumsum(dim=-1) - 1).clamp(min=0)
+        return {"position_ids": position_ids[:, -num_new_tokens:]}
+
+    def _run_lang_encoder(self, vision_x, repeats, generation_state, lang_x, attention_mask, past_key_values=None):
+        """One cached language model pass over `lang_x` conditioned on `vision_x`, returning its output and the prefix state after it."""
+        for layer in self.lang_encoder._get_decoder_layers():
+            layer.condition_vis_x(vision_x, repeats=repeats)
+        self.lang_encoder.generation_state = generation_state
+        num_new_tokens = lang_x.shape[1]
+        output = self.lang_encoder(
+            input_ids=lang_x,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            **self._position_kwargs(attention_mask, num_new_tokens),
+        )
+        # logits after the last real token of each row, whether the new tokens are padded on the left or on the right
+        new_tokens_mask = attention_mask[:, -num_new_tokens:].long()
+        last_token = (torch.arange(num_new_tokens, device=lang_x.device) * new_tokens_mask).argmax(dim=-1)
+        state = OtterPrefixState(
+            vision_x=repeat_batch(vision_x, repeats),
+            past_key_values=output.past_key_values,
+            attention_mask=attention_mask,
+            logits=output.logits[torch.arange(lang_x.shape[0], device=lang_x.device), last_token],
+            generation_state=self.lang_encoder.generation_state,
+        )
+        self.lang_encoder.clear_conditioned_layers()
+        return output, state
+
+    @torch.no_grad()
+    def prefill(
+        self,
+        vision_x: torch.Tensor,
+        lang_x: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        num_images: Optional[torch.LongTensor] = None,
+    ) -> OtterPrefixState:
+        """
+        Encode shared prefixes, e.g. the in-context examples and the query image of a few-shot prompt, once for any
+        number of continuations with `extend` and `score`.
+
+        Args:
+            vision_x (torch.Tensor): Vision input, see `_encode_vision_x`
+            lang_x (torch.Tensor): Language input, padded on the left
+                shape (B, T_txt)
+            attention_mask (torch.Tensor, optional): Attention mask. Defaults to None.
+            num_images (torch.LongTensor, optional): number of images of each sample when vision_x is packed, see `_encode_vision_x`.
+        Returns:
+            OtterPrefixState: the encoded prefixes
+        """
+        if attention_mask is None:
+            attention_mask = torch.ones_like(lang_x)
+        self._encode_vision_x(vision_x=vision_x, num_images=num_images)
+        vision_x = self.lang_encoder._get_decoder_layers()[0].vis_x
+        # no cache yet, the language model counts the media of the prefix itself
+        _, state = self._run_lang_encoder(vision_x, 1, None, lang_x, attention_mask)
+        return state
+
+    @torch.no_grad()
+    def extend(self, state: OtterPrefixState, lang_x: torch.Tensor, attention_mask: Optional[torch.Tensor] = None) -> OtterPrefixState:
+        """
+        Continue each prefix of `state` with more tokens, e.g. a question about the prefix images.
+
+        Args:
+            state (OtterPrefixState): prefixes to continue, from `prefill` or `extend`; it is left untouched
+            lang_x (torch.Tensor): continuations without media tokens
+                shape (B * r, T_txt), the r continuations of each prefix being consecutive. With r > 1, the prefix cache
+                and media are expanded over them (as views for a single prefix). Padding on the right is allowed, except
+                on MPT with alibi, whose bias follows the column distance: the padding would shift the tokens after it.
+            attention_mask (torch.Tensor, optional): Attention mask of lang_x. Defaults to None.
+        Returns:
+            OtterPrefixState: the continued sequences, e.g. to score answers with `score`
+        """
+        if attention_mask is not None and not bool(attention_mask.all()) and self.lang_encoder.__class__.__name__ == "MPTForCausalLM" and self.lang_encoder.config.attn_config["alibi"]:
+            raise ValueError("Padded continuations cannot be extended on MPT with alibi, extend continuations of the same length instead.")
+        return self._continue(state, lang_x, attention_mask)[1]
+
+    @torch.no_grad()
+    def score(self, state: OtterPrefixState, candidates: List[torch.LongTensor], chunk_size: int = 64) -> torch.Tensor:
+        """
+        Log-likelihood of candidate continuations, e.g. class names or answer options, after each prefix of `state`.
+
+        Args:
+            state (OtterPrefixState): prefixes to score the candidates after, from `prefill` or `extend`
+            candidates (List[torch.LongTensor]): token ids of each candidate, without media tokens
+            chunk_size (int): number of (prefix, candidate) sequences run together, which bounds the memory taken by
+                the expanded prefix cache
+        Returns:
+            torch.Tensor: summed log-probabilities of the candidate tokens, shape (B, num_candidates)
+        """
+        batch_size = state.logits.shape[0]
+        first_token_log_probs = state.logits.float().log_softmax(dim=-1)
+        candidates_per_chunk = max(chunk_size // batch_size, 1)
+        scores = []
+        for start in range(0, len(candidates), candidates_per_chunk):
+            chunk = candidates[start : start + candidates_per_chunk]
+            # candidates are padded on the right (the padding id is masked out), and prefix b is continued with
+            # candidate c in row b * len(chunk) + c
+            lang_x = nn.utils.rnn.pad_sequence(chunk, batch_first=True, padding_value=self.eoc_token_id).to(state.logits.device)
+            candidate_mask = nn.utils.rnn.pad_sequence([torch.ones_like(c) for c in chunk], batch_first=True).to(state.logits.device)
+            lang_x, candidate_mask = lang_x.repeat(batch_size, 1), candidate_mask.repeat(batch_size, 1)
+            output, _ = self._continue(state, lang_x, candidate_mask)
+
+            log_probs = output.logits[:, :-1].float().log_softmax(dim=-1)
+            token_log_probs = log_probs.gather(-1, lang_x[:, 1:, None]).squeeze(-1) * candidate_mask[:, 1:]
+            first_log_probs = first_token_log_probs.repeat_interleave(len(chunk), dim=0).gather(-1, lang_x[:, :1]).squeeze(-1)
+            scores.append((first_log_probs + token_log_probs.sum(dim=-1)).view(batch_size, len(chunk)))
+        return torch.cat(scores, dim=1)
+
+    def _continue(self, state: OtterPrefixState, lang_x: torch.Tensor, attention_mask: Optional[torch.Tensor] = None):
+        batch_size = state.attention_mask.shape[0]
+        assert lang_x.shape[0] % batch_size == 0, "Expect the same number of continuations for every prefix."
+        repeats = lang_x.shape[0] // batch_size
+        if attention_mask is None:
+            attention_mask = torch.ones_like(lang_x)
+        attention_mask = torch.cat([repeat_batch(state.attention_mask, repeats), attention_mask.to(state.attention_mask.dtype)], dim=1)
+        # a list, which MPT updates in place
+        past_key_values = [tuple(repeat_batch(t, repeats) for t in layer_past) for layer_past in state.past_key_values]
+        return self._run_lang_encoder(state.vision_x, repeats, state.generation_state.fork(repeats), lang_x, attention_mask, past_key_values)
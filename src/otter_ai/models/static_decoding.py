@@ -0,0 +1,183 @@
+"""Low-latency decoding for Otter models on MPT.
+
+`StaticDecoder` runs the prompt eagerly into a `StaticKVCache`, a preallocated cache of fixed capacity written in place,
+so that every decoding step has the same shapes and reads and writes the same tensors. On CUDA the one-token decoding
+step, cross-attention layers included, is captured once per batch size and media shape in a CUDA graph and replayed
+for every later token, instead of launching its many small kernels from Python one by one.
+"""
+
+from typing import Dict, Optional
+
+import torch
+
+from .mpt.attention import StaticKVCache
+
+
+class DecodeGraph:
+    """A captured decoding step and the tensors it reads: the input tokens, the media keys/values and media counts."""
+
+    def __init__(self, tokens: torch.LongTensor, media_kv, num_media: torch.LongTensor):
+        self.tokens = tokens
+        self.media_kv = media_kv
+        self.num_media = num_media
+        self.graph = None
+        self.logits = None
+
+    def bind(self, xattn_layers, generation_state):
+        """Point the layers and the generation state of a new prompt at the tensors the graph reads."""
+        for layer, buffers in zip(xattn_layers, self.media_kv):
+            for buffer, t in zip(buffers, layer.media_kv):
+                buffer.copy_(t)
+            layer.media_kv = buffers
+        self.num_media.copy_(generation_state.num_media)
+        generation_state.num_media = self.num_media
+
+    def replay(self, tokens: torch.LongTensor) -> torch.Tensor:
+        self.tokens.copy_(tokens)
+        self.graph.replay()
+        return self.logits
+
+
+class StaticDecoder:
+    """
+    Greedy or sampled decoding with a static KV cache, see the module docstring.
+
+    Args:
+        model: an `OtterForConditionalGeneration` whose language model is `MPTForCausalLM`
+        max_length: capacity of the cache, prompt and generated tokens included
+        use_cuda_graph: replay the decoding step from a CUDA graph, by default when the model is on CUDA
+    """
+
+    def __init__(self, model, max_length: int = 2048, use_cuda_graph: Optional[bool] = None):
+        if not hasattr(model.lang_encoder, "make_static_cache"):
+            raise NotImplementedError(f"Static decoding is only implemented for MPT, not {model.lang_encoder.__class__.__name__}.")
+        self.model = model
+        self.lang_encoder = model.lang_encoder
+        self.max_length = max_length
+        device = self.lang_encoder.get_input_embeddings().weight.device
+        self.use_cuda_graph = device.type == "cuda" if use_cuda_graph is None else use_cuda_graph
+        self.caches: Dict[int, StaticKVCache] = {}
+        self.graphs: Dict[tuple, DecodeGraph] = {}
+        self.graph_pool = None
+
+    def cache(self, batch_size: int) -> StaticKVCache:
+        # one cache per batch size, which the graphs of that batch size read
+        if batch_size not in self.caches:
+            self.caches[batch_size] = self.lang_encoder.make_static_cache(batch_size, self.max_length)
+        return self.caches[batch_size]
+
+    @torch.no_grad()
+    def generate(
+        self,
+        vision_x: torch.Tensor,
+        lang_x: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        num_images: Optional[torch.LongTensor] = None,
+        max_new_tokens: int = 512,
+        eos_token_id: Optional[int] = None,
+        pad_token_id: Optional[int] = None,
+        do_sample: bool = False,
+        temperature: float = 1.0,
+        streamer=None,
+    ) -> torch.LongTensor:
+        """
+        Args:
+            vision_x (torch.Tensor): Vision input, see `OtterForConditionalGeneration._encode_vision_x`
+            lang_x (torch.Tensor): Language input, padded on the left
+                shape (B, T_txt)
+            attention_mask (torch.Tensor, optional): Attention mask. Defaults to None.
+            num_images (torch.LongTensor, optional): number of images of each sample when vision_x is packed.
+            max_new_tokens (int): maximum number of generated tokens
+            eos_token_id (int, optional): sequences stop after generating it, and are padded with `pad_token_id`
+                (`eos_token_id` by default) until all of them stop
+            do_sample (bool): sample the tokens at `temperature` instead of taking the most likely one
+            streamer: a `transformers` streamer, as taken by `generate`
+        Returns:
+            torch.LongTensor: the prompts followed by the generated tokens, as returned by `generate`
+        """
+        batch_size, prompt_len = lang_x.shape
+        if prompt_len + max_new_tokens > self.max_length:
+            raise ValueError(f"{prompt_len} prompt tokens + {max_new_tokens} new tokens do not fit in a cache of max_length={self.max_length}.")
+        if attention_mask is None:
+            attention_mask = torch.ones_like(lang_x)
+        pad_token_id = eos_token_id if pad_token_id is None else pad_token_id
+        if streamer is not None:
+            streamer.put(lang_x.cpu())
+
+        self.model._encode_vision_x(vision_x=vision_x, num_images=num_images)
+        cache = self.cache(batch_size)
+        cache.reset()
+        # the prompt starts a new count of the media tokens
+        self.lang_encoder.generation_state = None
+        try:
+            logits = self.lang_encoder(input_ids=lang_x, attention_mask=attention_mask, past_key_values=cache).logits[:, -1]
+            step = self.decode_step(cache)
+            unfinished = torch.ones(batch_size, dtype=torch.bool, device=lang_x.device)
+            generated = []
+            for i in range(max_new_tokens):
+                if do_sample:
+                    next_tokens = torch.multinomial((logits.float() / temperature).softmax(dim=-1), num_samples=1).squeeze(1)
+                else:
+                    next_tokens = logits.argmax(dim=-1)
+                if eos_token_id is not None:
+                    next_tokens = next_tokens.masked_fill(~unfinished, pad_token_id)
+                    unfinished &= next_tokens != eos_token_id
+                generated.append(next_tokens)
+                if streamer is not None:
+                    streamer.put(next_tokens.cpu())
+                if i + 1 == max_new_tokens or (eos_token_id is not None and not unfinished.any()):
+                    break
+                logits = step(next_tokens)
+        finally:
+            self.lang_encoder.clear_conditioned_layers()
+            if streamer is not None:
+                streamer.end()
+        return torch.cat([lang_x, torch.stack(generated, dim=1)], dim=1)
+
+    def decode_step(self, cache: StaticKVCache):
+        """The function running one decoding step, from the tokens (B,) to the next token logits (B, vocab_size)."""
+
+        def eager_step(tokens):
+            return self.lang_encoder(input_ids=tokens[:, None], past_key_values=cache).logits[:, -1]
+
+        if not self.use_cuda_graph:
+            return eager_step
+
+        xattn_layers = [layer for layer in self.lang_encoder._get_decoder_layers() if layer.gated_cross_attn_layer is not None]
+        generation_state = self.lang_encoder.generation_state
+        # everything a step depends on beyond the tensors read by the graph: the batch size (and with it the cache) and
+        # how the tokens attend to the media
+        key = (cache.batch_size, tuple(xattn_layers[0].vis_x.shape), xattn_layers[0].media_repeats, generation_state.attend_previous)
+        graph = self.graphs.get(key)
+        if graph is not None:
+            graph.bind(xattn_layers, generation_state)
+            return graph.replay
+
+        def graph_step(tokens):
+            graph = self.graphs.get(key)
+            if graph is None:
+                return self.capture(key, tokens, eager_step, xattn_layers, generation_state)
+            return graph.replay(tokens)
+
+        return graph_step
+
+    def capture(self, key, tokens, eager_step, xattn_layers, generation_state) -> torch.Tensor:
+        """Run the first decoding step of `key` eagerly on a side stream, which also warms it up, then capture it."""
+        graph = DecodeGraph(
+            tokens.clone(),
+            [tuple(t.clone() for t in layer.media_kv) for layer in xattn_layers],
+            generation_state.num_media.clone(),
+        )
+        graph.bind(xattn_layers, generation_state)
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            logits = eager_step(graph.tokens).clone()
+        torch.cuda.current_stream().wait_stream(stream)
+        # capturing only records the kernels, the cache and the media counts are left as they are
+        graph.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph.graph, pool=self.graph_pool):
+            graph.logits = eager_step(graph.tokens)
+        self.graph_pool = graph.graph.pool()
+        self.graphs[key] = graph
+        return logits
@@ -0,0 +1,40 @@
+import unittest
+
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+from pipeline.mimicit_utils.data import CaptionBatchTokenizer
+
+
+def tiny_tokenizer():
+    words = ["a", "cat", "dog", "on", "the", "mat", "sits", "in", "sun"]
+    vocab = {token: i for i, token in enumerate(["[PAD]", "[UNK]", "</s>", "<image>", "<|endofchunk|>", "[INST]", "[/INST]"] + words)}
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+    backend.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(tokenizer_object=backend, pad_token="[PAD]", eos_token="</s>", unk_token="[UNK]", additional_special_tokens=["<image>", "<|endofchunk|>", "[INST]", "[/INST]"])
+
+
+class TestCaptionBatchTokenizer(unittest.TestCase):
+    def test_matches_tokenizer_call(self):
+        tokenizer = tiny_tokenizer()
+        # a short caption, a truncated one and raw bytes from a webdataset sample
+        captions = [" a cat sits on the mat ", " ".join(["the dog"] * 10), b"a dog in the sun"]
+        CaptionBatchTokenizer(tokenizer, max_length=12)(captions)
+        # the private backend leaves the padding and truncation settings of the tokenizer alone
+        self.assertIsNone(tokenizer.backend_tokenizer.padding)
+        self.assertIsNone(tokenizer.backend_tokenizer.truncation)
+
+        for prompt_format in ["simple", "llama2_inst"]:
+            caption_tokenizer = CaptionBatchTokenizer(tokenizer, max_length=12, prompt_format=prompt_format)
+            input_ids, attention_mask = caption_tokenizer(captions)
+            self.assertEqual(input_ids.shape, (3, 12))
+            self.assertEqual(input_ids.dtype, torch.int64)
+
+            expected = tokenizer([caption_tokenizer.format(c) for c in captions], max_length=12, padding="max_length", truncation=True, return_tensors="pt")
+            self.assertTrue(torch.equal(input_ids, expected["input_ids"]))
+            self.assertTrue(torch.equal(attention_mask, expected["attention_mask"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
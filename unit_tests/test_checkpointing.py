@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+
+import torch
+
+from pipeline.train.checkpointing import AsyncCheckpointWriter, load_checkpoint
+
+
+class TestAsyncCheckpointWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.state_dict = {f"layers.{i}.weight": torch.randn(16, 16) for i in range(4)}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_sharded_round_trip(self):
+        writer = AsyncCheckpointWriter(self.tmp_dir.name, max_shard_bytes=2 * 16 * 16 * 4)
+        writer.save(self.state_dict, "final_weights", metadata={"steps": 10})
+        # the snapshot must not alias the live tensors
+        self.state_dict["layers.0.weight"].zero_()
+        writer.close()
+
+        self.assertEqual(len([f for f in os.listdir(self.tmp_dir.name) if f.endswith(".safetensors")]), 2)
+        loaded = load_checkpoint(os.path.join(self.tmp_dir.name, "final_weights.safetensors.index.json"))
+        self.assertEqual(set(loaded), set(self.state_dict))
+        self.assertFalse(torch.equal(loaded["layers.0.weight"], self.state_dict["layers.0.weight"]))
+        self.assertTrue(torch.equal(loaded["layers.1.weight"], self.state_dict["layers.1.weight"]))
+
+    def test_keeps_last_n_per_series(self):
+        writer = AsyncCheckpointWriter(self.tmp_dir.name, keep_last_n=2)
+        for step in (100, 200, 300):
+            writer.save(self.state_dict, f"checkpoint_steps_{step}", series="steps")
+        writer.save(self.state_dict, "final_weights")
+        writer.close()
+
+        index_files = sorted(f for f in os.listdir(self.tmp_dir.name) if f.endswith(".index.json"))
+        self.assertEqual(index_files, ["checkpoint_steps_200.safetensors.index.json", "checkpoint_steps_300.safetensors.index.json", "final_weights.safetensors.index.json"])
+        self.assertFalse(any(f.startswith("checkpoint_steps_100") for f in os.listdir(self.tmp_dir.name)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+
+import torch
+
+from src.otter_ai.models.continuous_batching import ContinuousBatchingEngine
+from unit_tests.tiny_otter import TinyOtter
+
+
+def greedy_full_forward(model, images, input_ids, max_new_tokens, eos_token_id):
+    generated = []
+    with torch.no_grad():
+        for _ in range(max_new_tokens):
+            next_token = int(model(images, input_ids, torch.ones_like(input_ids)).logits[0, -1].argmax())
+            generated.append(next_token)
+            if next_token == eos_token_id:
+                break
+            input_ids = torch.cat([input_ids, torch.tensor([[next_token]])], dim=1)
+    return generated
+
+
+class TestContinuousBatching(unittest.TestCase):
+    def test_matches_each_request_alone(self):
+        for lang_model in ["llama", "mpt"]:
+            with self.subTest(lang_model=lang_model):
+                torch.manual_seed(0)
+                model = TinyOtter(lang_model=lang_model).eval()
+                for layer in model.lang_encoder._get_decoder_layers():
+                    if layer.gated_cross_attn_layer is not None:
+                        # the gates start closed, open them so that the cross-attention output matters
+                        layer.gated_cross_attn_layer.attn_gate.data.fill_(1.0)
+                # prompts of different lengths and image counts, the last one joining while the first is generating
+                prompts = []
+                for num_images, length, max_new_tokens in [(2, 10, 7), (1, 6, 3), (3, 12, 5)]:
+                    input_ids = torch.randint(7, 100, (1, length))
+                    input_ids[0, torch.arange(num_images) * 4] = 5
+                    prompts.append((torch.randn(1, num_images, 1, 3, 32, 32), input_ids, max_new_tokens))
+                expected = [greedy_full_forward(model, images, input_ids, max_new_tokens, model.eoc_token_id) for images, input_ids, max_new_tokens in prompts]
+
+                engine = ContinuousBatchingEngine(model, max_batch_size=2)
+                requests = [engine.submit(images, input_ids, max_new_tokens=max_new_tokens) for images, input_ids, max_new_tokens in prompts]
+                self.assertTrue(engine.step())
+                self.assertEqual(len(engine.requests), 2)
+                while engine.step():
+                    self.assertLessEqual(len(engine.requests), 2)
+                for request, expected_tokens in zip(requests, expected):
+                    self.assertEqual(list(request), expected_tokens)
+                self.assertFalse(model.lang_encoder.is_conditioned())
+
+
+if __name__ == "__main__":
+    unittest.main()
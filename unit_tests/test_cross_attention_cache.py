@@ -0,0 +1,79 @@
+import unittest
+
+import torch
+
+from unit_tests.tiny_otter import TinyOtter
+
+
+class TestMediaKVCache(unittest.TestCase):
+    def test_media_projected_once_per_conditioning(self):
+        torch.manual_seed(0)
+        model = TinyOtter().eval()
+        images = torch.randn(2, 2, 1, 3, 32, 32)
+        input_ids = torch.randint(6, 100, (2, 12))
+        input_ids[:, [0, 5]] = 5
+        attention_mask = torch.ones_like(input_ids)
+        expected = model(images, input_ids, attention_mask).logits
+
+        xattn_layers = [layer for layer in model.lang_encoder._get_decoder_layers() if layer.gated_cross_attn_layer is not None]
+        calls = []
+        for layer in xattn_layers:
+            layer.gated_cross_attn_layer.attn.to_kv.register_forward_hook(lambda *_: calls.append(1))
+        with torch.no_grad():
+            first = model(images, input_ids, attention_mask).logits
+            second = model.lang_encoder(input_ids=input_ids, attention_mask=attention_mask).logits
+        self.assertTrue(torch.allclose(expected, first, atol=1e-5))
+        self.assertTrue(torch.equal(first, second))
+        self.assertEqual(len(calls), len(xattn_layers))
+
+        model.lang_encoder.clear_conditioned_layers()
+        self.assertTrue(all(layer.media_kv is None for layer in xattn_layers))
+
+    def test_cached_decoding_matches_full_forward(self):
+        torch.manual_seed(0)
+        model = TinyOtter().eval()
+        for layer in model.lang_encoder._get_decoder_layers():
+            if layer.gated_cross_attn_layer is not None:
+                # the gates start closed, open them so that the cross-attention output matters
+                layer.gated_cross_attn_layer.attn_gate.data.fill_(1.0)
+        images = torch.randn(2, 2, 1, 3, 32, 32)
+        input_ids = torch.randint(6, 100, (2, 12))
+        # the second image of the first sequence only shows up in the decoded tokens
+        input_ids[0, [0, 9]] = 5
+        input_ids[1, [0, 3]] = 5
+        attention_mask = torch.ones_like(input_ids)
+        with torch.no_grad():
+            expected = model(images, input_ids, attention_mask).logits
+            outputs = model(images, input_ids[:, :8], attention_mask[:, :8])
+            logits = [outputs.logits]
+            past_key_values = outputs.past_key_values
+            for i in range(8, 12):
+                outputs = model.lang_encoder(input_ids=input_ids[:, i : i + 1], attention_mask=attention_mask[:, : i + 1], past_key_values=past_key_values)
+                logits.append(outputs.logits)
+                past_key_values = outputs.past_key_values
+        self.assertTrue(torch.allclose(expected, torch.cat(logits, dim=1), atol=1e-5))
+
+    def test_media_shared_over_repeated_sequences(self):
+        torch.manual_seed(0)
+        model = TinyOtter().eval()
+        for layer in model.lang_encoder._get_decoder_layers():
+            if layer.gated_cross_attn_layer is not None:
+                layer.gated_cross_attn_layer.attn_gate.data.fill_(1.0)
+        vis_x = torch.randn(2, 2, 8, 64)
+        input_ids = torch.randint(6, 100, (6, 12))
+        input_ids[:, [0, 5]] = 5
+        logits = []
+        with torch.no_grad():
+            for vision_features, repeats in [(vis_x.repeat_interleave(3, dim=0), 1), (vis_x, 3), (vis_x[:1], 6)]:
+                for layer in model.lang_encoder._get_decoder_layers():
+                    layer.condition_vis_x(vision_features, repeats=repeats)
+                logits.append(model.lang_encoder(input_ids=input_ids).logits)
+        self.assertTrue(torch.allclose(logits[0], logits[1], atol=1e-6))
+        self.assertEqual(logits[2].shape, logits[0].shape)
+        # a single element is expanded as a view
+        xattn_layer = next(layer for layer in model.lang_encoder._get_decoder_layers() if layer.gated_cross_attn_layer is not None)
+        self.assertEqual(xattn_layer.media_kv[0].stride(0), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+
+import torch
+from safetensors.torch import save_file
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from src.otter_ai.models.delta_checkpoint import DeltaOverlay, make_delta, read_delta_metadata, save_delta
+
+
+def tiny_llama(hidden_size=32):
+    return LlamaForCausalLM(LlamaConfig(vocab_size=50, hidden_size=hidden_size, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4)).eval()
+
+
+class TestDeltaCheckpoint(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.base_dir = os.path.join(self.tmp_dir.name, "base")
+        self.base = tiny_llama()
+        self.base.save_pretrained(self.base_dir, safe_serialization=True)
+        self.base_state = {name: tensor.clone() for name, tensor in self.base.state_dict().items()}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assert_state(self, model, expected):
+        for name, tensor in model.state_dict().items():
+            self.assertTrue(torch.equal(tensor, expected[name]), name)
+
+    def test_make_delta_apply_and_reset(self):
+        finetuned = tiny_llama()
+        finetuned.load_state_dict(self.base_state)
+        with torch.no_grad():
+            finetuned.model.layers[1].mlp.up_proj.weight.add_(1.0)
+            finetuned.lm_head.weight.mul_(2.0)
+        finetuned_dir = os.path.join(self.tmp_dir.name, "finetuned")
+        finetuned.save_pretrained(finetuned_dir, safe_serialization=True)
+        delta_path = os.path.join(self.tmp_dir.name, "delta.safetensors")
+        self.assertEqual(sorted(make_delta(self.base_dir, finetuned_dir, delta_path)), ["lm_head.weight", "model.layers.1.mlp.up_proj.weight"])
+
+        overlay = DeltaOverlay(self.base, self.base_dir)
+        self.assertEqual(sorted(overlay.apply(delta_path)), ["lm_head.weight", "model.layers.1.mlp.up_proj.weight"])
+        self.assert_state(self.base, finetuned.state_dict())
+        # another delta replaces the first one instead of stacking on it
+        other_path = os.path.join(self.tmp_dir.name, "other.safetensors")
+        save_delta({"model.norm.weight": torch.full((32,), 3.0)}, other_path, self.base_dir)
+        self.assertEqual(overlay.apply(other_path), ["model.norm.weight"])
+        self.assertTrue(torch.equal(self.base.lm_head.weight, self.base_state["lm_head.weight"]))
+        overlay.reset()
+        self.assert_state(self.base, self.base_state)
+        self.assertIsNone(overlay.delta_path)
+
+    def test_rejects_other_base_models(self):
+        other_dir = os.path.join(self.tmp_dir.name, "other_base")
+        tiny_llama(hidden_size=64).save_pretrained(other_dir, safe_serialization=True)
+        delta_path = os.path.join(self.tmp_dir.name, "delta.safetensors")
+        save_delta({"lm_head.weight": torch.zeros(50, 64)}, delta_path, other_dir)
+        self.assertEqual(read_delta_metadata(delta_path)["base_model"], other_dir)
+
+        overlay = DeltaOverlay(self.base, self.base_dir)
+        with self.assertRaisesRegex(ValueError, "does not match the loaded base model"):
+            overlay.apply(delta_path)
+        plain_path = os.path.join(self.tmp_dir.name, "plain.safetensors")
+        save_file({"lm_head.weight": torch.zeros(50, 32)}, plain_path)
+        with self.assertRaisesRegex(ValueError, "is not a delta checkpoint"):
+            overlay.apply(plain_path)
+        self.assert_state(self.base, self.base_state)
+
+    def test_rejects_base_models_with_other_weights(self):
+        # same architecture and file layout, only the weights differ
+        other_dir = os.path.join(self.tmp_dir.name, "other_base")
+        tiny_llama().save_pretrained(other_dir, safe_serialization=True)
+        delta_path = os.path.join(self.tmp_dir.name, "delta.safetensors")
+        save_delta({"lm_head.weight": torch.zeros(50, 32)}, delta_path, other_dir)
+
+        overlay = DeltaOverlay(self.base, self.base_dir)
+        with self.assertRaisesRegex(ValueError, "does not match the loaded base model"):
+            overlay.apply(delta_path)
+        self.assert_state(self.base, self.base_state)
+        self.assertEqual(DeltaOverlay(self.base, other_dir).apply(delta_path), ["lm_head.weight"])
+
+
+if __name__ == "__main__":
+    unittest.main()
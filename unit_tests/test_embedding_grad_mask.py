@@ -0,0 +1,64 @@
+import unittest
+
+import torch
+import torch.nn as nn
+
+from pipeline.train.train_utils import register_embedding_grad_mask
+
+
+class TestEmbeddingGradMask(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.input_ids = torch.tensor([[1, 2, 3, 5, 7]])
+        self.token_ids = [2, 5, 8]
+
+    def forward(self, embedding, lm_head):
+        logits = lm_head(embedding(self.input_ids))
+        return logits.log_softmax(dim=-1)[0, :-1].gather(-1, self.input_ids[0, 1:, None]).sum()
+
+    def mask(self, grad):
+        kept = torch.zeros(grad.shape[0], 1, dtype=torch.bool)
+        kept[self.token_ids] = True
+        return grad * kept
+
+    def expected_grad(self, embedding, lm_head, mask=True):
+        self.forward(embedding, lm_head).backward()
+        grad, embedding.weight.grad = embedding.weight.grad.clone(), None
+        return self.mask(grad) if mask else grad
+
+    def test_only_token_rows_keep_a_gradient(self):
+        embedding, lm_head = nn.Embedding(10, 4), nn.Linear(4, 10, bias=False)
+        full_grad = self.expected_grad(embedding, lm_head, mask=False)
+        # an earlier hook keeps the gradient it was given, which the mask must leave as is
+        seen = []
+        embedding.weight.register_hook(seen.append)
+        register_embedding_grad_mask(embedding, self.token_ids)
+        self.forward(embedding, lm_head).backward()
+        self.assertTrue(torch.equal(seen[0], full_grad))
+        self.assertTrue(torch.equal(embedding.weight.grad, self.mask(full_grad)))
+        # rows 2 and 5 are in the input, row 8 is not
+        self.assertEqual(embedding.weight.grad.abs().sum(dim=-1).nonzero().flatten().tolist(), [2, 5])
+        # accumulated over a second backward, zeroed in place
+        grad = embedding.weight.grad
+        self.forward(embedding, lm_head).backward()
+        self.assertIs(embedding.weight.grad, grad)
+        self.assertTrue(torch.allclose(grad, 2 * self.mask(full_grad)))
+
+    def test_tied_weights(self):
+        embedding, lm_head = nn.Embedding(10, 4), nn.Linear(4, 10, bias=False)
+        lm_head.weight = embedding.weight
+        expected = self.expected_grad(embedding, lm_head)
+        handles = [register_embedding_grad_mask(module, self.token_ids) for module in (embedding, lm_head)]
+        self.forward(embedding, lm_head).backward()
+        self.assertTrue(torch.equal(embedding.weight.grad, expected))
+        self.assertEqual(embedding.weight.grad.abs().sum(dim=-1).nonzero().flatten().tolist(), [2, 5, 8])
+
+        for handle in handles:
+            handle.remove()
+        embedding.weight.grad = None
+        self.forward(embedding, lm_head).backward()
+        self.assertTrue((embedding.weight.grad.abs().sum(dim=-1) > 0).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
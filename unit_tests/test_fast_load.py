@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from src.otter_ai.models.fast_load import FINGERPRINT_FILE, fast_from_pretrained
+
+
+def tiny_llama(seed):
+    torch.manual_seed(seed)
+    return LlamaForCausalLM(LlamaConfig(vocab_size=50, hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4)).eval()
+
+
+def fused_dirs(cache_dir):
+    return [name for name in os.listdir(cache_dir) if os.path.isdir(os.path.join(cache_dir, name))]
+
+
+class TestFastLoad(unittest.TestCase):
+    def assert_loads(self, model_dir, cache_dir, expected):
+        model, _ = fast_from_pretrained(LlamaForCausalLM, model_dir, device="cpu", torch_dtype=torch.float32, cache_dir=cache_dir)
+        for name, tensor in model.state_dict().items():
+            self.assertTrue(torch.equal(tensor, expected[name]), name)
+
+    def test_fused_checkpoint_round_trip(self):
+        base = tiny_llama(0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            base_dir = os.path.join(tmp_dir, "base")
+            base.save_pretrained(base_dir, safe_serialization=True)
+            # trained weights as saved by the training scripts, from a DDP-wrapped model
+            checkpoint_path = os.path.join(tmp_dir, "final_weights.pt")
+            trained = {"lm_head.weight": torch.randn(50, 32), "model.norm.weight": torch.randn(32)}
+            torch.save({"model_state_dict": {f"module.{name}": tensor for name, tensor in trained.items()}}, checkpoint_path)
+            expected = {**base.state_dict(), **trained}
+
+            cache_dir = os.path.join(tmp_dir, "fused")
+            for torch_dtype in [torch.float32, torch.bfloat16, torch.float32]:
+                model, overlay = fast_from_pretrained(LlamaForCausalLM, base_dir, device="cpu", torch_dtype=torch_dtype, checkpoint_path=checkpoint_path, cache_dir=cache_dir)
+                state_dict = model.state_dict()
+                self.assertEqual(state_dict.keys(), expected.keys())
+                for name, tensor in state_dict.items():
+                    self.assertEqual(tensor.dtype, torch_dtype)
+                    self.assertTrue(torch.equal(tensor, expected[name].to(torch_dtype)), name)
+                self.assertEqual(overlay.base_model_name_or_path, base_dir)
+            # one fused checkpoint per dtype, the last load reused the first one
+            self.assertEqual(len(fused_dirs(cache_dir)), 2)
+
+    def test_models_with_other_weights_are_not_shared(self):
+        # same architecture and file sizes, only the weights differ
+        models = [tiny_llama(0), tiny_llama(1)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_dir = os.path.join(tmp_dir, "fused")
+            model_dirs = [os.path.join(tmp_dir, f"m{i}") for i in range(2)]
+            for model, model_dir in zip(models, model_dirs):
+                model.save_pretrained(model_dir, safe_serialization=True)
+                self.assert_loads(model_dir, cache_dir, model.state_dict())
+            self.assertEqual(len(fused_dirs(cache_dir)), 2)
+
+            # a model overwritten in place is converted again
+            models[0].save_pretrained(model_dirs[1], safe_serialization=True)
+            self.assert_loads(model_dirs[1], cache_dir, models[0].state_dict())
+
+    def test_rebuilds_fused_checkpoint_with_other_fingerprint(self):
+        model = tiny_llama(0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_dir, model_dir = os.path.join(tmp_dir, "fused"), os.path.join(tmp_dir, "model")
+            model.save_pretrained(model_dir, safe_serialization=True)
+            self.assert_loads(model_dir, cache_dir, model.state_dict())
+            # e.g. the weights of another model left under the same directory
+            (fused_dir,) = fused_dirs(cache_dir)
+            tiny_llama(1).save_pretrained(os.path.join(cache_dir, fused_dir), safe_serialization=True)
+            with open(os.path.join(cache_dir, fused_dir, FINGERPRINT_FILE), "w") as f:
+                f.write("stale")
+            self.assert_loads(model_dir, cache_dir, model.state_dict())
+
+
+if __name__ == "__main__":
+    unittest.main()
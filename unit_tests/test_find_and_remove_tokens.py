@@ -0,0 +1,35 @@
+import unittest
+from types import SimpleNamespace
+
+import torch
+
+from pipeline.train.train_utils import find_and_remove_tokens
+from pipeline.utils.benchmark_find_and_remove_tokens import loop_find_and_remove_tokens
+
+
+class TestFindAndRemoveTokens(unittest.TestCase):
+    def test_matches_per_row_implementation(self):
+        tokenizer = SimpleNamespace(pad_token_id=0)
+        generator = torch.Generator().manual_seed(0)
+        for _ in range(50):
+            batch_size, seq_len = torch.randint(1, 6, (2,), generator=generator).tolist()
+            input_ids = torch.randint(1, 5, (batch_size, seq_len + 1), generator=generator)
+            labels = torch.randint(-100, 5, (batch_size, seq_len + 1), generator=generator)
+            attention_mask = torch.randint(0, 2, (batch_size, seq_len + 1), generator=generator)
+
+            expected = loop_find_and_remove_tokens(input_ids, labels, attention_mask, 3, tokenizer)
+            actual = find_and_remove_tokens(input_ids, labels, attention_mask, 3, tokenizer)
+            for e, a in zip(expected, actual):
+                self.assertTrue(torch.equal(e, a))
+                self.assertEqual(e.dtype, a.dtype)
+
+    def test_all_tokens_removed(self):
+        input_ids = torch.full((2, 4), 3)
+        new_input, new_labels, new_attention_mask = find_and_remove_tokens(input_ids, input_ids.clone(), torch.ones_like(input_ids), 3, SimpleNamespace(pad_token_id=0))
+        self.assertEqual(new_input.shape, (2, 0))
+        self.assertEqual(new_labels.shape, (2, 0))
+        self.assertEqual(new_attention_mask.shape, (2, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
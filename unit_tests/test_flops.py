@@ -0,0 +1,60 @@
+import unittest
+
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from pipeline.train.flops import FlopsAccountant
+from unit_tests.tiny_otter import TinyOtter
+
+
+class TestFlopsAccountant(unittest.TestCase):
+    def test_forward_flops_match_flop_counter(self):
+        model = TinyOtter().eval().requires_grad_(False)
+        for module in model.modules():
+            if hasattr(module, "use_sdpa"):
+                # the flop counter has no formula for the fused CPU attention kernel, compare on the einsum path
+                module.use_sdpa = False
+        images = torch.randn(2, 2, 1, 3, 32, 32)
+        input_ids = torch.randint(6, 100, (2, 40))
+        input_ids[:, [0, 10]] = 5
+        attention_mask = torch.ones_like(input_ids)
+
+        with FlopCounterMode(display=False) as flop_counter, torch.no_grad():
+            model(images, input_ids, attention_mask)
+        flops, num_images = FlopsAccountant(model).step_flops(attention_mask, images=images)
+        self.assertEqual(float(flops), flop_counter.get_total_flops())
+        self.assertEqual(num_images, 4)
+
+    def test_video_forward_flops_match_flop_counter(self):
+        model = TinyOtter(max_num_frames=8, max_attended_frames=4, frame_token_pool=2).eval().requires_grad_(False)
+        for module in model.modules():
+            if hasattr(module, "use_sdpa"):
+                module.use_sdpa = False
+        video = torch.randn(2, 1, 8, 3, 32, 32)
+        input_ids = torch.randint(6, 100, (2, 20))
+        input_ids[:, 0] = 5
+        attention_mask = torch.ones_like(input_ids)
+
+        with FlopCounterMode(display=False) as flop_counter, torch.no_grad():
+            model(video, input_ids, attention_mask)
+        flops, num_frames = FlopsAccountant(model).step_flops(attention_mask, images=video)
+        self.assertEqual(float(flops), flop_counter.get_total_flops())
+        self.assertEqual(num_frames, 8)
+
+    def test_summary_per_task_group(self):
+        model = LlamaForCausalLM(LlamaConfig(vocab_size=100, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4))
+        accountant = FlopsAccountant(model, peak_tflops=1.0)
+        attention_mask = torch.tensor([[1, 1, 1, 0], [1, 1, 0, 0]])
+        accountant.update("TEXT_ONLY", 0.5, attention_mask)
+        accountant.update("IMAGE_TEXT", 0.5, attention_mask)
+
+        stats = accountant.summary()
+        self.assertEqual(stats["tokens_per_second/TEXT_ONLY"], 10.0)
+        self.assertAlmostEqual(stats["mfu"], stats["tflops"])
+        self.assertIn("mfu/IMAGE_TEXT", stats)
+        self.assertEqual(accountant.summary(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
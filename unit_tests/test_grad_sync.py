@@ -0,0 +1,109 @@
+import os
+import tempfile
+import unittest
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from pipeline.train.grad_sync import TrainableGradSync, autocast_forward
+
+
+def make_model():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.Linear(16, 16), torch.nn.Linear(16, 16), torch.nn.Linear(16, 1))
+    model[0].requires_grad_(False)
+    return model
+
+
+def run_rank(rank, world_size, init_file, result_file):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+    model = make_model()
+    # a small cap so that the trainable layers are split over several buckets
+    grad_sync = TrainableGradSync(model, bucket_cap_mb=1e-3)
+    inputs = torch.randn(world_size, 4, 8, generator=torch.Generator().manual_seed(1))
+
+    # two accumulation steps, synchronized on the second one; the last layer is unused in the first
+    grad_sync.prepare(sync=False)
+    model[:3](inputs[rank]).sum().backward()
+    grad_sync.prepare(sync=True)
+    model(inputs[rank]).sum().backward()
+    grad_sync.finish()
+
+    if rank == 0:
+        torch.save({name: p.grad.clone() for name, p in model.named_parameters() if p.requires_grad}, result_file)
+    dist.destroy_process_group()
+
+
+class TinyVisionModel(torch.nn.Module):
+    # an fp32 frozen conv like the CLIP patch embedding, fed bf16 pixels as in forward_pass
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.vision_encoder = torch.nn.Conv2d(3, 4, kernel_size=2, stride=2).requires_grad_(False)
+        self.head = torch.nn.Linear(4, 1)
+
+    def forward(self, vision_x):
+        return self.head(self.vision_encoder(vision_x).mean(dim=(2, 3))).sum()
+
+
+def run_autocast_step(rank, world_size, init_file, result_file):
+    from accelerate import Accelerator
+
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+    accelerator = Accelerator(mixed_precision="bf16", cpu=True)
+    model = TinyVisionModel()
+    # the --ddp_trainable_only branch of instruction_following: only the optimizer goes through prepare
+    model = autocast_forward(model, accelerator)
+    optimizer = accelerator.prepare(torch.optim.SGD([p for p in model.parameters() if p.requires_grad], lr=0.1))
+    grad_sync = TrainableGradSync(model)
+    dtypes = {}
+    model.head.register_forward_hook(lambda module, inputs, output: dtypes.update(head=output.dtype))
+
+    grad_sync.prepare(sync=True)
+    loss = model(vision_x=torch.randn(2, 3, 4, 4).to(torch.bfloat16))
+    accelerator.backward(loss)
+    grad_sync.finish()
+    optimizer.step()
+
+    dtypes.update(loss=loss.dtype, grad=model.head.weight.grad.dtype, weight=model.head.weight.dtype)
+    torch.save(dtypes, result_file)
+    dist.destroy_process_group()
+
+
+class TestTrainableGradSync(unittest.TestCase):
+    def test_matches_averaged_gradients(self):
+        world_size = 2
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result_file = os.path.join(tmp_dir, "grads.pt")
+            mp.spawn(run_rank, args=(world_size, os.path.join(tmp_dir, "init"), result_file), nprocs=world_size)
+            synced = torch.load(result_file)
+
+        model = make_model()
+        inputs = torch.randn(world_size, 4, 8, generator=torch.Generator().manual_seed(1))
+        for rank in range(world_size):
+            model[:3](inputs[rank]).sum().div(world_size).backward()
+            model(inputs[rank]).sum().div(world_size).backward()
+        for name, p in model.named_parameters():
+            if p.requires_grad:
+                self.assertTrue(torch.allclose(synced[name], p.grad, atol=1e-6), name)
+            else:
+                self.assertNotIn(name, synced)
+
+    def test_forward_runs_under_autocast(self):
+        with self.assertRaises(RuntimeError):
+            TinyVisionModel()(torch.randn(2, 3, 4, 4).to(torch.bfloat16))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result_file = os.path.join(tmp_dir, "dtypes.pt")
+            mp.spawn(run_autocast_step, args=(1, os.path.join(tmp_dir, "init"), result_file), nprocs=1)
+            dtypes = torch.load(result_file)
+        self.assertEqual(dtypes["head"], torch.bfloat16)
+        # outputs are cast back and the trainable weights stay fp32, as with a prepared model
+        self.assertEqual(dtypes["loss"], torch.float32)
+        self.assertEqual(dtypes["grad"], torch.float32)
+        self.assertEqual(dtypes["weight"], torch.float32)
+
+
+if __name__ == "__main__":
+    unittest.main()
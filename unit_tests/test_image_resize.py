@@ -0,0 +1,88 @@
+import base64
+import io
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+import webdataset as wds
+from PIL import Image
+
+from pipeline.mimicit_utils.data import DraftImageDecoder, decode_image_to_size, preprocess_image_batch
+from pipeline.utils.resize_wds_shards import resize_image_bytes, resize_shard
+
+
+def encode(image, format):
+    buffer = io.BytesIO()
+    image.save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def random_image(width, height, mode="RGB"):
+    return Image.fromarray(np.random.RandomState(0).randint(0, 256, (height, width, len(mode)), dtype=np.uint8).squeeze(), mode=mode)
+
+
+class TestResizeShards(unittest.TestCase):
+    def test_resize_keeps_the_format(self):
+        jpeg = resize_image_bytes(encode(random_image(640, 480), "JPEG"), max_side=320, quality=90)
+        image = Image.open(io.BytesIO(jpeg))
+        self.assertEqual((image.format, image.size), ("JPEG", (320, 240)))
+
+        # PNG images stay lossless PNG, alpha channel included
+        source = random_image(200, 400, mode="RGBA")
+        png = Image.open(io.BytesIO(resize_image_bytes(encode(source, "PNG"), max_side=100, quality=90)))
+        expected = source.copy()
+        expected.thumbnail((100, 100), Image.BICUBIC)
+        self.assertEqual((png.format, png.mode, png.size), ("PNG", "RGBA", (50, 100)))
+        self.assertTrue(np.array_equal(np.asarray(png), np.asarray(expected)))
+
+        small = encode(random_image(64, 64), "PNG")
+        self.assertIs(resize_image_bytes(small, max_side=100, quality=90), small)
+
+    def test_resize_shard(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            shard = os.path.join(tmp_dir, "000000.tar")
+            with wds.TarWriter(shard) as sink:
+                sink.write({"__key__": "a", "jpg": encode(random_image(600, 300), "JPEG"), "txt": "a caption"})
+                sink.write({"__key__": "b", "png": base64.b64encode(encode(random_image(300, 600), "PNG")), "txt": "another caption"})
+            os.makedirs(os.path.join(tmp_dir, "out"))
+            self.assertEqual(resize_shard(shard, os.path.join(tmp_dir, "out"), max_side=150, quality=90, base64_keys=("png",)), (shard, 2))
+
+            samples = list(wds.WebDataset(os.path.join(tmp_dir, "out", "000000.tar"), shardshuffle=False))
+            jpg = Image.open(io.BytesIO(samples[0]["jpg"]))
+            png = Image.open(io.BytesIO(base64.b64decode(samples[1]["png"])))
+            self.assertEqual([(jpg.format, jpg.size), (png.format, png.size)], [("JPEG", (150, 75)), ("PNG", (75, 150))])
+            self.assertEqual(samples[1]["txt"], b"another caption")
+
+
+class TestDraftImageDecoding(unittest.TestCase):
+    def test_decode_image_to_size(self):
+        for rawbytes in [encode(random_image(640, 480), "JPEG"), encode(random_image(100, 300), "PNG")]:
+            image = decode_image_to_size(rawbytes, 224)
+            self.assertEqual((image.mode, image.size), ("RGB", (224, 224)))
+        # palette images with transparency are decoded through RGBA
+        palette = random_image(300, 300).convert("P")
+        palette.info["transparency"] = 0
+        self.assertEqual(decode_image_to_size(encode(palette, "PNG"), 32).size, (32, 32))
+
+    def test_draft_image_decoder(self):
+        decoder = DraftImageDecoder(size=32, base64_keys=("png",))
+        png = base64.b64encode(encode(random_image(64, 48), "PNG"))
+        self.assertEqual(decoder("sample.png", png).shape, (32, 32, 3))
+        self.assertEqual(decoder("sample.jpg", encode(random_image(64, 48), "JPEG")).dtype, np.uint8)
+        self.assertIsNone(decoder("sample.txt", b"a caption"))
+
+    def test_preprocess_image_batch(self):
+        # uniform images, so that the random flip does not matter
+        images = [np.full((8, 8, 3), value, dtype=np.uint8) for value in (0, 255)]
+        mean, std = [0.5, 0.4, 0.3], [0.2, 0.25, 0.5]
+        batch = preprocess_image_batch(images, mean, std)
+        self.assertEqual((batch.shape, batch.dtype), ((2, 3, 8, 8), torch.float32))
+        expected = (torch.tensor([0.0, 1.0])[:, None] - torch.tensor(mean)) / torch.tensor(std)
+        self.assertTrue(torch.allclose(batch[:, :, 0, 0], expected))
+        self.assertTrue(torch.equal(batch, batch[:, :, :1, :1].expand_as(batch)))
+
+
+if __name__ == "__main__":
+    unittest.main()
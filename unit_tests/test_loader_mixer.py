@@ -0,0 +1,51 @@
+import unittest
+
+from pipeline.mimicit_utils.data import LoaderMixer
+
+
+class FailingLoader:
+    def __len__(self):
+        return 3
+
+    def __iter__(self):
+        yield "ok"
+        raise RuntimeError("broken shard")
+
+
+class CountingLoader(list):
+    num_passes = 0
+
+    def __iter__(self):
+        self.num_passes += 1
+        return super().__iter__()
+
+
+class TestLoaderMixer(unittest.TestCase):
+    def test_cycles_the_shorter_loader(self):
+        mmc4 = CountingLoader([f"mmc4{i}" for i in range(3)])
+        mixer = LoaderMixer({"laion": [f"laion{i}" for i in range(8)], "mmc4": mmc4}, ratios={"laion": 2, "mmc4": 1}, prefetch=1)
+        self.assertEqual(len(mixer), 4)
+        steps = list(mixer)
+        self.assertEqual(steps, [{"laion": [f"laion{2 * i}", f"laion{2 * i + 1}"], "mmc4": [f"mmc4{i % 3}"]} for i in range(4)])
+        # iterated again from the start rather than replayed from a cache
+        self.assertEqual(mmc4.num_passes, 2)
+
+    def test_sized_by_the_longest_loader(self):
+        class ShortLoader(list):
+            # announces more batches than it yields, like a webdataset loader can
+            num_batches = 5
+
+        steps = list(LoaderMixer({"laion": ShortLoader(["a", "b"]), "mmc4": list(range(4))}))
+        self.assertEqual(steps, [{"laion": [laion], "mmc4": [mmc4]} for laion, mmc4 in zip("ababa", [0, 1, 2, 3, 0])])
+
+    def test_stops_on_an_empty_loader(self):
+        self.assertEqual(list(LoaderMixer({"laion": [], "mmc4": list(range(3))})), [])
+
+    def test_reraises_loader_errors(self):
+        mixer = LoaderMixer({"laion": FailingLoader(), "mmc4": list(range(3))})
+        with self.assertRaisesRegex(RuntimeError, "broken shard"):
+            list(mixer)
+
+
+if __name__ == "__main__":
+    unittest.main()
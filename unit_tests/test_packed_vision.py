@@ -0,0 +1,34 @@
+import unittest
+
+import torch
+
+from unit_tests.tiny_otter import TinyOtter
+
+
+class TestPackedVisionEncoding(unittest.TestCase):
+    def test_packed_images_match_zero_padding(self):
+        torch.manual_seed(0)
+        model = TinyOtter().eval()
+        for layer in model.lang_encoder._get_decoder_layers():
+            if layer.gated_cross_attn_layer is not None:
+                layer.gated_cross_attn_layer.attn_gate.data.fill_(1.0)
+        num_images = torch.tensor([3, 1, 0])
+        packed = torch.randn(int(num_images.sum()), 1, 3, 32, 32)
+        padded = torch.zeros(3, 3, 1, 3, 32, 32)
+        padded[0], padded[1, 0] = packed[:3], packed[3]
+        input_ids = torch.randint(6, 100, (3, 16))
+        input_ids[0, [0, 4, 9]] = 5
+        input_ids[1, 2] = 5
+        attention_mask = torch.ones_like(input_ids)
+
+        encoded = []
+        model.vision_encoder.register_forward_hook(lambda module, args, output: encoded.append(args[0].shape[0]))
+        with torch.no_grad():
+            expected = model(padded, input_ids, attention_mask).logits
+            actual = model(packed, input_ids, attention_mask, num_images=num_images).logits
+        self.assertTrue(torch.allclose(expected, actual, atol=1e-5))
+        self.assertEqual(encoded, [9, 4])
+
+
+if __name__ == "__main__":
+    unittest.main()
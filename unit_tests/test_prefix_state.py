@@ -0,0 +1,70 @@
+import unittest
+
+import torch
+
+from unit_tests.tiny_otter import TinyOtter
+
+
+class TestPrefixState(unittest.TestCase):
+    lang_model = "llama"
+    # two questions about the same image, the second one padded on the right
+    questions = torch.tensor([[40, 41, 42], [50, 51, 0]])
+    questions_mask = torch.tensor([[1, 1, 1], [1, 1, 0]])
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = TinyOtter(lang_model=self.lang_model).eval()
+        for layer in self.model.lang_encoder._get_decoder_layers():
+            if layer.gated_cross_attn_layer is not None:
+                layer.gated_cross_attn_layer.attn_gate.data.fill_(1.0)
+        self.images = torch.randn(2, 1, 1, 3, 32, 32)
+        self.prefix = torch.randint(7, 100, (2, 8))
+        self.prefix[:, 2] = 5
+        # the second prefix is padded on the left
+        self.prefix_mask = torch.ones_like(self.prefix)
+        self.prefix_mask[1, :2] = 0
+
+    def full_log_likelihood(self, b, continuation):
+        length = int(self.prefix_mask[b].sum())
+        input_ids = torch.cat([self.prefix[b, -length:], continuation])[None]
+        with torch.no_grad():
+            logits = self.model(self.images[b : b + 1], input_ids, torch.ones_like(input_ids)).logits
+        log_probs = logits[0, length - 1 : -1].log_softmax(dim=-1)
+        return log_probs.gather(-1, continuation[:, None]).sum()
+
+    def test_score_matches_full_forward(self):
+        candidates = [torch.tensor([11, 12, 13]), torch.tensor([20]), torch.tensor([30, 31])]
+        state = self.model.prefill(self.images, self.prefix, self.prefix_mask)
+        scores = self.model.score(state, candidates, chunk_size=4)
+        self.assertEqual(scores.shape, (2, 3))
+        for b in range(2):
+            for c, candidate in enumerate(candidates):
+                self.assertTrue(torch.allclose(scores[b, c], self.full_log_likelihood(b, candidate), atol=1e-4))
+
+    def test_extend_forks_the_prefix(self):
+        state = self.model.prefill(self.images[:1], self.prefix[:1])
+        # two questions about the same image, then an answer after each
+        extended = self.model.extend(state, self.questions, self.questions_mask)
+        scores = self.model.score(extended, [torch.tensor([60, 61])])
+        self.prefix_mask = torch.ones_like(self.prefix)
+        for q, question in enumerate([self.questions[q, self.questions_mask[q].bool()] for q in range(2)]):
+            expected = self.full_log_likelihood(0, torch.cat([question, torch.tensor([60, 61])])) - self.full_log_likelihood(0, question)
+            self.assertTrue(torch.allclose(scores[q, 0], expected, atol=1e-4))
+        # the prefix state can still be continued
+        self.assertTrue(torch.allclose(self.model.score(state, [torch.tensor([60])])[0, 0], self.full_log_likelihood(0, torch.tensor([60])), atol=1e-4))
+
+
+class TestPrefixStateMPT(TestPrefixState):
+    # MPT updates the cache it is given in place, and its alibi bias does not skip padding
+    lang_model = "mpt"
+    questions = torch.tensor([[40, 41, 42], [50, 51, 52]])
+    questions_mask = torch.ones_like(questions)
+
+    def test_extend_rejects_padding(self):
+        state = self.model.prefill(self.images[:1], self.prefix[:1])
+        with self.assertRaises(ValueError):
+            self.model.extend(state, TestPrefixState.questions, TestPrefixState.questions_mask)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import functools
+import json
+import unittest
+
+import webdataset as wds
+
+from pipeline.mimicit_utils.data import RejectionStats, decode_interleaved_json, has_interleaved_json, has_valid_interleaved_images, preprocess_interleaved
+
+
+def interleaved_sample(key, image_kb, matched_sim):
+    image_info = [{"image_base64": "A" * (image_kb * 1000 * 4 // 3), "matched_sim": matched_sim, "matched_text_index": 0}]
+    return {"__key__": key, "json": json.dumps({"text_list": ["a sentence"], "image_info": image_info})}
+
+
+class TestRejectionStats(unittest.TestCase):
+    def test_invalid_samples_are_counted_and_dropped(self):
+        stats = RejectionStats("mmc4", log_every=2)
+        samples = [
+            interleaved_sample("valid", image_kb=20, matched_sim=0.3),
+            {"__key__": "no_json", "txt": "a caption"},
+            interleaved_sample("small_image", image_kb=5, matched_sim=0.3),
+            interleaved_sample("unmatched_image", image_kb=20, matched_sim=0.1),
+        ]
+        pipeline = wds.DataPipeline(
+            lambda: iter(samples),
+            stats.select(has_interleaved_json, "no_json"),
+            wds.map(decode_interleaved_json),
+            stats.select(functools.partial(has_valid_interleaved_images, sim_threshold=0.24), "no_valid_images"),
+            wds.map(stats.accept),
+        )
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual([sample["__key__"] for sample in pipeline], ["valid"])
+        self.assertEqual(stats.accepted, 1)
+        self.assertEqual(dict(stats.rejected), {"no_json": 1, "no_valid_images": 2})
+        self.assertEqual(stats.total, 4)
+        self.assertIn("rejected 3/4", stats.summary())
+
+    def test_preprocess_interleaved_rejects_without_raising(self):
+        stats = RejectionStats("mmc4")
+        sample = json.loads(interleaved_sample("small_image", image_kb=5, matched_sim=0.3)["json"])
+        self.assertIsNone(preprocess_interleaved([sample], tokenizer=None, clip_processor=None, sim_threshold=0.24, rejection_stats=stats))
+        self.assertEqual(dict(stats.rejected), {"no_valid_images": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
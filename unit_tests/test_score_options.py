@@ -0,0 +1,67 @@
+import unittest
+
+import torch
+import torch.nn.functional as F
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from pipeline.benchmarks.models.base_model import option_losses
+from unit_tests.tiny_otter import TinyOtter
+
+
+class TestScoreOptions(unittest.TestCase):
+    def test_cached_options_match_full_forward_loss(self):
+        torch.manual_seed(0)
+        model = LlamaForCausalLM(LlamaConfig(vocab_size=100, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4)).eval()
+        prompt = torch.randint(0, 100, (1, 9))
+        options = [torch.randint(0, 100, (n,)) for n in [3, 1, 5]]
+
+        expected = []
+        with torch.no_grad():
+            for option in options:
+                input_ids = torch.cat([prompt[0], option])[None]
+                labels = input_ids.clone()
+                labels[:, : prompt.shape[1]] = -100
+                expected.append(model(input_ids=input_ids, labels=labels).loss.item())
+
+            prefix = model(input_ids=prompt, use_cache=True)
+            option_mask = torch.nn.utils.rnn.pad_sequence([torch.ones_like(option) for option in options], batch_first=True)
+            option_ids = torch.nn.utils.rnn.pad_sequence(options, batch_first=True)
+            num_options, option_len = option_ids.shape
+            outputs = model(
+                input_ids=option_ids,
+                attention_mask=torch.cat([torch.ones(num_options, prompt.shape[1], dtype=torch.long), option_mask], dim=1),
+                past_key_values=tuple(tuple(t.expand(num_options, -1, -1, -1) for t in layer_past) for layer_past in prefix.past_key_values),
+            )
+        actual = option_losses(prefix.logits[0, -1], outputs.logits, option_ids, option_mask)
+        for expected_loss, actual_loss in zip(expected, actual):
+            self.assertAlmostEqual(expected_loss, actual_loss, places=5)
+
+    def test_otter_prefix_scores_match_full_forward_loss(self):
+        torch.manual_seed(0)
+        model = TinyOtter().eval()
+        for layer in model.lang_encoder._get_decoder_layers():
+            if layer.gated_cross_attn_layer is not None:
+                layer.gated_cross_attn_layer.attn_gate.data.fill_(1.0)
+        images = torch.randn(1, 1, 1, 3, 32, 32)
+        # <image> then the question, as get_formatted_prompt; every option ends with <|endofchunk|> like in OtterImage
+        prompt = torch.cat([torch.tensor([5]), torch.randint(7, 100, (8,))])[None]
+        options = [torch.cat([torch.randint(7, 100, (n,)), torch.tensor([model.eoc_token_id])]) for n in [3, 1, 5]]
+
+        expected = []
+        with torch.no_grad():
+            for option in options:
+                input_ids = torch.cat([prompt[0], option])[None]
+                logits = model(images, input_ids, torch.ones_like(input_ids)).logits
+                expected.append(F.cross_entropy(logits[0, prompt.shape[1] - 1 : -1], option).item())
+
+            # as OtterImage.score_options
+            state = model.prefill(images, prompt, torch.ones_like(prompt))
+            log_likelihoods = model.score(state, options)[0]
+        lengths = torch.tensor([len(option) for option in options])
+        actual = (-log_likelihoods / lengths).tolist()
+        for expected_loss, actual_loss in zip(expected, actual):
+            self.assertAlmostEqual(expected_loss, actual_loss, places=4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import itertools
+import unittest
+
+import torch
+
+from src.otter_ai.models.flamingo.modeling_flamingo import FlamingoMaskedCrossAttention
+from src.otter_ai.models.otter.modeling_otter import OtterMaskedCrossAttention, OtterPerceiverBlock
+
+
+def outputs_and_grads(module, use_sdpa, inputs, **kwargs):
+    module.use_sdpa = use_sdpa
+    module.zero_grad()
+    inputs = [t.detach().requires_grad_() for t in inputs]
+    out = module(*inputs, **kwargs)
+    out.square().sum().backward()
+    return [out] + [t.grad for t in inputs] + [p.grad for p in module.parameters()]
+
+
+class TestSDPAAttention(unittest.TestCase):
+    def assert_parity(self, module, inputs, **kwargs):
+        reference = outputs_and_grads(module, False, inputs, **kwargs)
+        fused = outputs_and_grads(module, True, inputs, **kwargs)
+        for expected, actual in zip(reference, fused):
+            self.assertTrue(torch.allclose(expected, actual, atol=1e-5), (expected - actual).abs().max())
+
+    def test_perceiver_block(self):
+        torch.manual_seed(0)
+        block = OtterPerceiverBlock(dim=32, dim_head=8, heads=4)
+        self.assert_parity(block, [torch.randn(2, 3, 10, 32), torch.randn(2, 3, 4, 32)])
+
+    def test_masked_cross_attention(self):
+        torch.manual_seed(0)
+        x = torch.randn(3, 12, 32)
+        media = torch.randn(3, 2, 4, 16)
+        media_locations = torch.zeros(3, 12, dtype=torch.bool)
+        # text before the first image, two images, and a sequence without images
+        media_locations[0, [2, 7]] = True
+        media_locations[1, 0] = True
+        media_offset = torch.tensor([0, 1, 1])
+        for attention_cls, only_attend_immediate_media, attend_previous, offset in itertools.product([OtterMaskedCrossAttention, FlamingoMaskedCrossAttention], [True, False], [True, False], [None, media_offset]):
+            with self.subTest(attention_cls=attention_cls.__name__, only_attend_immediate_media=only_attend_immediate_media, attend_previous=attend_previous, offset=offset):
+                attention = attention_cls(dim=32, dim_visual=16, dim_head=8, heads=4, only_attend_immediate_media=only_attend_immediate_media)
+                self.assert_parity(attention, [x, media], media_locations=media_locations, attend_previous=attend_previous, media_offset=offset)
+                self.assert_parity(attention, [x, media])
+
+
+if __name__ == "__main__":
+    unittest.main()
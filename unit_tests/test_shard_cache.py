@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+
+from pipeline.mimicit_utils.data import ShardCache
+
+
+class TestShardCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.source_dir = os.path.join(self.tmp_dir.name, "source")
+        self.cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        os.makedirs(self.source_dir)
+        self.shards = []
+        for i in range(4):
+            path = os.path.join(self.source_dir, f"{i:06d}.tar")
+            with open(path, "wb") as f:
+                f.write(bytes([i]) * 1000)
+            self.shards.append(path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_rewrites_urls_to_local_copies(self):
+        cache = ShardCache(self.cache_dir, max_bytes=10**6, lookahead=2)
+        urls = [self.shards[0], f"file://{self.shards[1]}", f"pipe:cat {self.shards[2]}"]
+        outputs = list(cache.run(iter([dict(url=url) for url in urls])))
+
+        self.assertEqual(len(outputs), 3)
+        for i, sample in enumerate(outputs):
+            self.assertTrue(sample["url"].startswith(self.cache_dir))
+            with open(sample["url"], "rb") as f:
+                self.assertEqual(f.read(), bytes([i]) * 1000)
+
+    def test_evicts_least_recently_used_under_quota(self):
+        cache = ShardCache(self.cache_dir, max_bytes=2500, lookahead=0, num_workers=1)
+        first = cache.fetch(self.shards[0])
+        cache.fetch(self.shards[1])
+        os.utime(first, (0, 0))  # make the first shard the least recently used one
+        cache.fetch(self.shards[2])
+
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual(len(cache.cached_shards()), 2)
+        self.assertLessEqual(sum(size for _, size, _ in cache.cached_shards()), 2500)
+
+    def test_keeps_shards_being_read(self):
+        cache = ShardCache(self.cache_dir, max_bytes=2500, lookahead=0, num_workers=1)
+        samples = cache.run(iter([dict(url=self.shards[0]), dict(url=self.shards[1])]))
+        first = next(samples)["url"]  # read-locked until the next shard is requested
+        os.utime(first, (0, 0))
+        second = cache.fetch(self.shards[1])
+        cache.fetch(self.shards[2])
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+
+        samples.close()
+        os.utime(first, (0, 0))
+        cache.fetch(self.shards[3])
+        self.assertFalse(os.path.exists(first))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+import torch
+
+from src.otter_ai.models.static_decoding import StaticDecoder
+from unit_tests.tiny_otter import TinyOtter
+
+
+class TestStaticDecoding(unittest.TestCase):
+    def test_matches_greedy_full_forward(self):
+        torch.manual_seed(0)
+        model = TinyOtter(lang_model="mpt").eval()
+        for layer in model.lang_encoder._get_decoder_layers():
+            if layer.gated_cross_attn_layer is not None:
+                # the gates start closed, open them so that the cross-attention output matters
+                layer.gated_cross_attn_layer.attn_gate.data.fill_(1.0)
+        images = torch.randn(2, 2, 1, 3, 32, 32)
+        input_ids = torch.randint(7, 100, (2, 10))
+        input_ids[0, [0, 6]] = 5
+        input_ids[1, [3, 6]] = 5
+        # the second prompt is padded on the left
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[1, :3] = 0
+
+        expected, mask = input_ids, attention_mask
+        with torch.no_grad():
+            for _ in range(6):
+                next_tokens = model(images, expected, mask).logits[:, -1].argmax(dim=-1)
+                expected = torch.cat([expected, next_tokens[:, None]], dim=1)
+                mask = torch.cat([mask, torch.ones_like(mask[:, :1])], dim=1)
+
+        decoder = StaticDecoder(model, max_length=24)
+        self.assertFalse(decoder.use_cuda_graph)
+        for _ in range(2):
+            # the cache is reused by the next prompt of the same batch size
+            self.assertTrue(torch.equal(decoder.generate(images, input_ids, attention_mask, max_new_tokens=6), expected))
+        self.assertEqual(int(decoder.cache(2).seq_len), 15)
+        self.assertFalse(model.lang_encoder.is_conditioned())
+
+
+if __name__ == "__main__":
+    unittest.main()
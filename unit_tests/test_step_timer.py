@@ -0,0 +1,56 @@
+import unittest
+
+import torch
+import torch.utils.checkpoint
+
+from pipeline.train.step_timer import StepTimer
+
+
+class TestStepTimer(unittest.TestCase):
+    def test_breakdown_and_hooks(self):
+        model = torch.nn.Module()
+        model.vision_encoder = torch.nn.Linear(4, 4)
+        model.lang_encoder = torch.nn.Linear(4, 4)
+        timer = StepTimer()
+        timer.attach_otter(model)
+        for _ in range(3):
+            with timer.section("forward"):
+                model.lang_encoder(model.vision_encoder(torch.randn(2, 4)))
+            timer.step(num_tokens=torch.tensor(5))
+
+        stats = timer.summary()
+        for name in ["time/step_ms", "time/forward_ms", "time/vision_encode_ms", "time/lm_forward_ms", "tokens_per_second"]:
+            self.assertIn(name, stats)
+        self.assertGreaterEqual(stats["time/forward_ms"], stats["time/vision_encode_ms"])
+        self.assertEqual(timer.summary(), {})
+
+        timer.close()
+        self.assertEqual(len(model.vision_encoder._forward_hooks), 0)
+
+    def test_checkpoint_recompute_is_not_counted_as_forward(self):
+        model = torch.nn.Module()
+        model.lang_encoder = torch.nn.Linear(4, 4)
+        timer = StepTimer()
+        timer.attach_otter(model)
+        for _ in range(2):
+            with timer.section("forward"):
+                loss = torch.utils.checkpoint.checkpoint(model.lang_encoder, torch.randn(2, 4, requires_grad=True), use_reentrant=True).sum()
+            with timer.section("backward"):
+                loss.backward()
+            timer.step()
+
+        # one lm_forward per step, the recomputation (a full forward with reentrant checkpointing) happens inside backward
+        self.assertEqual(len(timer.intervals["lm_forward"]), 2)
+        self.assertEqual(len(timer.intervals["backward"]), 2)
+        timer.close()
+
+    def test_disabled(self):
+        timer = StepTimer(enabled=False)
+        with timer.section("forward"):
+            pass
+        timer.step(num_tokens=3)
+        self.assertEqual(timer.summary(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
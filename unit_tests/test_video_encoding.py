@@ -0,0 +1,47 @@
+import unittest
+
+import torch
+
+from unit_tests.tiny_otter import TinyOtter
+
+
+class TestVideoEncoding(unittest.TestCase):
+    def encode(self, model, video):
+        model._encode_vision_x(video)
+        return model.lang_encoder._get_decoder_layers()[1].vis_x
+
+    def test_chunked_frame_encoding(self):
+        torch.manual_seed(0)
+        model = TinyOtter(max_num_frames=8).eval()
+        video = torch.randn(2, 1, 8, 3, 32, 32)
+        with torch.no_grad():
+            expected = self.encode(model, video)
+            model.vision_encoder_chunk_size = 3
+            calls = []
+            model.vision_encoder.register_forward_hook(lambda module, args, output: calls.append(args[0].shape[0]))
+            actual = self.encode(model, video)
+        self.assertTrue(torch.allclose(expected, actual, atol=1e-5))
+        self.assertEqual(calls, [3, 3, 3, 3, 3, 1])
+
+    def test_frame_subsampling_and_pooling(self):
+        torch.manual_seed(0)
+        model = TinyOtter(max_num_frames=8, max_attended_frames=4, frame_token_pool=2).eval()
+        video = torch.randn(2, 1, 8, 3, 32, 32)
+        frame_ids = torch.tensor([0, 2, 4, 7])
+        self.assertTrue(torch.equal(model.perceiver.select_frames(8), frame_ids))
+        self.assertIsNone(model.perceiver.select_frames(4))
+
+        calls = []
+        model.vision_encoder.register_forward_hook(lambda module, args, output: calls.append(args[0].shape[0]))
+        # 4 patches per frame are left out of the 4x4 grid
+        model.perceiver.layers[0].register_forward_hook(lambda module, args, output: calls.append(args[0].shape[-2]))
+        with torch.no_grad():
+            actual = self.encode(model, video)
+            features = model.vision_encoder(video[:, :, frame_ids].flatten(0, 2))[0][:, 1:, :]
+            expected = model.perceiver(features.view(2, 1, 4, 16, 64), frame_ids=frame_ids)
+        self.assertTrue(torch.allclose(expected, actual, atol=1e-5))
+        self.assertEqual(calls[:2], [8, 16])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import torch.nn as nn
+from transformers import CLIPVisionConfig, CLIPVisionModel, LlamaConfig, LlamaForCausalLM
+
+from src.otter_ai.models.mpt.configuration_mpt import MPTConfig
+from src.otter_ai.models.mpt.modeling_mpt import MPTForCausalLM
+from src.otter_ai.models.otter.modeling_otter import OtterForConditionalGeneration, OtterLMMixin, OtterPerceiverResampler, _infer_decoder_layers_attr_name, extend_instance
+
+
+class TinyOtter(nn.Module):
+    def __init__(self, lang_model="llama", **perceiver_kwargs):
+        super().__init__()
+        self.vision_encoder = CLIPVisionModel(CLIPVisionConfig(hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4, image_size=32, patch_size=8))
+        self.perceiver = OtterPerceiverResampler(dim=64, depth=2, num_latents=8, **perceiver_kwargs)
+        if lang_model == "mpt":
+            mpt_config = MPTConfig(d_model=64, n_heads=4, n_layers=4, expansion_ratio=2, max_seq_len=64, vocab_size=100, attn_config={"attn_impl": "torch", "alibi": True}, hidden_size=64)
+            lang_encoder = MPTForCausalLM(mpt_config)
+        else:
+            lang_encoder = LlamaForCausalLM(LlamaConfig(vocab_size=100, hidden_size=64, intermediate_size=128, num_hidden_layers=4, num_attention_heads=4))
+        extend_instance(lang_encoder, OtterLMMixin)
+        lang_encoder.set_decoder_layers_attr_name(_infer_decoder_layers_attr_name(lang_encoder))
+        lang_encoder.init_otter(media_token_id=5, vis_hidden_size=64, cross_attn_every_n_layers=2, use_media_placement_augmentation=False)
+        self.lang_encoder = lang_encoder
+        self.vision_encoder_chunk_size = None
+
+    eoc_token_id = 6
+    _encode_vision_x = OtterForConditionalGeneration._encode_vision_x
+    _position_kwargs = OtterForConditionalGeneration._position_kwargs
+    _run_lang_encoder = OtterForConditionalGeneration._run_lang_encoder
+    _continue = OtterForConditionalGeneration._continue
+    prefill = OtterForConditionalGeneration.prefill
+    extend = OtterForConditionalGeneration.extend
+    score = OtterForConditionalGeneration.score
+
+    def forward(self, images, input_ids, attention_mask, num_images=None):
+        self._encode_vision_x(images, num_images=num_images)
+        return self.lang_encoder(input_ids=input_ids, attention_mask=attention_mask)